@@ -0,0 +1,151 @@
+"""
+Valuation change between two dates, split into quantity, price and FX effects
+
+For a holding valued q × p × fx (in HUF) on both dates, the change is
+attributed sequentially:
+
+- quantity effect: (q1 - q0) × p0 × fx0
+- price effect:    q1 × (p1 - p0) × fx0
+- FX effect:       q1 × p1 × (fx1 - fx0)
+
+which adds up exactly to the change. A position opened in between is all
+quantity effect (valued at the end prices); one closed is minus its start
+value. Wealth categories have no quantity: their local-currency change at
+the start rate is the price effect, the rest is FX. Liabilities count
+negatively, so effects add up to the change in net wealth.
+
+Portfolios resolve as of their last valued day on or before each date,
+wealth values as of their latest value (see wealth_crud). Categories in a
+currency without FX rates are listed under 'unconverted' instead.
+"""
+from datetime import date
+from typing import Iterable, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import Session
+from . import models
+from .wealth_crud import get_wealth_values_as_of, portfolio_subtotals, wealth_values_in_huf
+
+EFFECTS = ('quantity_effect_huf', 'price_effect_huf', 'fx_effect_huf')
+
+
+def _effects(q0, p0, f0, q1, p1, f1):
+    """Sequential attribution over float arrays; missing start/end legs are 0 quantity"""
+    # Opened positions: no start price, so value the quantity at end prices
+    p0 = np.where(q0 == 0, p1, p0)
+    f0 = np.where(q0 == 0, f1, f0)
+    quantity = (q1 - q0) * p0 * f0
+    price = q1 * (p1 - p0) * f0
+    fx = q1 * p1 * (f1 - f0)
+    return quantity, price, fx
+
+
+def _holdings(db: Session, start_date: date, end_date: date, portfolio_ids: Optional[Iterable[int]]) -> List[dict]:
+    # Which leg(s), start and/or end, each (portfolio, valued day) stands for
+    legs = {}
+    for p in portfolio_subtotals(db, [start_date, end_date], portfolio_ids):
+        for k in (0, 1):
+            if not np.isnat(p['value_date'][k]):
+                legs.setdefault((p['portfolio_id'], p['value_date'][k].astype(date)), []).append(k)
+    if not legs:
+        return []
+
+    rows = db.query(
+        models.PortfolioValueDaily.portfolio_id, models.PortfolioValueDaily.snapshot_date,
+        models.PortfolioValueDaily.instrument_id, models.Instrument.name,
+        models.PortfolioValueDaily.instrument_currency, models.PortfolioValueDaily.quantity,
+        models.PortfolioValueDaily.price, models.PortfolioValueDaily.fx_rate
+    ).join(
+        models.Instrument, models.Instrument.id == models.PortfolioValueDaily.instrument_id
+    ).filter(
+        or_(*[
+            and_(models.PortfolioValueDaily.portfolio_id == pid, models.PortfolioValueDaily.snapshot_date == day)
+            for pid, day in legs
+        ])
+    ).all()
+
+    holdings = {}
+    for row in rows:
+        for k in legs.get((row.portfolio_id, row.snapshot_date), ()):
+            holding = holdings.setdefault((row.portfolio_id, row.instrument_id), {
+                'portfolio_id': row.portfolio_id, 'instrument_id': row.instrument_id,
+                'name': row.name, 'currency': row.instrument_currency,
+                'legs': [(0.0, 0.0, 0.0), (0.0, 0.0, 0.0)]
+            })
+            holding['legs'][k] = (float(row.quantity), float(row.price or 0), float(row.fx_rate or 1))
+    return sorted(holdings.values(), key=lambda h: (h['portfolio_id'], h['instrument_id']))
+
+
+def _wealth(db: Session, start_date: date, end_date: date) -> Tuple[List[dict], List[dict]]:
+    """Wealth categories with their (value, fx) legs, and the categories left
+    out because their currency has no FX rate"""
+    categories, unconverted = {}, {}
+    for k, day in enumerate((start_date, end_date)):
+        for wv in wealth_values_in_huf(db, get_wealth_values_as_of(db, day)):
+            if wv['fx_rate'] is None:
+                unconverted[wv['category_id']] = {key: wv[key] for key in ('category_id', 'name', 'currency')}
+                continue
+            category = categories.setdefault(wv['category_id'], {
+                'category_id': wv['category_id'], 'name': wv['name'],
+                'category_type': wv['category_type'], 'currency': wv['currency'],
+                'is_liability': wv['is_liability'], 'legs': [(0.0, 0.0), (0.0, 0.0)]
+            })
+            sign = -1.0 if wv['is_liability'] else 1.0
+            present_value = abs(wv['present_value']) if wv['is_liability'] else wv['present_value']
+            category['legs'][k] = (sign * present_value, wv['fx_rate'])
+    converted = [c for category_id, c in sorted(categories.items()) if category_id not in unconverted]
+    return converted, [c for _, c in sorted(unconverted.items())]
+
+
+def _lines(items: List[dict], q0, p0, f0, q1, p1, f1) -> List[dict]:
+    start, end = q0 * p0 * f0, q1 * p1 * f1
+    quantity, price, fx = _effects(q0, p0, f0, q1, p1, f1)
+    lines = []
+    for k, item in enumerate(items):
+        line = {key: value for key, value in item.items() if key != 'legs'}
+        line.update({
+            'start_value_huf': float(start[k]),
+            'end_value_huf': float(end[k]),
+            'change_huf': float(end[k] - start[k]),
+            'quantity_effect_huf': float(quantity[k]),
+            'price_effect_huf': float(price[k]),
+            'fx_effect_huf': float(fx[k])
+        })
+        lines.append(line)
+    return lines
+
+
+def valuation_attribution(
+    db: Session,
+    start_date: date,
+    end_date: date,
+    portfolio_ids: Optional[Iterable[int]] = None
+) -> dict:
+    """Per-instrument and per-wealth-category change between two dates"""
+    if end_date < start_date:
+        raise ValueError("end_date must not be before start_date")
+
+    holdings = _holdings(db, start_date, end_date, portfolio_ids)
+    legs = np.array([h['legs'] for h in holdings], dtype=float).reshape(len(holdings), 2, 3)
+    instruments = _lines(holdings, *legs[:, 0].T, *legs[:, 1].T)
+
+    categories, unconverted = _wealth(db, start_date, end_date)
+    values = np.array([c['legs'] for c in categories], dtype=float).reshape(len(categories), 2, 2)
+    # Value as price with quantity 1 (held while the value is non-zero)
+    units = (values[:, :, 0] != 0).astype(float)
+    wealth = _lines(categories, units[:, 0], values[:, 0, 0], values[:, 0, 1], units[:, 1], values[:, 1, 0], values[:, 1, 1])
+    # A category's value moving to or from zero is a value change, not a quantity change
+    for line in wealth:
+        line['price_effect_huf'] += line['quantity_effect_huf']
+        line['quantity_effect_huf'] = 0.0
+
+    lines = instruments + wealth
+    totals = {key: sum(line[key] for line in lines) for key in ('start_value_huf', 'end_value_huf', 'change_huf', *EFFECTS)}
+    return {
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'instruments': instruments,
+        'wealth': wealth,
+        'unconverted': unconverted,
+        'totals': totals
+    }
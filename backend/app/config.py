@@ -20,6 +20,16 @@ class Settings(BaseSettings):
     database_pool_size: int = 5
     database_max_overflow: int = 10
     
+    # Worker processes for portfolio valuation (each opens its own connections)
+    etl_workers: int = 4
+    
+    # Days of change_journal history kept by the daily ETL; clients and caches
+    # last synced before that get a full copy
+    journal_retention_days: int = 30
+    
+    # CSV of decreed BÉT bridge days by year; empty uses data/bet_bridge_days.csv
+    bet_bridge_days_file: str = ""
+    
     class Config:
         # Look for .env in the project root (parent of backend/)
         env_file = str(Path(__file__).parent.parent.parent / ".env")
@@ -0,0 +1,336 @@
+"""
+Cost basis and realized / unrealized gains from the transaction ledger
+
+Lots are matched per instrument either FIFO or at average cost. The whole
+portfolio ledger is loaded once into NumPy arrays, sorted by
+(instrument, date), and each instrument's slice is processed in one pass.
+
+FIFO is fully vectorized: with cumulative bought quantity B and cumulative
+bought cost C, the first x units ever bought cost interp(x, B, C). A sale
+that takes the cumulative quantity sold from S0 to S1 therefore consumes
+interp(S1) - interp(S0) of cost, and the open lots are whatever lies past
+the total quantity sold. A sale can only close units bought before it:
+S is the running sum of sales clamped to the quantity bought so far, as the
+average-cost pass does.
+
+Conventions:
+- Holding.quantity at Holding.acquisition_price is the opening lot
+- BUY and positive ADJUST open lots at the transaction price (zero cost if
+  no price was recorded)
+- SELL closes units at the transaction price; negative ADJUST and SELLs
+  without a price close units at cost, realizing nothing
+"""
+import threading
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal
+from typing import Dict, Optional, Tuple
+import numpy as np
+from sqlalchemy.orm import Session
+from . import models
+from .positions import signed_quantity
+from .journal import current_version
+
+METHODS = ('fifo', 'average')
+
+# Lot states kept, least recently used dropped first (one per as_of date
+# asked for, so a range of historical dates would otherwise pile up)
+LOT_CACHE_SIZE = 256
+
+# (portfolio_id, method, as_of) -> (ledger version, result)
+_lot_cache: 'OrderedDict[Tuple[int, str, Optional[date]], Tuple[int, dict]]' = OrderedDict()
+_lot_cache_lock = threading.Lock()
+
+
+def cumulative_sold(quantities: np.ndarray) -> np.ndarray:
+    """Total quantity sold after each sale of one instrument, in ledger order
+
+    A sale closes at most what was bought before it and not yet sold:
+    S_k = min(S_k-1 + s_k, B_k), which unrolls to
+    T_k + min(0, min_j<=k (B_j - T_j)) with T the unclamped running sum.
+    """
+    sells = quantities < 0
+    bought_before = np.cumsum(np.where(quantities > 0, quantities, 0.0))[sells]
+    total = np.cumsum(-quantities[sells])
+    return total + np.minimum(np.minimum.accumulate(bought_before - total), 0.0)
+
+
+def _fifo(quantities: np.ndarray, prices: np.ndarray, realizes: np.ndarray):
+    """FIFO matching for one instrument, in ledger order"""
+    buys = quantities > 0
+    buy_qty = quantities[buys]
+    buy_price = prices[buys]
+    cum_qty = np.concatenate(([0.0], np.cumsum(buy_qty)))
+    cum_cost = np.concatenate(([0.0], np.cumsum(buy_qty * buy_price)))
+
+    sells = quantities < 0
+    cum_sold = cumulative_sold(quantities)
+    prev_sold = np.concatenate(([0.0], cum_sold[:-1]))
+    closed = cum_sold - prev_sold
+    consumed = np.interp(cum_sold, cum_qty, cum_cost) - np.interp(prev_sold, cum_qty, cum_cost)
+
+    closes = realizes[sells]
+    realized = float(np.sum(closed[closes] * prices[sells][closes] - consumed[closes]))
+
+    # Open lots: the part of each buy lot beyond the total quantity sold
+    total_sold = cum_sold[-1] if len(cum_sold) else 0.0
+    open_qty = np.clip(cum_qty[1:] - np.maximum(cum_qty[:-1], total_sold), 0.0, None)
+    open_mask = open_qty > 0
+    return realized, open_qty[open_mask], buy_price[open_mask], np.flatnonzero(buys)[open_mask]
+
+
+def _average(quantities: np.ndarray, prices: np.ndarray, realizes: np.ndarray):
+    """Average-cost matching for one instrument, in ledger order"""
+    held = 0.0
+    cost = 0.0
+    realized = 0.0
+    last_buy = -1
+    for i, (qty, price, realize) in enumerate(zip(quantities.tolist(), prices.tolist(), realizes.tolist())):
+        if qty > 0:
+            held += qty
+            cost += qty * price
+            last_buy = i
+        elif qty < 0:
+            closed = min(-qty, held)
+            consumed = cost * closed / held if held else 0.0
+            if realize:
+                realized += closed * price - consumed
+            held -= closed
+            cost -= consumed
+    if held <= 0:
+        return realized, np.array([]), np.array([]), np.array([], dtype=int)
+    return realized, np.array([held]), np.array([cost / held]), np.array([last_buy])
+
+
+def compute_lots(
+    instrument_ids: np.ndarray,
+    dates: np.ndarray,
+    quantities: np.ndarray,
+    prices: np.ndarray,
+    realizes: np.ndarray,
+    method: str = 'fifo'
+) -> Dict[int, dict]:
+    """Match lots for a whole ledger
+
+    Arrays are aligned per ledger entry: signed quantity, unit price and
+    whether a disposal realizes a gain. Entries on the same date keep their
+    input order.
+
+    Returns per instrument: open quantity, cost basis of open lots, realized
+    gain and the open lots themselves, all in the instrument currency.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown cost basis method: {method}")
+    match = _fifo if method == 'fifo' else _average
+
+    order = np.lexsort((dates, instrument_ids))
+    instrument_ids = instrument_ids[order]
+    dates = dates[order]
+    quantities = quantities[order]
+    prices = prices[order]
+    realizes = realizes[order]
+
+    date_strings = np.datetime_as_string(dates, unit='D')
+
+    # Slice boundaries of each instrument in the sorted ledger
+    boundaries = np.flatnonzero(np.diff(instrument_ids)) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [len(instrument_ids)]))
+
+    results = {}
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        if start == end:
+            continue
+        realized, lot_qty, lot_cost, lot_idx = match(
+            quantities[start:end], prices[start:end], realizes[start:end]
+        )
+        quantity = float(lot_qty.sum())
+        cost_basis = float(np.dot(lot_qty, lot_cost))
+        results[int(instrument_ids[start])] = {
+            'quantity': quantity,
+            'cost_basis': cost_basis,
+            'average_cost': cost_basis / quantity if quantity else None,
+            'realized_gain': realized,
+            'lots': [
+                {'date': lot_date, 'quantity': q, 'unit_cost': c}
+                for lot_date, q, c in zip(
+                    date_strings[start + lot_idx].tolist(), lot_qty.tolist(), lot_cost.tolist()
+                )
+            ]
+        }
+    return results
+
+
+def load_ledger_arrays(db: Session, portfolio_id: int, as_of: Optional[date] = None):
+    """Opening lots and transactions of a portfolio as aligned NumPy arrays"""
+    holdings = db.query(
+        models.Holding.instrument_id,
+        models.Holding.acquisition_date,
+        models.Holding.quantity,
+        models.Holding.acquisition_price
+    ).filter(models.Holding.portfolio_id == portfolio_id)
+
+    transactions = db.query(
+        models.Transaction.instrument_id,
+        models.Transaction.transaction_date,
+        models.Transaction.transaction_type,
+        models.Transaction.quantity,
+        models.Transaction.price
+    ).filter(models.Transaction.portfolio_id == portfolio_id)
+
+    if as_of is not None:
+        holdings = holdings.filter(
+            (models.Holding.acquisition_date == None) | (models.Holding.acquisition_date <= as_of)
+        )
+        transactions = transactions.filter(models.Transaction.transaction_date <= as_of)
+
+    rows = [
+        (instrument_id, acquisition_date or date(1900, 1, 1), float(quantity),
+         float(price or 0), False)
+        for instrument_id, acquisition_date, quantity, price in holdings.all()
+    ]
+    rows += [
+        (instrument_id, tx_date, float(signed_quantity(tx_type, quantity)),
+         float(price or 0), tx_type == 'SELL' and price is not None)
+        for instrument_id, tx_date, tx_type, quantity, price in transactions.order_by(
+            models.Transaction.transaction_date, models.Transaction.id
+        ).all()
+    ]
+
+    if not rows:
+        empty = np.array([])
+        return empty.astype(np.int64), empty.astype('datetime64[D]'), empty, empty, empty.astype(bool)
+
+    instrument_ids, dates, quantities, prices, realizes = zip(*rows)
+    return (
+        np.array(instrument_ids, dtype=np.int64),
+        np.array(dates, dtype='datetime64[D]'),
+        np.array(quantities, dtype=np.float64),
+        np.array(prices, dtype=np.float64),
+        np.array(realizes, dtype=bool)
+    )
+
+
+def _ledger_version(db: Session, portfolio_id: int) -> int:
+    """Journal version of the portfolio's ledger, for cache validation"""
+    return current_version(db, ('transactions', 'holdings'), portfolio_id)
+
+
+def get_lot_state(
+    db: Session,
+    portfolio_id: int,
+    as_of: Optional[date] = None,
+    method: str = 'fifo'
+) -> Dict[int, dict]:
+    """Matched lots per instrument, cached until the ledger changes"""
+    key = (portfolio_id, method, as_of)
+    version = _ledger_version(db, portfolio_id)
+    with _lot_cache_lock:
+        cached = _lot_cache.get(key)
+        if cached and cached[0] == version:
+            _lot_cache.move_to_end(key)
+            return cached[1]
+
+    result = compute_lots(*load_ledger_arrays(db, portfolio_id, as_of), method=method)
+    with _lot_cache_lock:
+        _lot_cache[key] = (version, result)
+        _lot_cache.move_to_end(key)
+        while len(_lot_cache) > LOT_CACHE_SIZE:
+            _lot_cache.popitem(last=False)
+    return result
+
+
+def lot_cost_in_huf(
+    db: Session,
+    state: Optional[dict],
+    currency: str,
+    fallback_rate: Optional[Decimal] = None,
+    fx_cache: Optional[dict] = None
+):
+    """Cost basis of open lots in HUF, each lot at the FX rate of its own date
+
+    Lots dated before the first stored FX rate (e.g. opening balances without
+    an acquisition date) use fallback_rate. Returns None when there are no
+    open lots with a known cost.
+    """
+    from .etl.calculate_values import get_fx_rate
+
+    if not state or not state['cost_basis']:
+        return None
+    if fx_cache is None:
+        fx_cache = {}
+
+    total = Decimal('0')
+    for lot in state['lots']:
+        key = (currency, lot['date'])
+        if key not in fx_cache:
+            fx_cache[key] = get_fx_rate(currency, 'HUF', date.fromisoformat(lot['date']), db)
+        fx_rate = fx_cache[key] or fallback_rate
+        if fx_rate is None:
+            return None
+        total += Decimal(str(lot['quantity'])) * Decimal(str(lot['unit_cost'])) * fx_rate
+    return total
+
+
+def calculate_gains(
+    db: Session,
+    portfolio_id: int,
+    as_of: Optional[date] = None,
+    method: str = 'fifo'
+) -> list:
+    """Realized and unrealized gains per instrument
+
+    Unrealized gain values the open lots at the latest price on or before
+    as_of. In HUF the value uses the FX rate of that date and the cost each
+    lot's own rate (lot_cost_in_huf), like the stored cost_basis_huf;
+    realized gains use the as_of rate.
+    """
+    from .etl.calculate_values import get_latest_price, get_fx_rate
+
+    if as_of is None:
+        as_of = date.today()
+    lots = get_lot_state(db, portfolio_id, as_of, method)
+    if not lots:
+        return []
+
+    fx_cache = {}
+    instruments = {
+        i.id: i for i in db.query(models.Instrument).filter(models.Instrument.id.in_(list(lots)))
+    }
+
+    results = []
+    for instrument_id, state in lots.items():
+        instrument = instruments.get(instrument_id)
+        if instrument is None:
+            continue
+        price = get_latest_price(instrument_id, as_of, db)
+        fx_rate = get_fx_rate(instrument.currency, 'HUF', as_of, db)
+        fx = float(fx_rate) if fx_rate else None
+
+        market_value = state['quantity'] * float(price) if price is not None else None
+        unrealized = market_value - state['cost_basis'] if market_value is not None else None
+        cost_huf = lot_cost_in_huf(db, state, instrument.currency, fx_rate, fx_cache) if fx else None
+        unrealized_huf = (
+            market_value * fx - float(cost_huf) if market_value is not None and cost_huf is not None else None
+        )
+
+        results.append({
+            'instrument_id': instrument_id,
+            'isin': instrument.isin,
+            'name': instrument.name,
+            'currency': instrument.currency,
+            'quantity': state['quantity'],
+            'average_cost': state['average_cost'],
+            'cost_basis': state['cost_basis'],
+            'price': float(price) if price is not None else None,
+            'market_value': market_value,
+            'realized_gain': state['realized_gain'],
+            'unrealized_gain': unrealized,
+            'fx_rate': fx,
+            'cost_basis_huf': float(cost_huf) if cost_huf is not None else None,
+            'realized_gain_huf': state['realized_gain'] * fx if fx else None,
+            'unrealized_gain_huf': unrealized_huf,
+            'lots': state['lots']
+        })
+
+    return sorted(results, key=lambda r: r['name'])
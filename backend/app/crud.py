@@ -1,28 +1,49 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, desc, func
+from sqlalchemy import and_, desc, func, insert, select, update
 from datetime import date, datetime
-from . import models
+from . import models, positions
+from .revaluation import mark_dirty
 from typing import List, Optional
 
+def valued_as_of(portfolio_id: int, snapshot_date: date):
+    """Latest stored valuation date on or before snapshot_date, as a subquery
+
+    Values are not stored for days no market was open, so reads resolve
+    those as of the last valued day.
+    """
+    return select(func.max(models.PortfolioValueDaily.snapshot_date)).where(
+        models.PortfolioValueDaily.portfolio_id == portfolio_id,
+        models.PortfolioValueDaily.snapshot_date <= snapshot_date
+    ).scalar_subquery()
+
 def get_portfolio_snapshot(db: Session, portfolio_id: int, snapshot_date: date):
-    """Get portfolio snapshot for a date"""
+    """Get portfolio snapshot as of a date"""
     return db.query(models.PortfolioValueDaily).filter(
         and_(
             models.PortfolioValueDaily.portfolio_id == portfolio_id,
-            models.PortfolioValueDaily.snapshot_date == snapshot_date
+            models.PortfolioValueDaily.snapshot_date == valued_as_of(portfolio_id, snapshot_date)
         )
     ).all()
 
-def get_portfolio_summary(db: Session, portfolio_id: int, snapshot_date: date):
-    """Get aggregated portfolio summary"""
+def value_column(currency: str):
+    """portfolio_values_daily column holding values in a reporting currency"""
+    column = models.VALUE_COLUMNS.get(currency.upper())
+    if column is None:
+        raise ValueError(f"Unsupported currency {currency}; use one of {', '.join(models.VALUE_COLUMNS)}")
+    return getattr(models.PortfolioValueDaily, column)
+
+def get_portfolio_summary(db: Session, portfolio_id: int, snapshot_date: date, currency: str = 'HUF'):
+    """Get aggregated portfolio summary as of a date"""
     
     result = db.query(
         func.sum(models.PortfolioValueDaily.value_huf).label('total_value_huf'),
-        func.count(models.PortfolioValueDaily.id).label('instrument_count')
+        func.sum(value_column(currency)).label('total_value'),
+        func.count(models.PortfolioValueDaily.id).label('instrument_count'),
+        func.max(models.PortfolioValueDaily.snapshot_date).label('value_date')
     ).filter(
         and_(
             models.PortfolioValueDaily.portfolio_id == portfolio_id,
-            models.PortfolioValueDaily.snapshot_date == snapshot_date
+            models.PortfolioValueDaily.snapshot_date == valued_as_of(portfolio_id, snapshot_date)
         )
     ).first()
     
@@ -42,21 +63,62 @@ def add_transaction(
     created_by: Optional[str] = None
 ) -> models.Transaction:
     """Add a new transaction (BUY, SELL, ADJUST)"""
-    transaction = models.Transaction(
-        portfolio_id=portfolio_id,
-        instrument_id=instrument_id,
-        transaction_date=transaction_date,
-        transaction_type=transaction_type.upper(),
-        quantity=quantity,
-        price=price,
-        notes=notes,
-        created_by=created_by
-    )
-    db.add(transaction)
+    # INSERT ... RETURNING populates id/created_at without a follow-up SELECT
+    transaction = db.scalars(
+        insert(models.Transaction).values(
+            portfolio_id=portfolio_id,
+            instrument_id=instrument_id,
+            transaction_date=transaction_date,
+            transaction_type=transaction_type.upper(),
+            quantity=quantity,
+            price=price,
+            notes=notes,
+            created_by=created_by
+        ).returning(models.Transaction)
+    ).one()
+    # Maintained positions move in the same database transaction
+    positions.apply_transactions(db, [transaction])
+    mark_dirty(db, transaction_date, [instrument_id], portfolio_id, reason='transaction')
     db.commit()
-    db.refresh(transaction)
     return transaction
 
+def add_transactions(db: Session, transactions: List[dict]) -> List[models.Transaction]:
+    """Add many transactions in one INSERT and one position update pass
+
+    Each dict takes the same fields as add_transaction.
+    """
+    if not transactions:
+        return []
+    
+    rows = [
+        {
+            'portfolio_id': tx['portfolio_id'],
+            'instrument_id': tx['instrument_id'],
+            'transaction_date': tx['transaction_date'],
+            'transaction_type': tx['transaction_type'].upper(),
+            'quantity': tx['quantity'],
+            'price': tx.get('price'),
+            'notes': tx.get('notes'),
+            'created_by': tx.get('created_by'),
+            'created_at': datetime.utcnow()
+        }
+        for tx in transactions
+    ]
+    created = list(db.scalars(
+        insert(models.Transaction).returning(models.Transaction, sort_by_parameter_order=True),
+        rows
+    ).all())
+    positions.apply_transactions(db, created)
+    earliest = {}
+    for tx in created:
+        key = (tx.portfolio_id, tx.instrument_id)
+        if key not in earliest or tx.transaction_date < earliest[key]:
+            earliest[key] = tx.transaction_date
+    for (portfolio_id, instrument_id), from_date in earliest.items():
+        mark_dirty(db, from_date, [instrument_id], portfolio_id, reason='transaction')
+    db.commit()
+    return created
+
 def get_transactions(
     db: Session, 
     portfolio_id: int, 
@@ -88,36 +150,37 @@ def add_manual_price(
     created_by: Optional[str] = None
 ) -> models.ManualPrice:
     """Add or update manual price override"""
-    # Check if override already exists
-    existing = db.query(models.ManualPrice).filter(
-        and_(
-            models.ManualPrice.instrument_id == instrument_id,
-            models.ManualPrice.override_date == override_date
-        )
-    ).first()
-    
-    if existing:
-        existing.price = price
-        existing.currency = currency
-        existing.reason = reason
-        existing.created_by = created_by
-        existing.created_at = datetime.utcnow()
-        db.commit()
-        db.refresh(existing)
-        return existing
-    else:
-        manual_price = models.ManualPrice(
-            instrument_id=instrument_id,
-            override_date=override_date,
+    # Update an existing override in place; RETURNING tells us whether one existed
+    manual_price = db.scalars(
+        update(models.ManualPrice).where(
+            and_(
+                models.ManualPrice.instrument_id == instrument_id,
+                models.ManualPrice.override_date == override_date
+            )
+        ).values(
             price=price,
             currency=currency,
             reason=reason,
-            created_by=created_by
-        )
-        db.add(manual_price)
-        db.commit()
-        db.refresh(manual_price)
-        return manual_price
+            created_by=created_by,
+            created_at=datetime.utcnow()
+        ).returning(models.ManualPrice)
+    ).first()
+    
+    if manual_price is None:
+        manual_price = db.scalars(
+            insert(models.ManualPrice).values(
+                instrument_id=instrument_id,
+                override_date=override_date,
+                price=price,
+                currency=currency,
+                reason=reason,
+                created_by=created_by
+            ).returning(models.ManualPrice)
+        ).one()
+    
+    mark_dirty(db, override_date, [instrument_id], reason='manual_price')
+    db.commit()
+    return manual_price
 
 def get_manual_prices(
     db: Session,
@@ -134,6 +197,61 @@ def get_manual_prices(
     
     return query.order_by(desc(models.ManualPrice.override_date)).all()
 
+def get_quarantined_prices(db: Session, instrument_id: Optional[int] = None) -> List[models.PriceQuarantine]:
+    """Fetched prices held back by the price checks, newest first"""
+    query = db.query(models.PriceQuarantine)
+    
+    if instrument_id:
+        query = query.filter(models.PriceQuarantine.instrument_id == instrument_id)
+    
+    return query.order_by(desc(models.PriceQuarantine.price_date), desc(models.PriceQuarantine.id)).all()
+
+def release_quarantined_price(db: Session, quarantine_id: int) -> Optional[models.Price]:
+    """Accept a quarantined price after review: store it in prices and drop it
+    from the quarantine
+    
+    Stored like the price ETL stores a fetched price (replacing the price of
+    the same date and source), so later fetches are checked against it; this
+    is how a genuine move such as a split is let through. Prices quoted in
+    another currency than the instrument's are refused; enter those as a
+    manual price instead. Returns None if there is no such quarantined price.
+    """
+    held = db.get(models.PriceQuarantine, quarantine_id)
+    if held is None:
+        return None
+    instrument = db.get(models.Instrument, held.instrument_id)
+    if held.currency and held.currency != instrument.currency:
+        raise ValueError(f"Price was quoted in {held.currency}, instrument is {instrument.currency}")
+    
+    price = db.query(models.Price).filter(
+        models.Price.instrument_id == held.instrument_id,
+        models.Price.price_date == held.price_date,
+        models.Price.source == held.source
+    ).first()
+    if price is None:
+        price = models.Price(
+            instrument_id=held.instrument_id,
+            price_date=held.price_date,
+            currency=instrument.currency,
+            source=held.source
+        )
+        db.add(price)
+    price.price = held.price
+    price.retrieved_at = datetime.utcnow()
+    
+    db.delete(held)
+    mark_dirty(db, held.price_date, [held.instrument_id], reason='price')
+    db.commit()
+    return price
+
+def discard_quarantined_price(db: Session, quarantine_id: int) -> bool:
+    """Drop a quarantined price that was rightly held back"""
+    deleted = db.query(models.PriceQuarantine).filter(
+        models.PriceQuarantine.id == quarantine_id
+    ).delete(synchronize_session=False)
+    db.commit()
+    return deleted > 0
+
 def add_new_instrument(
     db: Session,
     isin: str,
@@ -152,17 +270,17 @@ def add_new_instrument(
     if existing:
         raise ValueError(f"Instrument with ISIN {isin} already exists")
     
-    instrument = models.Instrument(
-        isin=isin,
-        name=name,
-        currency=currency,
-        instrument_type=instrument_type,
-        ticker=ticker,
-        source=source
-    )
-    db.add(instrument)
+    instrument = db.scalars(
+        insert(models.Instrument).values(
+            isin=isin,
+            name=name,
+            currency=currency,
+            instrument_type=instrument_type,
+            ticker=ticker,
+            source=source
+        ).returning(models.Instrument)
+    ).one()
     db.commit()
-    db.refresh(instrument)
     return instrument
 
 def get_all_instruments(db: Session) -> List[models.Instrument]:
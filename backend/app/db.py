@@ -1,5 +1,6 @@
+from contextlib import contextmanager
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
 from .config import settings
 
 # Create engine with connection pooling (optimized for Supabase)
@@ -12,9 +13,32 @@ engine = create_engine(
     echo=False            # Set to True for SQL debugging
 )
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# expire_on_commit=False keeps attributes loaded by INSERT/UPDATE ... RETURNING
+# available after commit, so building API responses never triggers a reload
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 Base = declarative_base()
 
+def dialect_insert(db, table):
+    """INSERT construct supporting ON CONFLICT for the session's dialect"""
+    if db.get_bind().dialect.name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        from sqlalchemy.dialects.postgresql import insert
+    return insert(table)
+
+@contextmanager
+def committed_reader(db):
+    """Short-lived session on db's database, outside db's transaction
+
+    For process-wide caches: they must only ever hold committed rows, not
+    what the calling request has written and may still roll back.
+    """
+    reader = Session(bind=db.get_bind().engine, autoflush=False, expire_on_commit=False)
+    try:
+        yield reader
+    finally:
+        reader.close()
+
 def get_db():
     db = SessionLocal()
     try:
@@ -1,9 +1,14 @@
 from datetime import date, datetime
 from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import numpy as np
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
-from ..db import SessionLocal
-from ..models import Portfolio, Holding, Instrument, Price, FxRate, PortfolioValueDaily, ManualPrice
+from ..db import dialect_insert
+from ..models import Instrument, PortfolioValueDaily, VALUE_COLUMNS
+from ..positions import PositionSeries, load_position_series, positions_as_of
+from ..cost_basis import get_lot_state, lot_cost_in_huf
+from ..price_index import get_price_index
+from ..fx_curve import FxCurves, get_fx_curves
 
 def get_latest_price(instrument_id: int, price_date: date, db: Session) -> Decimal:
     """Get latest price for instrument on or before date
@@ -13,133 +18,166 @@ def get_latest_price(instrument_id: int, price_date: date, db: Session) -> Decim
     2. Non-test automatic prices (real data from APIs)
     3. Manual price overrides (as fallback if no automatic prices exist)
     4. Test data (last resort fallback)
+    
+    Served from the in-memory price index (see price_index.py).
     """
-    # Get the most recent manual price
-    manual_price = db.query(ManualPrice).filter(
-        and_(
-            ManualPrice.instrument_id == instrument_id,
-            ManualPrice.override_date <= price_date
-        )
-    ).order_by(ManualPrice.override_date.desc()).first()
+    hit = get_price_index(db).latest(instrument_id, price_date)
+    return hit.price if hit else None
+
+def get_fx_rate(currency: str, target_currency: str, rate_date: date, db: Session) -> Decimal:
+    """Get FX rate for date (from the shared FX curves, see fx_curve.py)"""
+    return get_fx_curves(db).rate(currency, target_currency, rate_date)
+
+def load_latest_prices(db: Session, instrument_ids, price_date: date) -> Dict[int, Decimal]:
+    """get_latest_price for many instruments, same precedence"""
+    hits = get_price_index(db).latest_many(instrument_ids, price_date)
+    return {instrument_id: hit.price for instrument_id, hit in hits.items()}
+
+def load_fx_rates(db: Session, currency_dates: Iterable[Tuple[str, date]], target_currency: str = 'HUF') -> Dict[Tuple[str, date], Decimal]:
+    """get_fx_rate for many (currency, date) pairs"""
+    fx = get_fx_curves(db)
+    return {(currency, day): fx.rate(currency, target_currency, day) for currency, day in set(currency_dates)}
+
+def reporting_values(fx: FxCurves, value_huf: np.ndarray, days: np.ndarray) -> Dict[str, np.ndarray]:
+    """value_huf in every other reporting currency at each day's rate,
+    keyed by column; None where the rate is unknown"""
+    converted = {}
+    for currency, column in VALUE_COLUMNS.items():
+        if currency == 'HUF':
+            continue
+        rates = fx.rates_on('HUF', currency, days)
+        known = (rates != None) & (value_huf != None)
+        values = np.full(len(value_huf), None, dtype=object)
+        values[known] = value_huf[known] * rates[known]
+        converted[column] = values
+    return converted
+
+def upsert_portfolio_values(db: Session, rows: List[dict], chunk_size: int = 1000):
+    """Insert or update portfolio_values_daily rows
     
-    # Get the most recent automatic price (non-test)
-    auto_price = db.query(Price).filter(
-        and_(
-            Price.instrument_id == instrument_id,
-            Price.price_date <= price_date,
-            Price.source != 'test'
-        )
-    ).order_by(Price.price_date.desc()).first()
+    One compiled statement executed for all rows of a chunk (the driver
+    batches them into multi-row VALUES).
+    """
+    if not rows:
+        return
+    stmt = dialect_insert(db, PortfolioValueDaily.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['portfolio_id', 'snapshot_date', 'instrument_id'],
+        set_={
+            column: stmt.excluded[column]
+            for column in rows[0]
+            if column not in ('portfolio_id', 'snapshot_date', 'instrument_id')
+        }
+    )
+    for i in range(0, len(rows), chunk_size):
+        db.execute(stmt, rows[i:i + chunk_size])
+
+def calculate_portfolio_values(
+    portfolio_id: int,
+    snapshot_date: date,
+    db: Session,
+    position_series: Optional[Dict[int, PositionSeries]] = None,
+    instrument_ids: Optional[Set[int]] = None
+):
+    """Calculate and store portfolio values for a date
+
+    Quantities come from the maintained position steps as of snapshot_date, so past
+    dates are valued with the positions actually held then. Pass
+    position_series to reuse an already built ledger across many dates.
     
-    # Determine which to use based on recency
-    # If automatic price is more recent than manual, use automatic
-    # This allows automatic updates to override old manual entries
-    if auto_price and manual_price:
-        if auto_price.price_date >= manual_price.override_date:
-            return auto_price.price
-        else:
-            return manual_price.price
-    elif auto_price:
-        return auto_price.price
-    elif manual_price:
-        return manual_price.price
+    With instrument_ids, only those instruments are recalculated, and stored
+    rows for ones among them no longer held on that date are removed.
     
-    # Last resort: Fall back to test data
-    test_price = db.query(Price).filter(
-        and_(
-            Price.instrument_id == instrument_id,
-            Price.price_date <= price_date
-        )
-    ).order_by(Price.price_date.desc()).first()
+    Prices and FX rates are loaded for all holdings at once and every row is
+    written with a single upsert, so the query count does not grow with the
+    number of holdings.
+    """
+    if position_series is None:
+        position_series = load_position_series(db, portfolio_id)
+    positions = positions_as_of(position_series, snapshot_date)
     
-    return test_price.price if test_price else None
-
-def get_fx_rate(currency: str, target_currency: str, rate_date: date, db: Session) -> Decimal:
-    """Get FX rate for date"""
-    if currency == target_currency:
-        return Decimal('1.0')
+    if instrument_ids is not None:
+        positions = {k: v for k, v in positions.items() if k in instrument_ids}
+        closed = [i for i in instrument_ids if i in position_series and i not in positions]
+        if closed:
+            db.query(PortfolioValueDaily).filter(
+                PortfolioValueDaily.portfolio_id == portfolio_id,
+                PortfolioValueDaily.snapshot_date == snapshot_date,
+                PortfolioValueDaily.instrument_id.in_(closed)
+            ).delete(synchronize_session=False)
     
-    fx = db.query(FxRate).filter(
-        and_(
-            FxRate.base_currency == currency,
-            FxRate.target_currency == target_currency,
-            FxRate.rate_date <= rate_date
-        )
-    ).order_by(FxRate.rate_date.desc()).first()
+    instruments = db.query(Instrument.id, Instrument.name, Instrument.currency).filter(
+        Instrument.id.in_(list(positions))
+    ).all() if positions else []
     
-    return fx.rate if fx else None
-
-def calculate_portfolio_values(portfolio_id: int, snapshot_date: date, db: Session):
-    """Calculate and store portfolio values for a date"""
-    holdings = db.query(Holding).filter(
-        Holding.portfolio_id == portfolio_id
-    ).all()
+    # Open lots as of the snapshot date, for cost basis and unrealized P&L
+    lots = get_lot_state(db, portfolio_id, snapshot_date)
+    
+    prices = load_latest_prices(db, positions, snapshot_date)
+    currency_dates = {(i.currency, snapshot_date) for i in instruments}
+    currency_dates |= {
+        (i.currency, date.fromisoformat(lot['date']))
+        for i in instruments if lots.get(i.id)
+        for lot in lots[i.id]['lots']
+    }
+    fx_rates = load_fx_rates(db, currency_dates)
+    fx_cache = {(currency, day.isoformat()): rate for (currency, day), rate in fx_rates.items()}
     
-    calculated = 0
-    for holding in holdings:
-        instrument = holding.instrument
-        
-        # Get price
-        price = get_latest_price(instrument.id, snapshot_date, db)
-        if not price:
+    valued = []
+    for instrument in instruments:
+        if not prices.get(instrument.id):
             print(f"⚠ No price for {instrument.name}")
-            continue
-        
-        # Get FX rate
-        fx_rate = get_fx_rate(instrument.currency, 'HUF', snapshot_date, db)
-        if not fx_rate:
+        elif not fx_rates[(instrument.currency, snapshot_date)]:
             print(f"⚠ No FX rate for {instrument.currency}")
-            continue
-        
-        # Calculate value
-        value_huf = Decimal(holding.quantity) * price * fx_rate
-        
-        # Check if record already exists
-        existing = db.query(PortfolioValueDaily).filter(
-            PortfolioValueDaily.portfolio_id == portfolio_id,
-            PortfolioValueDaily.snapshot_date == snapshot_date,
-            PortfolioValueDaily.instrument_id == instrument.id
-        ).first()
-        
-        if existing:
-            # Update existing record
-            existing.quantity = holding.quantity
-            existing.price = price
-            existing.fx_rate = fx_rate
-            existing.value_huf = value_huf
-            existing.calculated_at = datetime.now()
         else:
-            # Create new record
-            value_record = PortfolioValueDaily(
-                portfolio_id=portfolio_id,
-                snapshot_date=snapshot_date,
-                instrument_id=instrument.id,
-                quantity=holding.quantity,
-                price=price,
-                instrument_currency=instrument.currency,
-                fx_rate=fx_rate,
-                value_huf=value_huf
-            )
-            db.add(value_record)
-        
-        calculated += 1
+            valued.append(instrument)
+    
+    # Exact Decimal arithmetic, element-wise over all holdings at once
+    quantity = np.array([positions[i.id] for i in valued], dtype=object)
+    price = np.array([prices[i.id] for i in valued], dtype=object)
+    fx_rate = np.array([fx_rates[(i.currency, snapshot_date)] for i in valued], dtype=object)
+    value_huf = quantity * price * fx_rate
+    converted = reporting_values(
+        get_fx_curves(db), value_huf, np.full(len(valued), np.datetime64(snapshot_date, 'D'))
+    )
+    
+    calculated_at = datetime.now()
+    rows = []
+    for k, instrument in enumerate(valued):
+        cost_basis_huf = lot_cost_in_huf(db, lots.get(instrument.id), instrument.currency, fx_rate[k], fx_cache)
+        rows.append({
+            'portfolio_id': portfolio_id,
+            'snapshot_date': snapshot_date,
+            'instrument_id': instrument.id,
+            'quantity': quantity[k],
+            'price': price[k],
+            'instrument_currency': instrument.currency,
+            'fx_rate': fx_rate[k],
+            'value_huf': value_huf[k],
+            **{column: values[k] for column, values in converted.items()},
+            'cost_basis_huf': cost_basis_huf,
+            'unrealized_gain_huf': value_huf[k] - cost_basis_huf if cost_basis_huf is not None else None,
+            'calculated_at': calculated_at
+        })
     
+    if rows:
+        upsert_portfolio_values(db, rows)
     db.commit()
-    print(f"✓ Calculated values for {calculated} holdings")
+    print(f"✓ Calculated values for {len(rows)} holdings")
 
-def run_calculate_values():
-    """Calculate values for all portfolios"""
-    db = SessionLocal()
-    try:
-        today = date.today()
-        portfolios = db.query(Portfolio).all()
-        
-        for portfolio in portfolios:
-            print(f"\nCalculating values for '{portfolio.name}'...")
-            calculate_portfolio_values(portfolio.id, today, db)
-            
-    finally:
-        db.close()
+def rebuild_portfolio_values(portfolio_id: int, start_date: date, end_date: date, db: Session):
+    """Recalculate stored values for every date in a range (see recalculate.py)"""
+    from .recalculate import recalculate
+    return recalculate(portfolio_id, start_date, end_date, db)
+
+def run_calculate_values(workers: Optional[int] = None):
+    """Calculate today's values for all portfolios, one worker process per portfolio
+
+    Nothing is stored on days when none of a portfolio's markets is open.
+    """
+    from .parallel_values import run_parallel_values
+    today = date.today()
+    run_parallel_values(today, today, workers=workers)
 
 if __name__ == "__main__":
     run_calculate_values()
@@ -5,6 +5,8 @@ from decimal import Decimal
 from sqlalchemy.orm import Session
 from ..db import SessionLocal
 from ..models import FxRate
+from ..revaluation import mark_currency_dirty
+from ..trading_calendar import is_trading_day
 
 def fetch_mnb_rates(target_date: date = None) -> tuple[dict, str]:
     """
@@ -89,6 +91,8 @@ def store_fx_rates(rates: dict, rate_date: date, source: str, db: Session):
         
         if existing:
             # Update existing record
+            if existing.rate != rate:
+                mark_currency_dirty(db, currency, rate_date, reason='fx_rate')
             existing.rate = rate
             existing.retrieved_at = datetime.now()
         else:
@@ -101,6 +105,7 @@ def store_fx_rates(rates: dict, rate_date: date, source: str, db: Session):
                 source=source
             )
             db.add(fx_rate)
+            mark_currency_dirty(db, currency, rate_date, reason='fx_rate')
     
     db.commit()
 
@@ -109,6 +114,11 @@ def run_fx_fetch():
     db = SessionLocal()
     try:
         today = date.today()
+        if not is_trading_day(today, 'BET'):
+            # MNB does not fix rates on Hungarian non-business days
+            print(f"→ {today} is not a business day, FX rates stay as of the last one")
+            return
+        
         rates, source = fetch_mnb_rates(today)
         
         if rates:
@@ -1,15 +1,20 @@
 from datetime import date, datetime
 from decimal import Decimal
 from sqlalchemy.orm import Session
-from ..db import SessionLocal
-from ..models import Instrument, Price
+from ..db import SessionLocal, dialect_insert
+from ..models import Instrument, Price, PriceQuarantine
+from ..revaluation import mark_dirty
+from ..price_index import get_price_index
+from ..price_checks import PriceCandidate, check_prices
+from ..price_staleness import refresh_price_staleness
+from ..trading_calendar import calendar_for_currency, is_trading_day
 import requests
 from bs4 import BeautifulSoup
 import re
 from .fetch_erste_market import fetch_erste_market_price
 
-def fetch_price_bse(isin: str, ticker: str, price_date: date) -> tuple[Decimal, str]:
-    """Fetch price from Budapest Stock Exchange (BÉT)"""
+def fetch_price_bse(isin: str, ticker: str, price_date: date) -> tuple[Decimal, str, str]:
+    """Fetch price from Budapest Stock Exchange (BÉT): (price, source, quoted currency or None)"""
     try:
         # Try Yahoo Finance with .BD suffix (Budapest)
         if ticker:
@@ -25,7 +30,7 @@ def fetch_price_bse(isin: str, ticker: str, price_date: date) -> tuple[Decimal,
                     result = data['chart']['result'][0]
                     if 'meta' in result and 'regularMarketPrice' in result['meta']:
                         price = result['meta']['regularMarketPrice']
-                        return Decimal(str(price)), 'Yahoo Finance'
+                        return Decimal(str(price)), 'Yahoo Finance', result['meta'].get('currency')
         
         # Fallback: Try alternative Yahoo Finance endpoint
         if ticker:
@@ -38,22 +43,22 @@ def fetch_price_bse(isin: str, ticker: str, price_date: date) -> tuple[Decimal,
                 # Look for price in the main price display
                 price_elem = soup.find('fin-streamer', {'data-symbol': f'{ticker}.BD', 'data-field': 'regularMarketPrice'})
                 if price_elem and price_elem.get('value'):
-                    return Decimal(price_elem['value']), 'Yahoo Finance Web'
+                    return Decimal(price_elem['value']), 'Yahoo Finance Web', None
                 
                 # Alternative: look for price in specific classes
                 price_elem = soup.find('span', {'class': re.compile(r'Fw\(b\)|livePrice')})
                 if price_elem:
                     price_text = price_elem.text.strip().replace(',', '')
                     if re.match(r'^\d+\.?\d*$', price_text):
-                        return Decimal(price_text), 'Yahoo Finance Web'
+                        return Decimal(price_text), 'Yahoo Finance Web', None
         
-        return None, None
+        return None, None, None
         
     except Exception as e:
         print(f"Error fetching BSE price for {isin} / {ticker}: {e}")
-        return None, None
+        return None, None, None
 
-def fetch_price_fund(isin: str, name: str, price_date: date) -> tuple[Decimal, str]:
+def fetch_price_fund(isin: str, name: str, price_date: date) -> tuple[Decimal, str, str]:
     """Fetch price for Hungarian funds
     
     First tries Erste Market web scraping, then falls back to last known price.
@@ -63,16 +68,16 @@ def fetch_price_fund(isin: str, name: str, price_date: date) -> tuple[Decimal, s
         # Try Erste Market website scraping
         price, currency, date_str = fetch_erste_market_price(isin)
         if price:
-            return Decimal(str(price)), 'Erste Market'
+            return Decimal(str(price)), 'Erste Market', currency
         
         # For funds without Erste Market listing, return None to use last known price
-        return None, None
+        return None, None, None
         
     except Exception as e:
         print(f"Error fetching fund price for {name}: {e}")
-        return None, None
+        return None, None, None
 
-def fetch_price_bond(isin: str, name: str, price_date: date, instrument_currency: str) -> tuple[Decimal, str]:
+def fetch_price_bond(isin: str, name: str, price_date: date, instrument_currency: str) -> tuple[Decimal, str, str]:
     """Fetch price for bonds
     
     First tries Erste Market web scraping, then uses fixed values for government bonds.
@@ -80,29 +85,23 @@ def fetch_price_bond(isin: str, name: str, price_date: date, instrument_currency
     try:
         # Special case: Hungarian government bond with fixed par value
         if isin == 'HU0000403522':  # 2028/O BÓNUSZ MAGYAR ÁLLAMPAPÍR
-            return Decimal('1.0'), 'Fixed Par Value'
+            return Decimal('1.0'), 'Fixed Par Value', None
         
         # Try Erste Market website scraping for other bonds
         price, currency, date_str = fetch_erste_market_price(isin)
         if price:
-            return Decimal(str(price)), 'Erste Market'
+            return Decimal(str(price)), 'Erste Market', currency
         
         # For bonds without pricing, return None to use last known price
-        return None, None
+        return None, None, None
         
     except Exception as e:
         print(f"Error fetching bond price for {name}: {e}")
-        return None, None
+        return None, None, None
 
-def fetch_and_store_price(instrument: Instrument, price_date: date, db: Session):
-    """Fetch and store price for a single instrument
-    
-    If unable to fetch new price, keeps the most recent price from database.
-    This is common for funds (daily update after close) and bonds (infrequent trading).
-    """
-    price = None
-    source = None
-    
+def fetch_price(instrument: Instrument, price_date: date) -> tuple[Decimal, str, str]:
+    """Fetch a price for a single instrument: (price, source, quoted currency),
+    all None if no source had one"""
     if instrument.instrument_type == 'equity':
         # Try to get ticker from instrument, or use common tickers for Hungarian stocks
         ticker_map = {
@@ -111,15 +110,24 @@ def fetch_and_store_price(instrument: Instrument, price_date: date, db: Session)
             'HU0000061726': 'OTP'         # OTP
         }
         ticker = instrument.ticker or ticker_map.get(instrument.isin)
-        price, source = fetch_price_bse(instrument.isin, ticker, price_date)
+        return fetch_price_bse(instrument.isin, ticker, price_date)
         
     elif instrument.instrument_type == 'fund':
-        price, source = fetch_price_fund(instrument.isin, instrument.name, price_date)
+        return fetch_price_fund(instrument.isin, instrument.name, price_date)
         
     elif instrument.instrument_type == 'bond':
         # Use new bond fetcher with Erste Market + fixed values
-        price, source = fetch_price_bond(instrument.isin, instrument.name, price_date, instrument.currency)
+        return fetch_price_bond(instrument.isin, instrument.name, price_date, instrument.currency)
     
+    return None, None, None
+
+def store_price(instrument: Instrument, price_date: date, price: Decimal, source: str, db: Session):
+    """Store a fetched price, or report the carried-forward one if there is none
+    
+    If no new price was fetched, nothing is written and the most recent
+    price keeps being used as of later dates. This is common for funds (daily
+    update after close) and bonds (infrequent trading).
+    """
     if price:
         # Check if this price already exists
         existing = db.query(Price).filter(
@@ -133,6 +141,7 @@ def fetch_and_store_price(instrument: Instrument, price_date: date, db: Session)
             if existing.price != price:
                 existing.price = price
                 existing.retrieved_at = datetime.now()
+                mark_dirty(db, price_date, [instrument.id], reason='price')
                 db.commit()
                 return True, 'updated'
             else:
@@ -147,66 +156,110 @@ def fetch_and_store_price(instrument: Instrument, price_date: date, db: Session)
                 source=source
             )
             db.add(price_record)
+            mark_dirty(db, price_date, [instrument.id], reason='price')
             db.commit()
             return True, 'fetched'
     else:
-        # Check if we have a recent price in database
-        last_price = db.query(Price)\
-            .filter(Price.instrument_id == instrument.id)\
-            .order_by(Price.price_date.desc())\
-            .first()
-        
+        # Nothing new: valuation carries the latest stored price forward
+        # through the as-of lookup, so no copy is written
+        last_price = get_price_index(db).latest(instrument.id, price_date)
         if last_price:
-            # Use the most recent price we have
-            if last_price.price_date < price_date:
-                # Copy forward the last price to today
-                price_record = Price(
-                    instrument_id=instrument.id,
-                    price_date=price_date,
-                    price=last_price.price,
-                    currency=instrument.currency,
-                    source=f"{last_price.source} (carried forward)"
-                )
-                db.merge(price_record)
-                db.commit()
-                return True, 'carried_forward'
-            else:
-                return True, 'exists'
+            return True, 'carried_forward' if last_price.price_date < price_date else 'exists'
         
         return False, 'no_data'
 
+def quarantine_price(instrument: Instrument, price_date: date, price: Decimal, source: str,
+                     currency: str, reason: str, db: Session):
+    """Hold back a price that failed the checks; the last good price carries forward
+
+    A price already held back (the same day refetched) is not queued again.
+    """
+    db.execute(dialect_insert(db, PriceQuarantine.__table__).values(
+        instrument_id=instrument.id,
+        price_date=price_date,
+        price=price,
+        currency=currency,
+        source=source,
+        reason=reason,
+        detected_at=datetime.utcnow()
+    ).on_conflict_do_nothing(index_elements=['instrument_id', 'price_date', 'source', 'price']))
+    db.commit()
+    return True, 'quarantined'
+
+def store_checked_prices(fetched: list, price_date: date, db: Session) -> list:
+    """Check a batch of (instrument, price, source, currency) in one pass, then
+    store the ones that pass and quarantine the rest; returns (success, status)
+    per entry"""
+    reasons = iter(check_prices(db, [
+        PriceCandidate(instrument.id, price_date, price, currency, instrument.currency)
+        for instrument, price, source, currency in fetched if price
+    ]))
+    
+    results = []
+    for instrument, price, source, currency in fetched:
+        reason = next(reasons) if price else None
+        if reason:
+            print(f"⚠ Quarantined {price} for {instrument.name} from {source}: {reason}")
+            results.append(quarantine_price(instrument, price_date, price, source, currency, reason, db))
+        else:
+            results.append(store_price(instrument, price_date, price, source, db))
+    return results
+
+def fetch_and_store_price(instrument: Instrument, price_date: date, db: Session):
+    """Fetch, check and store the price of a single instrument"""
+    price, source, currency = fetch_price(instrument, price_date)
+    return store_checked_prices([(instrument, price, source, currency)], price_date, db)[0]
+
 def run_price_fetch():
-    """Fetch prices for all instruments"""
+    """Fetch prices for all instruments
+    
+    All prices are fetched first and checked as one batch before anything
+    is written.
+    """
     db = SessionLocal()
     try:
         today = date.today()
         instruments = db.query(Instrument).all()
         
+        fetched_prices = []
+        closed = 0
+        for instrument in instruments:
+            # No new price on market holidays; the last one is used as of today
+            if not is_trading_day(today, calendar_for_currency(instrument.currency)):
+                closed += 1
+                continue
+            fetched_prices.append((instrument, *fetch_price(instrument, today)))
+        
         fetched = 0
         carried_forward = 0
         exists = 0
         failed = 0
+        quarantined = 0
         
-        for instrument in instruments:
-            success, status = fetch_and_store_price(instrument, today, db)
-            
+        for (instrument, *_), (success, status) in zip(fetched_prices, store_checked_prices(fetched_prices, today, db)):
             if success:
-                if status == 'fetched':
+                if status in ('fetched', 'updated'):
                     print(f"✓ Fetched new price for {instrument.name}")
                     fetched += 1
                 elif status == 'carried_forward':
-                    print(f"→ Carried forward price for {instrument.name}")
+                    print(f"→ No new price for {instrument.name}, last price carries forward")
                     carried_forward += 1
                 elif status == 'exists':
                     print(f"✓ Price already exists for {instrument.name}")
                     exists += 1
+                elif status == 'quarantined':
+                    quarantined += 1
             else:
                 print(f"✗ No price available for {instrument.name}")
                 failed += 1
         
-        print(f"\nSummary: {fetched} fetched, {carried_forward} carried forward, {exists} already exist, {failed} failed")
+        print(f"\nSummary: {fetched} fetched, {carried_forward} carried forward, {exists} already exist, "
+              f"{quarantined} quarantined, {failed} failed, {closed} market closed")
         print(f"Total: {fetched + carried_forward + exists}/{len(instruments)} instruments have prices for {today}")
-        
+
+        # Also on market holidays, so the carried-forward counts stay current
+        refresh_price_staleness(db, today)
+
     finally:
         db.close()
 
@@ -0,0 +1,132 @@
+"""
+Value many portfolios (and long date ranges) on a process pool
+
+The work is split into one task per portfolio and date chunk. Each task runs
+recalculate.grid_rows in a worker process with its own database session;
+the price index and FX curves are loaded once here and handed to every
+worker, so workers only query positions, instruments and lots. Results come
+back as rows and are written by this process with one bulk upsert and a
+single commit.
+
+    python -m backend.app.etl.parallel_values <start_date> [end_date] [--portfolio ID ...] [--workers N] [--all-days]
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from functools import partial
+from typing import Iterable, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from ..config import settings
+from ..db import SessionLocal, engine
+from ..models import Portfolio
+from ..price_index import PriceIndex, get_price_index, install_price_index
+from ..fx_curve import FxCurves, get_fx_curves, install_fx_curves
+from .calculate_values import upsert_portfolio_values
+from .recalculate import delete_stale_values, grid_rows
+
+# Days per task for range backfills
+CHUNK_DAYS = 366
+
+# Fewer tasks than this run in-process: starting worker processes (spawned,
+# not forked, on Windows) costs more than the daily run saves
+MIN_POOL_TASKS = 8
+
+Task = Tuple[int, date, date]
+
+
+def plan_tasks(portfolio_ids: Iterable[int], start_date: date, end_date: date, chunk_days: int = CHUNK_DAYS) -> List[Task]:
+    """(portfolio_id, chunk start, chunk end) covering the range for every portfolio"""
+    if end_date < start_date:
+        raise ValueError("end_date must not be before start_date")
+    tasks = []
+    for portfolio_id in portfolio_ids:
+        chunk_start = start_date
+        while chunk_start <= end_date:
+            chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+            tasks.append((portfolio_id, chunk_start, chunk_end))
+            chunk_start = chunk_end + timedelta(days=1)
+    return tasks
+
+
+def _init_worker(index: PriceIndex, curves: FxCurves):
+    # Connections inherited from a forked parent must not be reused here
+    engine.dispose(close=False)
+    install_price_index(index)
+    install_fx_curves(curves)
+
+
+def _run_task(task: Task, trading_days_only: bool = False):
+    db = SessionLocal()
+    try:
+        return grid_rows(*task, db, trading_days_only)
+    finally:
+        db.close()
+
+
+def value_portfolios(
+    db: Session,
+    portfolio_ids: Iterable[int],
+    start_date: date,
+    end_date: date,
+    workers: Optional[int] = None,
+    chunk_days: int = CHUNK_DAYS,
+    trading_days_only: bool = False
+) -> int:
+    """Recalculate stored values of several portfolios over a date range
+
+    One-day runs, small batches (under MIN_POOL_TASKS tasks) and runs with
+    one worker stay in this process. Stored rows of instruments without a
+    position series (imported history) are kept. trading_days_only skips
+    closed days as in recalculate.grid_rows. Returns the number of rows
+    written.
+    """
+    tasks = plan_tasks(portfolio_ids, start_date, end_date, chunk_days)
+    workers = min(workers or settings.etl_workers, len(tasks))
+
+    # Loaded (or refreshed) once, then shared by every task
+    index, curves = get_price_index(db), get_fx_curves(db)
+
+    if workers <= 1 or start_date == end_date or len(tasks) < MIN_POOL_TASKS:
+        workers = 1
+        results = [grid_rows(*task, db, trading_days_only) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(index, curves)) as pool:
+            results = list(pool.map(partial(_run_task, trading_days_only=trading_days_only), tasks))
+
+    rows = [row for task_rows, _ in results for row in task_rows]
+    stale = [row_id for _, task_stale in results for row_id in task_stale]
+    delete_stale_values(db, stale)
+    upsert_portfolio_values(db, rows)
+    db.commit()
+
+    print(f"✓ Valued {len(tasks)} portfolio/date chunks on {workers} worker(s): "
+          f"{len(rows)} rows written, {len(stale)} stale rows removed")
+    return len(rows)
+
+
+def run_parallel_values(
+    start_date: date,
+    end_date: date,
+    portfolio_ids: Optional[List[int]] = None,
+    workers: Optional[int] = None,
+    trading_days_only: bool = True
+):
+    """Value the given portfolios, or all of them, over a date range"""
+    db = SessionLocal()
+    try:
+        if not portfolio_ids:
+            portfolio_ids = [portfolio_id for portfolio_id, in db.query(Portfolio.id).order_by(Portfolio.id)]
+        value_portfolios(db, portfolio_ids, start_date, end_date, workers, trading_days_only=trading_days_only)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('start_date', type=date.fromisoformat)
+    parser.add_argument('end_date', type=date.fromisoformat, nargs='?')
+    parser.add_argument('--portfolio', type=int, action='append', dest='portfolio_ids')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--all-days', action='store_true', help="also store values on market holidays and weekends")
+    args = parser.parse_args()
+    run_parallel_values(args.start_date, args.end_date or args.start_date, args.portfolio_ids, args.workers, not args.all_days)
@@ -0,0 +1,117 @@
+"""
+Recalculate stored portfolio values made stale by back-dated writes
+
+Coalesces revaluation_queue into one from_date per (portfolio, instrument)
+and recalculates only the already stored snapshot dates on or after it.
+Runs of consecutive stored dates with the same dirty instruments are
+valued together on the recalculate.py grid.
+"""
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+from ..db import SessionLocal
+from ..models import Portfolio, PortfolioValueDaily, RevaluationQueue
+from .calculate_values import upsert_portfolio_values
+from .recalculate import delete_stale_values, grid_rows
+
+ALL = None
+
+
+def coalesce_queue(db: Session, max_id: int) -> Dict[int, Dict[Optional[int], date]]:
+    """Earliest dirty date per portfolio and instrument (ALL = every instrument)"""
+    entries = db.query(
+        RevaluationQueue.portfolio_id,
+        RevaluationQueue.instrument_id,
+        func.min(RevaluationQueue.from_date)
+    ).filter(
+        RevaluationQueue.id <= max_id
+    ).group_by(
+        RevaluationQueue.portfolio_id, RevaluationQueue.instrument_id
+    ).all()
+
+    portfolio_ids = [p.id for p in db.query(Portfolio.id)]
+    ranges: Dict[int, Dict[Optional[int], date]] = defaultdict(dict)
+    for portfolio_id, instrument_id, from_date in entries:
+        for pid in ([portfolio_id] if portfolio_id is not None else portfolio_ids):
+            current = ranges[pid].get(instrument_id)
+            if current is None or from_date < current:
+                ranges[pid][instrument_id] = from_date
+    return ranges
+
+
+def _scope(dirty: Dict[Optional[int], date], snapshot_date: date) -> Optional[Set[int]]:
+    """Instruments stale on a date; None when all of them are"""
+    everything_from = dirty.get(ALL)
+    if everything_from is not None and snapshot_date >= everything_from:
+        return None
+    return {
+        instrument_id for instrument_id, from_date in dirty.items()
+        if instrument_id is not ALL and from_date <= snapshot_date
+    }
+
+
+def dirty_runs(dirty: Dict[Optional[int], date], snapshot_dates: List[date]) -> List[Tuple[date, date, Optional[Set[int]]]]:
+    """Consecutive stored dates with the same stale instruments, as (start, end, scope)"""
+    runs = []
+    for snapshot_date in snapshot_dates:
+        scope = _scope(dirty, snapshot_date)
+        if scope is not None and not scope:
+            continue
+        if runs and runs[-1][1] + timedelta(days=1) == snapshot_date and runs[-1][2] == scope:
+            runs[-1] = (runs[-1][0], snapshot_date, scope)
+        else:
+            runs.append((snapshot_date, snapshot_date, scope))
+    return runs
+
+
+def revalue_portfolio(db: Session, portfolio_id: int, dirty: Dict[Optional[int], date]) -> int:
+    """Recalculate the dirty ranges of one portfolio; returns rows written"""
+    start = min(dirty.values())
+    snapshot_dates = [
+        row.snapshot_date for row in db.query(PortfolioValueDaily.snapshot_date).filter(
+            PortfolioValueDaily.portfolio_id == portfolio_id,
+            PortfolioValueDaily.snapshot_date >= start
+        ).distinct().order_by(PortfolioValueDaily.snapshot_date)
+    ]
+
+    written = 0
+    for run_start, run_end, scope in dirty_runs(dirty, snapshot_dates):
+        rows, stale = grid_rows(portfolio_id, run_start, run_end, db, instrument_ids=scope)
+        delete_stale_values(db, stale)
+        upsert_portfolio_values(db, rows)
+        db.commit()
+        written += len(rows)
+    return written
+
+
+def process_revaluation_queue(db: Session) -> int:
+    """Drain the queue; entries added while this runs are left for next time"""
+    max_id = db.query(func.max(RevaluationQueue.id)).scalar()
+    if max_id is None:
+        print("✓ No stale values to recalculate")
+        return 0
+
+    ranges = coalesce_queue(db, max_id)
+    recalculated = 0
+    for portfolio_id, dirty in ranges.items():
+        recalculated += revalue_portfolio(db, portfolio_id, dirty)
+
+    db.query(RevaluationQueue).filter(RevaluationQueue.id <= max_id).delete(synchronize_session=False)
+    db.commit()
+    print(f"✓ Recalculated {recalculated} stale values across {len(ranges)} portfolios")
+    return recalculated
+
+
+def run_revaluation_queue():
+    """Process pending revaluations"""
+    db = SessionLocal()
+    try:
+        process_revaluation_queue(db)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    run_revaluation_queue()
@@ -0,0 +1,271 @@
+"""
+Recalculate stored portfolio values for a date range
+
+Builds the date × instrument grid of a portfolio and resolves quantities,
+prices, FX rates and cost basis for every cell with sorted as-of lookups
+over arrays loaded once, instead of valuing the range date by date. Price
+and FX curves come from the shared in-process caches (price_index.py,
+fx_curve.py); prices follow the same precedence as get_latest_price, and
+values are also converted into USD and EUR at each day's rate. Rows are
+upserted in chunks, and stored rows in the range for positions that were
+not held are removed; rows of instruments without positions (imported
+history) are left alone. Backfills from the command line skip days on
+which no held instrument's market is open (see trading_calendar.py).
+
+    python -m backend.app.etl.recalculate <portfolio_id> <start_date> <end_date> [--all-days]
+"""
+import argparse
+from datetime import date, datetime
+from decimal import Decimal
+from typing import List, Optional, Set, Tuple
+import numpy as np
+from sqlalchemy.orm import Session
+from ..db import SessionLocal
+from ..models import Instrument, PortfolioValueDaily
+from ..positions import load_position_series
+from ..cost_basis import cumulative_sold, load_ledger_arrays
+from ..price_index import get_price_index
+from ..fx_curve import FxCurves, get_fx_curves
+from ..trading_calendar import calendar_for_currency, open_days
+from .calculate_values import reporting_values, upsert_portfolio_values
+
+# (sorted datetime64[D] dates, Decimal values)
+Curve = Tuple[np.ndarray, np.ndarray]
+
+
+def _as_of(curve: Optional[Curve], days: np.ndarray):
+    """Latest value on or before each day: (values, their dates, found mask)"""
+    if curve is None:
+        return (
+            np.full(len(days), None, dtype=object),
+            np.full(len(days), np.datetime64('NaT'), dtype='datetime64[D]'),
+            np.zeros(len(days), dtype=bool)
+        )
+    curve_days, curve_values = curve
+    idx = np.searchsorted(curve_days, days, side='right') - 1
+    found = idx >= 0
+    safe = np.where(found, idx, 0)
+    values = np.where(found, curve_values[safe], None)
+    value_days = np.where(found, curve_days[safe], np.datetime64('NaT'))
+    return values, value_days, found
+
+
+def resolve_prices(auto: Optional[Curve], manual: Optional[Curve], test: Optional[Curve], days: np.ndarray) -> np.ndarray:
+    """get_latest_price for every day: the more recent of manual and automatic
+    (automatic wins ties), then test data; None where there is no price"""
+    auto_values, auto_days, has_auto = _as_of(auto, days)
+    manual_values, manual_days, has_manual = _as_of(manual, days)
+    test_values, _, _ = _as_of(test, days)
+
+    use_manual = has_manual & (~has_auto | (manual_days > auto_days))
+    return np.where(use_manual, manual_values, np.where(has_auto, auto_values, test_values))
+
+
+def _cost_basis_segments(ledger, instrument_id: int, fx: FxCurves, currency: str, start: np.datetime64):
+    """Lot cost of one instrument after each of its ledger dates
+
+    Each segment holds the HUF cost of lots with an FX rate on their date and
+    the local-currency cost of lots without one (valued at the snapshot rate,
+    as lot_cost_in_huf does). Returns (segment start days, huf parts,
+    local parts, has cost).
+
+    FIFO lots as compute_lots matches them, in one cumulative pass: the open
+    lots after an entry are the buys past the quantity sold so far, so their
+    cost is the cost bought so far minus that of the first units sold, read
+    off cumulative sums.
+    """
+    instrument_ids, dates, quantities, prices, _ = ledger
+    mine = instrument_ids == instrument_id
+    # Stable, like compute_lots: entries of one date keep their ledger order
+    order = np.argsort(dates[mine], kind='stable')
+    dates, quantities, prices = dates[mine][order], quantities[mine][order], prices[mine][order]
+    changes = np.unique(np.concatenate(([start], dates[dates > start])))
+
+    buys = quantities > 0
+    buy_qty, buy_price = quantities[buys], prices[buys]
+    buy_rates = fx.rates_on(currency, 'HUF', dates[buys])
+    cum_qty = np.concatenate(([0.0], np.cumsum(buy_qty)))
+    unit_cost = np.array([Decimal(str(p)) for p in buy_price.tolist()], dtype=object)
+    unit_huf = np.array([c * r if r is not None else Decimal('0') for c, r in zip(unit_cost, buy_rates)], dtype=object)
+    unit_local = np.array([c if r is None else Decimal('0') for c, r in zip(unit_cost, buy_rates)], dtype=object)
+    lot_qty = np.array([Decimal(str(q)) for q in buy_qty.tolist()], dtype=object)
+    cum_huf, cum_local, cum_all = (
+        np.concatenate(([Decimal('0')], np.cumsum(lot_qty * unit))) for unit in (unit_huf, unit_local, unit_cost)
+    )
+
+    # Quantity sold and number of buys after each entry
+    sold = np.concatenate(([0.0], cumulative_sold(quantities)))[np.cumsum(quantities < 0)]
+    bought = np.cumsum(buys)
+
+    def first_units(cum, unit, units: float):
+        """Cost of the first `units` units bought"""
+        j = int(np.searchsorted(cum_qty, units, side='right')) - 1
+        if j >= len(buy_qty):
+            return cum[-1]
+        return cum[j] + Decimal(str(units - cum_qty[j])) * unit[j]
+
+    huf_parts, local_parts, has_cost = [], [], []
+    for k in (np.searchsorted(dates, changes, side='right') - 1).tolist():
+        if k < 0:
+            huf, local, cost = Decimal('0'), Decimal('0'), Decimal('0')
+        else:
+            n, units = bought[k], sold[k]
+            huf = cum_huf[n] - first_units(cum_huf, unit_huf, units)
+            local = cum_local[n] - first_units(cum_local, unit_local, units)
+            cost = cum_all[n] - first_units(cum_all, unit_cost, units)
+        has_cost.append(cost != 0)
+        huf_parts.append(huf if cost else Decimal('0'))
+        local_parts.append(local if cost else Decimal('0'))
+
+    return changes, np.array(huf_parts, dtype=object), np.array(local_parts, dtype=object), np.array(has_cost)
+
+
+def grid_rows(
+    portfolio_id: int, start_date: date, end_date: date, db: Session, trading_days_only: bool = False,
+    instrument_ids: Optional[Set[int]] = None
+) -> Tuple[List[dict], List[int]]:
+    """Value every day in [start_date, end_date] without writing anything
+
+    With trading_days_only, days on which none of the held instruments'
+    markets is open are left out (reads resolve them as of the last open
+    day), and rows stored for them are reported as stale. With
+    instrument_ids, only those instruments are valued and only their stored
+    rows can be stale.
+
+    Returns the portfolio_values_daily rows in date-major order, and the ids
+    of stored rows in the range that the grid no longer produces.
+    """
+    if end_date < start_date:
+        raise ValueError("end_date must not be before start_date")
+
+    days = np.arange(np.datetime64(start_date, 'D'), np.datetime64(end_date, 'D') + 1)
+    position_series = load_position_series(db, portfolio_id)
+    if instrument_ids is not None:
+        position_series = {k: v for k, v in position_series.items() if k in instrument_ids}
+
+    # Grid columns: instruments held at some point in the range
+    quantities = {}
+    for instrument_id, series in position_series.items():
+        held = series.quantities_on(days.astype(date))
+        if any(q != 0 for q in held):
+            quantities[instrument_id] = held
+
+    instruments = db.query(Instrument.id, Instrument.name, Instrument.currency).filter(
+        Instrument.id.in_(list(quantities))
+    ).all() if quantities else []
+
+    price_index = get_price_index(db)
+    fx = get_fx_curves(db)
+    ledger = load_ledger_arrays(db, portfolio_id, end_date)
+
+    if trading_days_only:
+        is_open = open_days(days, {calendar_for_currency(i.currency) for i in instruments})
+    else:
+        is_open = np.ones(len(days), dtype=bool)
+
+    calculated_at = datetime.now()
+    day_values = days.astype(date)
+    rows = []
+    for instrument in instruments:
+        quantity = quantities[instrument.id]
+        price = resolve_prices(*price_index.curves(instrument.id), days)
+        fx_rate = fx.rates_on(instrument.currency, 'HUF', days)
+
+        valued = (quantity != 0) & (price != None) & (fx_rate != None)
+        if not valued.any():
+            print(f"⚠ No price or FX rate for {instrument.name} in this range")
+            continue
+        valued &= is_open
+
+        value_huf = np.full(len(days), None, dtype=object)
+        value_huf[valued] = quantity[valued] * price[valued] * fx_rate[valued]
+        converted = reporting_values(fx, value_huf, days)
+
+        changes, huf_parts, local_parts, has_cost = _cost_basis_segments(
+            ledger, instrument.id, fx, instrument.currency, days[0]
+        )
+        segment = np.searchsorted(changes, days, side='right') - 1
+
+        for k in np.flatnonzero(valued).tolist():
+            s = segment[k]
+            cost_basis_huf = huf_parts[s] + local_parts[s] * fx_rate[k] if has_cost[s] else None
+            rows.append({
+                'portfolio_id': portfolio_id,
+                'snapshot_date': day_values[k],
+                'instrument_id': instrument.id,
+                'quantity': quantity[k],
+                'price': price[k],
+                'instrument_currency': instrument.currency,
+                'fx_rate': fx_rate[k],
+                'value_huf': value_huf[k],
+                **{column: values[k] for column, values in converted.items()},
+                'cost_basis_huf': cost_basis_huf,
+                'unrealized_gain_huf': value_huf[k] - cost_basis_huf if cost_basis_huf is not None else None,
+                'calculated_at': calculated_at
+            })
+
+    # Stored rows in the range that the grid no longer produces. Only
+    # instruments with a position series can be regenerated; rows of other
+    # instruments (month-end rows from the history CSV imports) are kept.
+    written = {(row['snapshot_date'], row['instrument_id']) for row in rows}
+    stale = [
+        row.id for row in db.query(
+            PortfolioValueDaily.id, PortfolioValueDaily.snapshot_date, PortfolioValueDaily.instrument_id
+        ).filter(
+            PortfolioValueDaily.portfolio_id == portfolio_id,
+            PortfolioValueDaily.snapshot_date >= start_date,
+            PortfolioValueDaily.snapshot_date <= end_date,
+            PortfolioValueDaily.instrument_id.in_(list(position_series))
+        )
+        if (row.snapshot_date, row.instrument_id) not in written
+    ] if position_series else []
+
+    # Date-major order so each committed chunk covers a contiguous period
+    rows.sort(key=lambda row: (row['snapshot_date'], row['instrument_id']))
+    return rows, stale
+
+
+def delete_stale_values(db: Session, stale: List[int], chunk_size: int = 1000):
+    for i in range(0, len(stale), chunk_size):
+        db.query(PortfolioValueDaily).filter(
+            PortfolioValueDaily.id.in_(stale[i:i + chunk_size])
+        ).delete(synchronize_session=False)
+
+
+def recalculate(
+    portfolio_id: int, start_date: date, end_date: date, db: Session,
+    chunk_size: int = 1000, trading_days_only: bool = False
+) -> int:
+    """Recalculate portfolio_values_daily for every day in [start_date, end_date]
+
+    Returns the number of rows written.
+    """
+    rows, stale = grid_rows(portfolio_id, start_date, end_date, db, trading_days_only)
+    delete_stale_values(db, stale, chunk_size)
+    for i in range(0, len(rows), chunk_size):
+        upsert_portfolio_values(db, rows[i:i + chunk_size], chunk_size)
+        db.commit()
+    db.commit()
+
+    days = (end_date - start_date).days + 1
+    print(f"✓ Recalculated {len(rows)} values over {days} days ({len(stale)} stale rows removed)")
+    return len(rows)
+
+
+def run_recalculate(portfolio_id: int, start_date: date, end_date: date, trading_days_only: bool = True):
+    """Recalculate a portfolio's stored values for a date range"""
+    db = SessionLocal()
+    try:
+        recalculate(portfolio_id, start_date, end_date, db, trading_days_only=trading_days_only)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('portfolio_id', type=int)
+    parser.add_argument('start_date', type=date.fromisoformat)
+    parser.add_argument('end_date', type=date.fromisoformat)
+    parser.add_argument('--all-days', action='store_true', help="also store values on market holidays and weekends")
+    args = parser.parse_args()
+    run_recalculate(args.portfolio_id, args.start_date, args.end_date, not args.all_days)
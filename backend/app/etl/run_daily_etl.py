@@ -2,29 +2,50 @@ from datetime import date
 from .fetch_fx_mnb import run_fx_fetch
 from .fetch_prices import run_price_fetch
 from .calculate_values import run_calculate_values
+from .process_revaluations import run_revaluation_queue
 from .fetch_wealth_automated import run_wealth_fetch
+from ..events import publish, check_data_version
+from ..journal import run_journal_prune
+from ..positions import run_position_sync
+
+ETL_STEPS = [
+    ("Fetching FX rates from MNB", run_fx_fetch),
+    ("Fetching instrument prices", run_price_fetch),
+    ("Rebuilding positions changed outside the API", run_position_sync),
+    ("Calculating portfolio values", run_calculate_values),
+    ("Recalculating values made stale by back-dated changes", run_revaluation_queue),
+    ("Fetching automated wealth values", run_wealth_fetch),
+    ("Pruning the change journal", run_journal_prune),
+]
 
 def run_daily_etl():
-    """Run complete daily ETL pipeline"""
+    """Run complete daily ETL pipeline
+
+    Progress is published as 'etl' events (see events.py), followed by a
+    data_version event after each step that changed data.
+    """
     print(f"\n{'='*50}")
     print(f"Running Daily ETL - {date.today()}")
     print(f"{'='*50}\n")
-    
-    print("Step 1: Fetching FX rates from MNB...")
-    run_fx_fetch()
-    
-    print("\nStep 2: Fetching instrument prices...")
-    run_price_fetch()
-    
-    print("\nStep 3: Calculating portfolio values...")
-    run_calculate_values()
-    
-    print("\nStep 4: Fetching automated wealth values...")
-    run_wealth_fetch()
-    
+    publish('etl', {'status': 'started', 'steps': len(ETL_STEPS)})
+
+    for step, (title, run_step) in enumerate(ETL_STEPS, start=1):
+        if step > 1:
+            print()
+        print(f"Step {step}: {title}...")
+        publish('etl', {'status': 'step_started', 'step': step, 'steps': len(ETL_STEPS), 'title': title})
+        try:
+            run_step()
+        except Exception as e:
+            publish('etl', {'status': 'failed', 'step': step, 'title': title, 'error': str(e)})
+            raise
+        publish('etl', {'status': 'step_completed', 'step': step, 'steps': len(ETL_STEPS), 'title': title})
+        check_data_version(force=True)
+
     print(f"\n{'='*50}")
     print("ETL Complete!")
     print(f"{'='*50}\n")
+    publish('etl', {'status': 'completed', 'version': check_data_version(force=True)})
 
 if __name__ == "__main__":
     run_daily_etl()
@@ -0,0 +1,143 @@
+"""
+In-process event stream for server-sent events
+
+The ETL publishes progress and step completion here, and data-version bumps
+are published whenever change_journal moves (whoever wrote the data: the
+API, the ETL, a cron run in another process or the mobile app). /events
+streams them to every connected client so they refresh exactly when new
+data lands.
+
+Events are kept in a short ring buffer with increasing ids, so a client
+that reconnects with Last-Event-ID gets what it missed. Subscribers are
+async generators on the server's event loop; publishers in any thread wake
+them through the loop.
+"""
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from typing import AsyncIterator, Optional
+
+HISTORY_SIZE = 200
+KEEPALIVE_SECONDS = 15
+VERSION_POLL_SECONDS = 2
+
+_lock = threading.Lock()
+_history = deque(maxlen=HISTORY_SIZE)
+# Ids continue from the boot time in milliseconds, so they keep increasing
+# across server restarts and a client's Last-Event-ID from an earlier run
+# is not mistaken for one of this run's events
+_last_id = int(time.time() * 1000)
+# (event loop, asyncio.Event) of every connected subscriber
+_subscribers = set()
+
+_version_lock = threading.Lock()
+_last_version: Optional[int] = None
+_last_version_check = 0.0
+
+
+def publish(event: str, data: dict) -> int:
+    """Append an event and wake every subscriber; returns the event id
+
+    Safe to call from any thread (ETL runs, sync endpoints).
+    """
+    global _last_id
+    with _lock:
+        _last_id += 1
+        _history.append((_last_id, event, data))
+        subscribers = list(_subscribers)
+        event_id = _last_id
+    for loop, wakeup in subscribers:
+        try:
+            loop.call_soon_threadsafe(wakeup.set)
+        except RuntimeError:
+            pass  # loop already closed; the subscriber is going away
+    return event_id
+
+
+def check_data_version(force: bool = False) -> Optional[int]:
+    """Publish a data_version event if the journal moved since the last check
+
+    Polled at most every VERSION_POLL_SECONDS across all subscribers, so the
+    database sees one cheap max(id) query no matter how many are connected.
+    """
+    global _last_version, _last_version_check
+    with _version_lock:
+        now = time.monotonic()
+        if not force and now - _last_version_check < VERSION_POLL_SECONDS:
+            return _last_version
+        _last_version_check = now
+
+        from .db import SessionLocal
+        from .journal import current_version
+        db = SessionLocal()
+        try:
+            version = current_version(db)
+        finally:
+            db.close()
+
+        if version != _last_version:
+            _last_version = version
+            publish('data_version', {'version': version})
+        return version
+
+
+def _format(event_id: int, event: str, data: dict) -> str:
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def _can_replay(last_event_id: int) -> bool:
+    """Whether every event after last_event_id is still in the history
+
+    Not for ids from an earlier run (or a buffer that has moved on): those
+    clients start over like new ones.
+    """
+    with _lock:
+        oldest = _history[0][0] if _history else _last_id + 1
+        return oldest - 1 <= last_event_id <= _last_id
+
+
+async def stream(last_event_id: Optional[int] = None, keepalive: float = KEEPALIVE_SECONDS) -> AsyncIterator[str]:
+    """SSE frames for one client, starting after last_event_id
+
+    New clients, and clients whose missed events are gone, first get the
+    current data version, then live events. Runs on the event loop: waiting
+    holds no worker thread, only the version check runs in one.
+    """
+    wakeup = asyncio.Event()
+    subscriber = (asyncio.get_running_loop(), wakeup)
+    with _lock:
+        _subscribers.add(subscriber)
+    try:
+        if last_event_id is None or not _can_replay(last_event_id):
+            version = await asyncio.to_thread(check_data_version, True)
+            with _lock:
+                last_event_id = _last_id
+            yield _format(last_event_id, 'data_version', {'version': version})
+
+        last_sent = time.monotonic()
+        while True:
+            wakeup.clear()
+            with _lock:
+                pending = [e for e in _history if e[0] > last_event_id]
+            if not pending:
+                try:
+                    await asyncio.wait_for(wakeup.wait(), timeout=VERSION_POLL_SECONDS)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+                # Idle: pick up writes made outside this process
+                await asyncio.to_thread(check_data_version)
+                if time.monotonic() - last_sent >= keepalive:
+                    last_sent = time.monotonic()
+                    yield ": keepalive\n\n"
+                continue
+
+            last_sent = time.monotonic()
+            for event_id, event, data in pending:
+                last_event_id = event_id
+                yield _format(event_id, event, data)
+    finally:
+        with _lock:
+            _subscribers.discard(subscriber)
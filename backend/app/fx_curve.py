@@ -0,0 +1,185 @@
+"""
+Process-level FX curve service
+
+Every FX lookup (valuation, cost basis, returns, total wealth) goes through
+here. fx_rates is loaded once into date-sorted arrays per stored pair and
+reloaded whenever change_journal shows the table changed; the table is small
+(one row per currency per business day), so a full reload is cheaper than
+replaying individual rows.
+
+A rate for base -> target on a date is the latest one on or before it,
+resolved in this order:
+
+1. the stored pair
+2. the inverse of the stored target -> base pair
+3. triangulated through HUF, then EUR (each leg stored or inverse); MNB
+   publishes everything against HUF, so e.g. EUR -> USD is EUR/HUF ÷ USD/HUF
+"""
+import threading
+from bisect import bisect_right
+from datetime import date
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from sqlalchemy.orm import Session
+from . import models
+from .db import committed_reader
+from .journal import current_version
+
+PIVOT_CURRENCIES = ('HUF', 'EUR')
+ONE = Decimal('1.0')
+
+Curve = Tuple[List[date], List[Decimal]]
+
+
+def _as_of(curve: Curve, as_of: date) -> Optional[Decimal]:
+    dates, rates = curve
+    i = bisect_right(dates, as_of)
+    return rates[i - 1] if i else None
+
+
+class FxCurves:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        # Picklable for worker processes; the lock is per process
+        return {k: v for k, v in self.__dict__.items() if k != '_lock'}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Forget everything; the next refresh reloads from the database"""
+        self._stored: Dict[Tuple[str, str], Curve] = {}
+        self._pairs: Dict[Tuple[str, str], Optional[Curve]] = {}
+        self._arrays: Dict[Tuple[str, str], Tuple[np.ndarray, np.ndarray]] = {}
+        self.version: Optional[int] = None
+
+    def refresh(self, db: Session):
+        """Reload if fx_rates changed since the last load
+
+        Reads committed rows only, through a session of its own.
+        """
+        with committed_reader(db) as reader:
+            self._refresh(reader)
+
+    def _refresh(self, db: Session):
+        version = current_version(db, ('fx_rates',))
+        if version == self.version:
+            return
+
+        with self._lock:
+            if version == self.version:
+                return
+            rows = db.query(
+                models.FxRate.base_currency, models.FxRate.target_currency,
+                models.FxRate.rate_date, models.FxRate.rate
+            ).order_by(
+                models.FxRate.base_currency, models.FxRate.target_currency,
+                models.FxRate.rate_date, models.FxRate.id
+            ).all()
+
+            stored: Dict[Tuple[str, str], Curve] = {}
+            for base, target, day, rate in rows:
+                dates, rates = stored.setdefault((base, target), ([], []))
+                if dates and dates[-1] == day:
+                    rates[-1] = rate  # last row of a date wins
+                else:
+                    dates.append(day)
+                    rates.append(rate)
+
+            self._stored = stored
+            self._pairs = {}
+            self._arrays = {}
+            self.version = version
+
+    def currencies(self) -> set:
+        """Every currency that can be converted, HUF included"""
+        return {c for pair in self._stored for c in pair} | {'HUF'}
+
+    # ----- pair curves -----
+
+    def _leg(self, base: str, target: str) -> Optional[Curve]:
+        """Stored pair or its inverse"""
+        if (base, target) in self._stored:
+            return self._stored[(base, target)]
+        if (target, base) in self._stored:
+            dates, rates = self._stored[(target, base)]
+            return dates, [ONE / r for r in rates]
+        return None
+
+    def pair(self, base: str, target: str) -> Optional[Curve]:
+        """Dates and rates of base -> target, derived and cached on first use"""
+        key = (base, target)
+        if key in self._pairs:
+            return self._pairs[key]
+
+        curve = self._leg(base, target)
+        if curve is None:
+            for pivot in PIVOT_CURRENCIES:
+                if pivot in key:
+                    continue
+                first, second = self._leg(base, pivot), self._leg(pivot, target)
+                if first and second:
+                    # Rate changes whenever either leg does
+                    dates = sorted(set(first[0]) | set(second[0]))
+                    points = [(d, _as_of(first, d), _as_of(second, d)) for d in dates]
+                    points = [(d, a * b) for d, a, b in points if a is not None and b is not None]
+                    curve = ([d for d, _ in points], [r for _, r in points])
+                    break
+
+        self._pairs[key] = curve
+        return curve
+
+    # ----- lookups -----
+
+    def rate(self, base: str, target: str, as_of: date) -> Optional[Decimal]:
+        """Latest base -> target rate on or before as_of"""
+        if base == target:
+            return ONE
+        curve = self.pair(base, target)
+        return _as_of(curve, as_of) if curve else None
+
+    def nearest(self, base: str, target: str, as_of: date) -> Optional[Decimal]:
+        """rate(), or the first known rate when as_of predates the curve"""
+        found = self.rate(base, target, as_of)
+        if found is None:
+            curve = self.pair(base, target)
+            if curve and curve[1]:
+                return curve[1][0]
+        return found
+
+    def rates(self, currencies: Iterable[str], target: str, as_of: date) -> Dict[str, Optional[Decimal]]:
+        return {currency: self.rate(currency, target, as_of) for currency in currencies}
+
+    def rates_on(self, base: str, target: str, days: np.ndarray) -> np.ndarray:
+        """Vectorized rate() over datetime64[D] days; None where unknown"""
+        if base == target:
+            return np.full(len(days), ONE, dtype=object)
+        key = (base, target)
+        if key not in self._arrays:
+            curve = self.pair(base, target)
+            if not curve or not curve[0]:
+                return np.full(len(days), None, dtype=object)
+            self._arrays[key] = (np.array(curve[0], dtype='datetime64[D]'), np.array(curve[1], dtype=object))
+        curve_days, curve_rates = self._arrays[key]
+        idx = np.searchsorted(curve_days, days, side='right') - 1
+        return np.where(idx >= 0, curve_rates[np.maximum(idx, 0)], None)
+
+
+_curves = FxCurves()
+
+
+def get_fx_curves(db: Session) -> FxCurves:
+    """The shared FX curves, reloaded if fx_rates changed"""
+    _curves.refresh(db)
+    return _curves
+
+
+def install_fx_curves(curves: FxCurves):
+    """Use curves loaded in another process (see etl/parallel_values.py)"""
+    global _curves
+    _curves = curves
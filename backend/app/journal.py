@@ -0,0 +1,219 @@
+"""
+Change-data-capture journal
+
+Every insert, update and delete on the journaled tables appends a row to
+change_journal. The journal id is a monotonically increasing data version,
+so caches, ETags, sync clients and derived tables can tell exactly what
+changed since a version they have seen.
+
+Ids come from a sequence and are handed out when rows are written, not when
+they commit, so on Postgres a later id can become visible before an earlier
+one. current_version() therefore only reports versions up to which every id
+is settled: each writing transaction takes a shared advisory lock keyed by
+the sequence value just before its first journal id, and readers stay at or
+below the lowest such key (see settled_version). SQLite serializes writers,
+so there every visible id is settled.
+
+The daily ETL prunes entries older than settings.journal_retention_days
+(prune_journal); sync clients and caches behind the oldest kept entry start
+over from a full copy.
+
+Entries are written by database triggers rather than by each write path, so
+crud.py, wealth_crud.py, the ETL, the raw-SQL importers and the mobile app's
+direct Supabase writes are all captured the same way. The triggers are
+attached when tables are created (see models.py) and installed on existing
+databases by migrate_schema.py.
+"""
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+from sqlalchemy import DDL, event, func, select, text, union_all
+from sqlalchemy.orm import Session
+
+JOURNALED_TABLES = (
+    'instruments',
+    'portfolios',
+    'holdings',
+    'prices',
+    'fx_rates',
+    'portfolio_values_daily',
+    'transactions',
+    'manual_prices',
+    'wealth_categories',
+    'wealth_values',
+    'total_wealth_snapshots',
+)
+
+# Tables whose rows belong to a portfolio; the journal records it for scoping
+PORTFOLIO_SCOPED_TABLES = ('holdings', 'portfolio_values_daily', 'transactions')
+
+POSTGRES_FUNCTION = """
+CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$
+DECLARE
+    changed jsonb;
+    settled bigint;
+BEGIN
+    -- Once per transaction, before its first id: announce that ids above the
+    -- current sequence value may still be in flight (released at commit or
+    -- rollback). The journal is the only user of bigint-keyed advisory locks.
+    IF coalesce(current_setting('change_journal.settled', true), '') = '' THEN
+        settled := coalesce(pg_sequence_last_value(pg_get_serial_sequence('change_journal', 'id')::regclass), 0);
+        PERFORM pg_advisory_xact_lock_shared(settled);
+        PERFORM set_config('change_journal.settled', settled::text, true);
+    END IF;
+    IF TG_OP = 'DELETE' THEN
+        changed := to_jsonb(OLD);
+    ELSE
+        changed := to_jsonb(NEW);
+    END IF;
+    INSERT INTO change_journal (table_name, row_id, operation, portfolio_id, changed_at)
+    VALUES (
+        TG_TABLE_NAME,
+        CAST(changed->>'id' AS INTEGER),
+        lower(TG_OP),
+        CAST(changed->>'portfolio_id' AS INTEGER),
+        now()
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def postgres_trigger_statements(table: str) -> list:
+    return [
+        POSTGRES_FUNCTION,
+        f"DROP TRIGGER IF EXISTS journal_{table} ON {table}",
+        f"CREATE TRIGGER journal_{table} AFTER INSERT OR UPDATE OR DELETE ON {table} "
+        f"FOR EACH ROW EXECUTE FUNCTION record_change()",
+    ]
+
+
+def sqlite_trigger_statements(table: str) -> list:
+    statements = []
+    for operation, row in (('insert', 'NEW'), ('update', 'NEW'), ('delete', 'OLD')):
+        portfolio = f"{row}.portfolio_id" if table in PORTFOLIO_SCOPED_TABLES else "NULL"
+        statements.append(
+            f"CREATE TRIGGER IF NOT EXISTS journal_{table}_{operation} "
+            f"AFTER {operation.upper()} ON {table} FOR EACH ROW BEGIN "
+            f"INSERT INTO change_journal (table_name, row_id, operation, portfolio_id, changed_at) "
+            f"VALUES ('{table}', {row}.id, '{operation}', {portfolio}, CURRENT_TIMESTAMP); END"
+        )
+    return statements
+
+
+def attach_triggers(metadata):
+    """Install journal triggers whenever a journaled table is created"""
+    for table in JOURNALED_TABLES:
+        if table not in metadata.tables:
+            continue
+        target = metadata.tables[table]
+        for statement in postgres_trigger_statements(table):
+            event.listen(target, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+        for statement in sqlite_trigger_statements(table):
+            event.listen(target, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+
+
+# Read the sequence first, then the locks: an id at or below the sequence
+# value was handed out after its transaction's lock was taken
+SEQUENCE_VALUE_SQL = (
+    "SELECT pg_sequence_last_value(pg_get_serial_sequence('change_journal', 'id')::regclass)"
+)
+IN_FLIGHT_SQL = (
+    "SELECT min((classid::bigint << 32) | objid::bigint) FROM pg_locks "
+    "WHERE locktype = 'advisory' AND objsubid = 1 "
+    "AND database = (SELECT oid FROM pg_database WHERE datname = current_database())"
+)
+
+
+def settled_version(db: Session) -> Optional[int]:
+    """Highest id below which no journal entry can still be uncommitted
+
+    None on SQLite, where writers are serialized. Must be read before the
+    journal itself, so the journal read sees everything it covers.
+    """
+    if db.get_bind().dialect.name != 'postgresql':
+        return None
+    settled = db.execute(text(SEQUENCE_VALUE_SQL)).scalar() or 0
+    in_flight = db.execute(text(IN_FLIGHT_SQL)).scalar()
+    return settled if in_flight is None else min(settled, in_flight)
+
+
+def current_version(
+    db: Session,
+    tables: Optional[Iterable[str]] = None,
+    portfolio_id: Optional[int] = None
+) -> int:
+    """Latest settled journal version, optionally for some tables / one portfolio
+
+    Portfolio-scoped lookups also include changes to unscoped rows of the
+    same tables (e.g. a new instrument), so they never miss a change.
+    """
+    from .models import ChangeJournal
+
+    settled = settled_version(db)
+    if tables is None:
+        tables = JOURNALED_TABLES
+    # One max(id) per table, each a backward scan of ix_change_journal_table_id
+    per_table = []
+    for table in tables:
+        query = select(func.max(ChangeJournal.id).label('id')).where(ChangeJournal.table_name == table)
+        if portfolio_id is not None:
+            query = query.where(
+                (ChangeJournal.portfolio_id == portfolio_id) | (ChangeJournal.portfolio_id == None)
+            )
+        per_table.append(query)
+    if not per_table:
+        return 0
+    latest = union_all(*per_table).subquery()
+    version = db.query(func.max(latest.c.id)).scalar() or 0
+    return version if settled is None else min(version, settled)
+
+
+def first_version(db: Session) -> Optional[int]:
+    """Oldest journal id still kept; None if the journal is empty"""
+    from .models import ChangeJournal
+    return db.query(func.min(ChangeJournal.id)).scalar()
+
+
+def prune_journal(db: Session, retention_days: int, batch_size: int = 50000) -> int:
+    """Delete entries older than retention_days, in batches
+
+    Never deletes the latest entry or anything not yet settled. Consumers
+    holding a version older than the oldest kept entry start over: sync
+    returns a full copy, the price index reloads. Returns the rows deleted.
+    """
+    from .models import ChangeJournal
+
+    cutoff = datetime.utcnow() - timedelta(days=retention_days)
+    bound = db.query(func.max(ChangeJournal.id)).filter(ChangeJournal.changed_at < cutoff).scalar()
+    latest = db.query(func.max(ChangeJournal.id)).scalar()
+    if bound is None:
+        return 0
+    bound = min(bound, latest - 1)
+    settled = settled_version(db)
+    if settled is not None:
+        bound = min(bound, settled)
+
+    deleted = 0
+    while True:
+        batch = select(ChangeJournal.id).where(ChangeJournal.id <= bound).order_by(ChangeJournal.id).limit(batch_size)
+        count = db.query(ChangeJournal).filter(
+            ChangeJournal.id.in_(batch.scalar_subquery())
+        ).delete(synchronize_session=False)
+        db.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def run_journal_prune():
+    """Prune change_journal to settings.journal_retention_days"""
+    from .config import settings
+    from .db import SessionLocal
+
+    db = SessionLocal()
+    try:
+        deleted = prune_journal(db, settings.journal_retention_days)
+        print(f"✓ Removed {deleted} change journal entries older than {settings.journal_retention_days} days")
+    finally:
+        db.close()
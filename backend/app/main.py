@@ -1,11 +1,14 @@
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Request, Response, Header, Query
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.orm import Session
 from datetime import date
 from typing import List, Optional
+import threading
 from pydantic import BaseModel
-from . import crud, models, wealth_crud
+from . import crud, models, wealth_crud, cost_basis, returns, journal, sync, events, attribution, price_staleness
 from .db import get_db, engine
+from .price_index import get_price_index
 from .automatic_loan_reductions import check_and_run_automatic_reductions
 
 # Create tables
@@ -38,6 +41,12 @@ async def startup_event():
     finally:
         db.close()
 
+def not_modified(request: Request, response: Response, version: int) -> bool:
+    """Set a version-based ETag; True if the client's copy is still current"""
+    etag = f'W/"{version}"'
+    response.headers["ETag"] = etag
+    return request.headers.get("if-none-match") == etag
+
 @app.get("/")
 def root():
     return {"message": "Portfolio Analyzer API", "version": "1.0"}
@@ -57,41 +66,26 @@ def get_snapshot(
     if not snapshot:
         raise HTTPException(status_code=404, detail="No data for this date")
     
+    instruments = {
+        i.id: i for i in db.query(models.Instrument).filter(
+            models.Instrument.id.in_([item.instrument_id for item in snapshot])
+        )
+    }
+    price_index = get_price_index(db)
+    
     result = []
     for item in snapshot:
-        instrument = db.query(models.Instrument).get(item.instrument_id)
-        
-        # Determine price source by checking which was used most recently
-        # First, get the most recent manual price
-        manual_price = db.query(models.ManualPrice).filter(
-            models.ManualPrice.instrument_id == item.instrument_id,
-            models.ManualPrice.override_date <= snapshot_date
-        ).order_by(models.ManualPrice.override_date.desc()).first()
-        
-        # Then, get the most recent automatic price
-        auto_price = db.query(models.Price).filter(
-            models.Price.instrument_id == item.instrument_id,
-            models.Price.price_date <= snapshot_date
-        ).order_by(models.Price.price_date.desc()).first()
+        instrument = instruments[item.instrument_id]
         
-        # Determine which source was actually used based on which is more recent
-        # and whether the price matches
-        if manual_price and auto_price:
-            # If manual price is more recent than auto price, it was used
-            if manual_price.override_date >= auto_price.price_date:
-                if abs(float(manual_price.price) - float(item.price)) < 0.01:
-                    price_source = f"manual ({manual_price.created_by or 'user'})"
-                else:
-                    price_source = auto_price.source
-            else:
-                # Auto price is more recent, it was used
-                price_source = auto_price.source
-        elif manual_price:
-            price_source = f"manual ({manual_price.created_by or 'user'})"
-        elif auto_price:
-            price_source = auto_price.source
-        else:
-            price_source = "unknown"
+        # Determine price source: the price valuation would use, unless the
+        # stored price matches the other latest manual / automatic candidate
+        used = price_index.latest(item.instrument_id, snapshot_date)
+        matching = [
+            hit for hit in (used, *price_index.candidates(item.instrument_id, snapshot_date))
+            if hit and abs(float(hit.price) - float(item.price)) < 0.01
+        ]
+        hit = matching[0] if matching else used
+        price_source = hit.label if hit else "unknown"
         
         result.append({
             "isin": instrument.isin,
@@ -102,7 +96,12 @@ def get_snapshot(
             "currency": item.instrument_currency,
             "fx_rate": float(item.fx_rate),
             "value_huf": float(item.value_huf),
-            "price_source": price_source
+            "cost_basis_huf": float(item.cost_basis_huf) if item.cost_basis_huf is not None else None,
+            "unrealized_gain_huf": float(item.unrealized_gain_huf) if item.unrealized_gain_huf is not None else None,
+            "price_source": price_source,
+            # Staleness: prices carry forward as of later dates until a new one is fetched
+            "price_date": hit.price_date.isoformat() if hit else None,
+            "price_age_days": (snapshot_date - hit.price_date).days if hit else None
         })
     
     return result
@@ -111,18 +110,25 @@ def get_snapshot(
 def get_summary(
     portfolio_id: int,
     snapshot_date: date = None,
+    currency: str = "HUF",
     db: Session = Depends(get_db)
 ):
-    """Get portfolio summary"""
+    """Get portfolio summary, totalled in HUF, USD or EUR"""
     if snapshot_date is None:
         snapshot_date = date.today()
     
-    summary = crud.get_portfolio_summary(db, portfolio_id, snapshot_date)
+    try:
+        summary = crud.get_portfolio_summary(db, portfolio_id, snapshot_date, currency)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     
     return {
         "portfolio_id": portfolio_id,
         "snapshot_date": snapshot_date.isoformat(),
+        "value_date": summary.value_date.isoformat() if summary.value_date else None,
         "total_value_huf": float(summary.total_value_huf) if summary.total_value_huf else 0,
+        "currency": currency.upper(),
+        "total_value": float(summary.total_value) if summary.total_value else 0,
         "instrument_count": summary.instrument_count
     }
 
@@ -131,9 +137,20 @@ def get_portfolio_history(
     portfolio_id: int,
     start_date: date,
     end_date: date,
+    request: Request,
+    response: Response,
+    currency: str = "HUF",
     db: Session = Depends(get_db)
 ):
-    """Get portfolio value history for a date range"""
+    """Get portfolio value history for a date range, with values in HUF, USD or EUR"""
+    try:
+        value_column = crud.value_column(currency).key
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    version = journal.current_version(db, ["portfolio_values_daily", "instruments"], portfolio_id)
+    if not_modified(request, response, version):
+        return Response(status_code=304, headers={"ETag": response.headers["ETag"]})
     
     # Get all portfolio values in date range
     portfolio_values = db.query(models.PortfolioValueDaily).filter(
@@ -162,11 +179,44 @@ def get_portfolio_history(
             "price": float(pv.price),
             "currency": pv.instrument_currency,
             "fx_rate": float(pv.fx_rate),
-            "value_huf": float(pv.value_huf)
+            "value_huf": float(pv.value_huf),
+            "reporting_currency": currency.upper(),
+            "value": float(getattr(pv, value_column)) if getattr(pv, value_column) is not None else None,
+            "cost_basis_huf": float(pv.cost_basis_huf) if pv.cost_basis_huf is not None else None,
+            "unrealized_gain_huf": float(pv.unrealized_gain_huf) if pv.unrealized_gain_huf is not None else None
         })
     
     return results
 
+@app.get("/portfolio/{portfolio_id}/gains")
+def get_portfolio_gains(
+    portfolio_id: int,
+    as_of: date = None,
+    method: str = "fifo",
+    db: Session = Depends(get_db)
+):
+    """Get cost basis, realized and unrealized gains per instrument"""
+    if method not in cost_basis.METHODS:
+        raise HTTPException(status_code=400, detail=f"method must be one of {', '.join(cost_basis.METHODS)}")
+    
+    return cost_basis.calculate_gains(db, portfolio_id, as_of, method)
+
+@app.get("/portfolio/{portfolio_id}/returns")
+def get_portfolio_returns(
+    portfolio_id: int,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    include_series: bool = False,
+    db: Session = Depends(get_db)
+):
+    """Get time-weighted (TWR) and money-weighted (XIRR) returns for a window"""
+    result = returns.calculate_returns(db, portfolio_id, start_date, end_date, include_series)
+    
+    if result is None:
+        raise HTTPException(status_code=404, detail="No portfolio values in this range")
+    
+    return result
+
 # ===== PYDANTIC SCHEMAS =====
 
 class TransactionCreate(BaseModel):
@@ -227,6 +277,29 @@ def create_transaction(transaction: TransactionCreate, db: Session = Depends(get
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.post("/transactions/bulk")
+def create_transactions_bulk(transactions: List[TransactionCreate], db: Session = Depends(get_db)):
+    """Add many transactions at once (e.g. a broker statement import)"""
+    try:
+        created = crud.add_transactions(db, [tx.dict() for tx in transactions])
+        return [
+            {
+                "id": tx.id,
+                "portfolio_id": tx.portfolio_id,
+                "instrument_id": tx.instrument_id,
+                "transaction_date": tx.transaction_date.isoformat(),
+                "transaction_type": tx.transaction_type,
+                "quantity": float(tx.quantity),
+                "price": float(tx.price) if tx.price else None,
+                "notes": tx.notes,
+                "created_by": tx.created_by,
+                "created_at": tx.created_at.isoformat()
+            }
+            for tx in created
+        ]
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.get("/transactions/{portfolio_id}")
 def get_transaction_history(
     portfolio_id: int,
@@ -320,6 +393,54 @@ def get_manual_price_overrides(
     
     return results
 
+@app.get("/prices/staleness")
+def get_price_staleness_api(min_days: int = 0, db: Session = Depends(get_db)):
+    """Last real price per instrument and the trading days it has been carried
+    forward, as of the last price ETL run; min_days filters to staler ones"""
+    return price_staleness.get_price_staleness(db, min_days)
+
+@app.get("/prices/quarantine")
+def get_quarantined_prices_api(instrument_id: Optional[int] = None, db: Session = Depends(get_db)):
+    """Fetched prices the price checks held back, with the reason"""
+    return [
+        {
+            "id": held.id,
+            "instrument_id": held.instrument_id,
+            "instrument_name": held.instrument.name,
+            "price_date": held.price_date.isoformat(),
+            "price": float(held.price),
+            "currency": held.currency,
+            "source": held.source,
+            "reason": held.reason,
+            "detected_at": held.detected_at.isoformat() if held.detected_at else None
+        }
+        for held in crud.get_quarantined_prices(db, instrument_id)
+    ]
+
+@app.post("/prices/quarantine/{quarantine_id}/release")
+def release_quarantined_price_api(quarantine_id: int, db: Session = Depends(get_db)):
+    """Accept a quarantined price: it is stored in prices and used from now on"""
+    try:
+        price = crud.release_quarantined_price(db, quarantine_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if price is None:
+        raise HTTPException(status_code=404, detail="Quarantined price not found")
+    return {
+        "id": price.id,
+        "instrument_id": price.instrument_id,
+        "price_date": price.price_date.isoformat(),
+        "price": float(price.price),
+        "source": price.source
+    }
+
+@app.delete("/prices/quarantine/{quarantine_id}")
+def discard_quarantined_price_api(quarantine_id: int, db: Session = Depends(get_db)):
+    """Discard a quarantined price"""
+    if not crud.discard_quarantined_price(db, quarantine_id):
+        raise HTTPException(status_code=404, detail="Quarantined price not found")
+    return {"message": "Quarantined price discarded"}
+
 # ===== INSTRUMENT ENDPOINTS =====
 
 @app.post("/instruments")
@@ -520,12 +641,18 @@ def create_wealth_value_api(value: WealthValueCreate, db: Session = Depends(get_
 def get_wealth_values_api(
     value_date: str,
     category_type: Optional[str] = None,
+    as_of: bool = False,
     db: Session = Depends(get_db)
 ):
-    """Get all wealth values for a specific date"""
+    """Get all wealth values for a specific date
+
+    With as_of=true, each category's latest value on or before the date.
+    """
     try:
         from datetime import datetime
         date_obj = datetime.strptime(value_date, "%Y-%m-%d").date()
+        if as_of:
+            return wealth_crud.get_wealth_values_as_of(db, date_obj, category_type)
         return wealth_crud.get_wealth_values(db, date_obj, category_type)
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -624,10 +751,14 @@ def delete_wealth_value_api(value_id: int, db: Session = Depends(get_db)):
 @app.get("/wealth/total/{snapshot_date}")
 def get_total_wealth_api(
     snapshot_date: str,
-    portfolio_id: int = 1,
+    portfolio_id: Optional[List[int]] = Query(None),
     db: Session = Depends(get_db)
 ):
-    """Get total wealth (portfolio + other assets - liabilities)"""
+    """Get total wealth (portfolios + other assets - liabilities)
+
+    Consolidates every portfolio, or those given as repeated portfolio_id
+    parameters, with per-portfolio subtotals.
+    """
     try:
         from datetime import datetime
         date_obj = datetime.strptime(snapshot_date, "%Y-%m-%d").date()
@@ -636,19 +767,49 @@ def get_total_wealth_api(
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+@app.get("/wealth/attribution")
+def get_wealth_attribution_api(
+    start_date: str,
+    end_date: str,
+    portfolio_id: Optional[List[int]] = Query(None),
+    db: Session = Depends(get_db)
+):
+    """Change in value between two dates, per instrument and wealth category,
+    split into quantity, price and FX effects (HUF)"""
+    try:
+        from datetime import datetime
+        start = datetime.strptime(start_date, "%Y-%m-%d").date()
+        end = datetime.strptime(end_date, "%Y-%m-%d").date()
+        
+        return attribution.valuation_attribution(db, start, end, portfolio_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 @app.post("/wealth/snapshot/{snapshot_date}")
 def save_wealth_snapshot_api(
     snapshot_date: str,
-    portfolio_id: int = 1,
+    portfolio_id: Optional[List[int]] = Query(None),
     db: Session = Depends(get_db)
 ):
-    """Calculate and save total wealth snapshot"""
+    """Calculate and save the total wealth snapshot of a date
+
+    There is one snapshot per date, consolidated over every portfolio, so a
+    subset of portfolio_id values is rejected (use /wealth/total to see a
+    subset without saving it).
+    """
     try:
         from datetime import datetime
         date_obj = datetime.strptime(snapshot_date, "%Y-%m-%d").date()
         
+        if portfolio_id and set(portfolio_id) != {pid for pid, in db.query(models.Portfolio.id)}:
+            raise ValueError("Snapshots cover every portfolio; a subset would overwrite the consolidated snapshot")
+        
         # Calculate total wealth
-        wealth_data = wealth_crud.calculate_total_wealth(db, date_obj, portfolio_id)
+        wealth_data = wealth_crud.calculate_total_wealth(db, date_obj)
+        if wealth_data['unconverted']:
+            # Totals without these categories would be stored as if complete
+            currencies = sorted({c['currency'] for c in wealth_data['unconverted']})
+            raise ValueError(f"No FX rates for {', '.join(currencies)}; snapshot not saved")
         
         # Save snapshot
         snapshot = wealth_crud.save_total_wealth_snapshot(
@@ -669,6 +830,7 @@ def save_wealth_snapshot_api(
             "other_assets_huf": float(snapshot.other_assets_huf),
             "total_liabilities_huf": float(snapshot.total_liabilities_huf),
             "net_wealth_huf": float(snapshot.net_wealth_huf),
+            "portfolios": wealth_data['portfolios'],
             "message": "Snapshot saved successfully"
         }
     except Exception as e:
@@ -676,11 +838,17 @@ def save_wealth_snapshot_api(
 
 @app.get("/wealth/snapshots")
 def get_wealth_snapshots_api(
+    request: Request,
+    response: Response,
     start_date: Optional[str] = None,
     end_date: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
     """Get historical wealth snapshots"""
+    version = journal.current_version(db, ["total_wealth_snapshots"])
+    if not_modified(request, response, version):
+        return Response(status_code=304, headers={"ETag": response.headers["ETag"]})
+    
     try:
         from datetime import datetime
         
@@ -725,8 +893,19 @@ def get_yoy_change_api(snapshot_date: str, db: Session = Depends(get_db)):
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+_etl_lock = threading.Lock()
+
+def _run_etl_locked():
+    try:
+        from .etl.run_daily_etl import run_daily_etl
+        run_daily_etl()
+    except Exception as e:
+        print(f"ETL failed: {e}")
+    finally:
+        _etl_lock.release()
+
 @app.post("/etl/run-daily-update")
-def run_daily_update():
+def run_daily_update(background: bool = False):
     """
     Trigger the daily ETL pipeline:
     1. Fetch FX rates
@@ -735,7 +914,26 @@ def run_daily_update():
     
     This endpoint runs the complete ETL and can be called from the UI.
     Safe to run multiple times per day - idempotent operation.
+    
+    With background=true it returns immediately; follow progress on /events.
+    Only one run at a time: a second request gets 409.
     """
+    if not _etl_lock.acquire(blocking=False):
+        raise HTTPException(status_code=409, detail="Daily update is already running")
+    
+    if background:
+        try:
+            threading.Thread(target=_run_etl_locked, daemon=True).start()
+        except BaseException:
+            # The worker never ran, so its finally will not release the lock
+            _etl_lock.release()
+            raise
+        return {
+            "status": "started",
+            "message": "Daily update started, follow progress on /events",
+            "timestamp": date.today().isoformat()
+        }
+    
     try:
         from .etl.run_daily_etl import run_daily_etl
         import io
@@ -763,6 +961,22 @@ def run_daily_update():
             status_code=500,
             detail=f"ETL failed: {str(e)}"
         )
+    finally:
+        _etl_lock.release()
+
+@app.get("/events")
+async def stream_events(last_event_id: Optional[int] = Header(None)):
+    """
+    Server-sent events: ETL progress ('etl') and data changes ('data_version')
+    
+    Clients refresh when a data_version event arrives instead of polling.
+    Reconnecting with Last-Event-ID replays recently missed events.
+    """
+    return StreamingResponse(
+        events.stream(last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 @app.post("/wealth/reduce-loans")
 def manual_loan_reduction(db: Session = Depends(get_db)):
@@ -773,6 +987,33 @@ def manual_loan_reduction(db: Session = Depends(get_db)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+# ===== SYNC ENDPOINTS =====
+
+@app.get("/sync")
+def sync_changes(
+    since: int = 0,
+    tables: Optional[str] = None,
+    portfolio_id: Optional[int] = None,
+    limit: int = 5000,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db)
+):
+    """Get rows inserted, updated or deleted since a data version
+    
+    Clients store the returned version and pass it as `since` next time;
+    since=0 returns a full copy. `tables` is a comma-separated subset of
+    the synced tables. Keep calling while has_more is true, passing the
+    returned cursor when there is one (full copies are paged by cursor).
+    """
+    if since < 0 or limit < 1:
+        raise HTTPException(status_code=400, detail="since must be >= 0 and limit >= 1")
+    
+    try:
+        table_list = [t.strip() for t in tables.split(",") if t.strip()] if tables else None
+        return sync.changes_since(db, since, table_list, portfolio_id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
 if __name__ == "__main__":
     import uvicorn
     from .config import settings
@@ -0,0 +1,100 @@
+"""
+Apply additive schema changes to an existing database.
+
+Base.metadata.create_all() only creates missing tables, so new columns,
+constraints and data fixes on existing tables are listed here. Derived
+tables (maintained positions) are then rebuilt where they no longer match
+their sources. Every step is idempotent; run it after pulling changes:
+
+    python -m backend.app.migrate_schema
+"""
+import os
+import sys
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from .journal import JOURNALED_TABLES, postgres_trigger_statements
+
+# Fix Windows console encoding
+if sys.platform == 'win32':
+    sys.stdout.reconfigure(encoding='utf-8')
+    sys.stderr.reconfigure(encoding='utf-8')
+
+MIGRATIONS = [
+    (
+        "P&L columns on portfolio_values_daily",
+        [
+            "ALTER TABLE portfolio_values_daily ADD COLUMN IF NOT EXISTS cost_basis_huf NUMERIC",
+            "ALTER TABLE portfolio_values_daily ADD COLUMN IF NOT EXISTS unrealized_gain_huf NUMERIC",
+        ]
+    ),
+    (
+        "Drop materialized carried-forward prices (resolved by as-of lookup)",
+        [
+            "DELETE FROM prices WHERE source LIKE '% (carried forward)'",
+        ]
+    ),
+    (
+        "EUR value column on portfolio_values_daily",
+        [
+            "ALTER TABLE portfolio_values_daily ADD COLUMN IF NOT EXISTS value_eur NUMERIC",
+        ]
+    ),
+    (
+        "One portfolio_values_daily row per portfolio, date and instrument",
+        [
+            # Keep the most recently written row of any duplicates
+            "DELETE FROM portfolio_values_daily WHERE id NOT IN ("
+            "SELECT MAX(id) FROM portfolio_values_daily GROUP BY portfolio_id, snapshot_date, instrument_id)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS unique_portfolio_value_daily "
+            "ON portfolio_values_daily (portfolio_id, snapshot_date, instrument_id)",
+        ]
+    ),
+    (
+        "Unique pending quarantined prices",
+        [
+            # Keep the first of any duplicates
+            "DELETE FROM price_quarantine WHERE id NOT IN ("
+            "SELECT MIN(id) FROM price_quarantine GROUP BY instrument_id, price_date, source, price)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS unique_price_quarantine "
+            "ON price_quarantine (instrument_id, price_date, source, price)",
+        ]
+    ),
+    (
+        "Change journal index on (table_name, id)",
+        [
+            "CREATE INDEX IF NOT EXISTS ix_change_journal_table_id ON change_journal (table_name, id)",
+            "DROP INDEX IF EXISTS ix_change_journal_table_name",
+        ]
+    ),
+    (
+        "Change journal triggers",
+        [
+            statement
+            for table in JOURNALED_TABLES
+            for statement in postgres_trigger_statements(table)
+        ]
+    ),
+]
+
+
+def run_migrations(engine):
+    from .models import Base
+    Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as conn:
+        for description, statements in MIGRATIONS:
+            print(f"→ {description}")
+            for statement in statements:
+                conn.execute(text(statement))
+
+    from .positions import sync_position_tables
+    print("→ Maintained positions in step with the ledger")
+    with Session(bind=engine) as db:
+        sync_position_tables(db)
+    print("✓ Schema up to date")
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    run_migrations(create_engine(os.getenv('DATABASE_URL')))
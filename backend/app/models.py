@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, Numeric, Date, DateTime, ForeignKey, Text, Boolean, UniqueConstraint
+from sqlalchemy import Column, Integer, BigInteger, String, Numeric, Date, DateTime, ForeignKey, Text, Boolean, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .db import Base
+from .journal import attach_triggers
 
 class Instrument(Base):
     __tablename__ = 'instruments'
@@ -58,6 +59,40 @@ class Price(Base):
     
     instrument = relationship("Instrument", back_populates="prices")
 
+class PriceQuarantine(Base):
+    """Fetched prices held back by the price checks; never used for valuation"""
+    __tablename__ = 'price_quarantine'
+    
+    id = Column(Integer, primary_key=True)
+    instrument_id = Column(Integer, ForeignKey('instruments.id'), nullable=False)
+    price_date = Column(Date, nullable=False)
+    price = Column(Numeric, nullable=False)
+    currency = Column(String(3))
+    source = Column(String)
+    reason = Column(Text, nullable=False)
+    detected_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    
+    instrument = relationship("Instrument")
+    
+    # Refetching the same price (re-runs of the ETL) must not queue it twice
+    __table_args__ = (
+        UniqueConstraint('instrument_id', 'price_date', 'source', 'price', name='unique_price_quarantine'),
+    )
+
+class PriceStaleness(Base):
+    """Per instrument: last real price and how many trading days it has been
+    carried forward, as of checked_date; maintained by the price ETL"""
+    __tablename__ = 'price_staleness'
+    
+    instrument_id = Column(Integer, ForeignKey('instruments.id'), primary_key=True)
+    last_price_date = Column(Date)
+    last_price_source = Column(String)
+    days_carried_forward = Column(Integer)
+    checked_date = Column(Date, nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    instrument = relationship("Instrument")
+
 class FxRate(Base):
     __tablename__ = 'fx_rates'
     
@@ -81,8 +116,18 @@ class PortfolioValueDaily(Base):
     instrument_currency = Column(String(3), nullable=False)
     fx_rate = Column(Numeric, nullable=False)
     value_huf = Column(Numeric, nullable=False)
-    value_huf_usd = Column(Numeric)
+    value_huf_usd = Column(Numeric)  # value_huf in USD
+    value_eur = Column(Numeric)      # value_huf in EUR
+    cost_basis_huf = Column(Numeric)
+    unrealized_gain_huf = Column(Numeric)
     calculated_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('portfolio_id', 'snapshot_date', 'instrument_id', name='unique_portfolio_value_daily'),
+    )
+
+# Stored portfolio_values_daily column per reporting currency
+VALUE_COLUMNS = {'HUF': 'value_huf', 'USD': 'value_huf_usd', 'EUR': 'value_eur'}
 
 class DataSource(Base):
     __tablename__ = 'data_sources'
@@ -112,6 +157,69 @@ class Transaction(Base):
     portfolio = relationship("Portfolio")
     instrument = relationship("Instrument")
 
+class PositionCurrent(Base):
+    __tablename__ = 'positions_current'
+    
+    id = Column(Integer, primary_key=True)
+    portfolio_id = Column(Integer, ForeignKey('portfolios.id'), nullable=False)
+    instrument_id = Column(Integer, ForeignKey('instruments.id'), nullable=False)
+    quantity = Column(Numeric, nullable=False)
+    last_change_date = Column(Date)
+    updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('portfolio_id', 'instrument_id', name='unique_position_current'),
+    )
+
+class PositionHistory(Base):
+    """Step series of quantities: quantity holds from effective_date until the next step"""
+    __tablename__ = 'positions_history'
+    
+    id = Column(Integer, primary_key=True)
+    portfolio_id = Column(Integer, ForeignKey('portfolios.id'), nullable=False)
+    instrument_id = Column(Integer, ForeignKey('instruments.id'), nullable=False)
+    effective_date = Column(Date, nullable=False)
+    quantity = Column(Numeric, nullable=False)
+    
+    __table_args__ = (
+        UniqueConstraint('portfolio_id', 'instrument_id', 'effective_date', name='unique_position_step'),
+    )
+
+class PositionVersion(Base):
+    """Ledger journal version the maintained positions of a portfolio reflect"""
+    __tablename__ = 'positions_version'
+    
+    portfolio_id = Column(Integer, ForeignKey('portfolios.id'), primary_key=True)
+    ledger_version = Column(BigInteger().with_variant(Integer, 'sqlite'), nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class RevaluationQueue(Base):
+    """Stored values that went stale from from_date on; NULL portfolio/instrument means all"""
+    __tablename__ = 'revaluation_queue'
+    
+    id = Column(Integer, primary_key=True)
+    portfolio_id = Column(Integer, ForeignKey('portfolios.id'))
+    instrument_id = Column(Integer, ForeignKey('instruments.id'))
+    from_date = Column(Date, nullable=False)
+    reason = Column(String(50))
+    created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+
+class ChangeJournal(Base):
+    """Append-only change log; id is the data version"""
+    __tablename__ = 'change_journal'
+    
+    id = Column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True)
+    table_name = Column(String(64), nullable=False)
+    row_id = Column(Integer)
+    operation = Column(String(10), nullable=False)  # insert, update, delete
+    portfolio_id = Column(Integer, index=True)
+    changed_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+    
+    __table_args__ = (
+        # Latest version per table is a backward scan of one index range
+        Index('ix_change_journal_table_id', 'table_name', 'id'),
+    )
+
 class ManualPrice(Base):
     __tablename__ = 'manual_prices'
     
@@ -174,3 +282,5 @@ class TotalWealthSnapshot(Base):
     pension_huf = Column(Numeric(20, 2), default=0)
     other_huf = Column(Numeric(20, 2), default=0)
     created_at = Column(DateTime(timezone=True), default=datetime.utcnow)
+
+attach_triggers(Base.metadata)
@@ -0,0 +1,414 @@
+"""
+Transaction-ledger position engine
+
+Derives the quantity held per (portfolio, instrument) on any date from the
+transactions table instead of the static Holding.quantity.
+
+Model:
+- Holding.quantity is the opening balance, effective from
+  Holding.acquisition_date (or from the beginning of time if not set)
+- BUY adds quantity, SELL removes it, ADJUST is a signed correction
+- The running quantity is a cumulative sum over the ledger, stored as a
+  compact step series: one (date, quantity) point per date on which the
+  position changed
+
+The step series is materialized in positions_history (with the latest
+quantity in positions_current) and patched incrementally as transactions
+are added through crud.py, so valuation never has to replay the full
+ledger. positions_version stamps each portfolio's tables with the ledger
+journal version they reflect. Writes that bypass apply_transactions (the
+mobile app, holdings edits, importers) move the ledger version on, and
+reads then replay the ledger instead of trusting the tables; reads never
+write. sync_position_tables rebuilds out-of-date portfolios, from the daily
+ETL and from migrate_schema.py.
+"""
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from sqlalchemy import delete, func, insert, update
+from sqlalchemy.orm import Session
+from . import models
+from .db import SessionLocal, dialect_insert
+from .journal import current_version, settled_version
+
+# Tables a portfolio's positions are derived from
+LEDGER_TABLES = ('transactions', 'holdings')
+
+# Direction applied to Transaction.quantity for each transaction type
+TRANSACTION_SIGNS = {
+    'BUY': 1,
+    'SELL': -1,
+    'ADJUST': 1
+}
+
+# Sentinel for holdings without an acquisition date
+_BEGINNING = np.datetime64('1900-01-01', 'D')
+
+
+def signed_quantity(transaction_type: str, quantity) -> Decimal:
+    """Quantity change a transaction applies to its position"""
+    sign = TRANSACTION_SIGNS.get((transaction_type or '').upper())
+    if sign is None:
+        raise ValueError(f"Unknown transaction type: {transaction_type}")
+    return Decimal(str(quantity)) * sign
+
+
+def _to_day(value) -> np.datetime64:
+    return np.datetime64(value, 'D')
+
+
+class PositionSeries:
+    """Quantity of one instrument in one portfolio as a step function of date
+
+    dates[i] is the first day on which quantities[i] is held; before dates[0]
+    the position is zero.
+    """
+    __slots__ = ('dates', 'quantities')
+
+    def __init__(self, dates: np.ndarray, quantities: np.ndarray):
+        self.dates = dates
+        self.quantities = quantities
+
+    @classmethod
+    def from_deltas(cls, dates: List[date], deltas: List[Decimal]) -> 'PositionSeries':
+        """Build a series from unsorted (date, signed quantity) ledger entries"""
+        if not dates:
+            return cls(np.array([], dtype='datetime64[D]'), np.array([], dtype=object))
+
+        day_array = np.array([_to_day(d) for d in dates], dtype='datetime64[D]')
+        delta_array = np.array(deltas, dtype=object)
+
+        # Stable sort keeps same-day entries in ledger order
+        order = np.argsort(day_array, kind='stable')
+        day_array = day_array[order]
+        running = np.cumsum(delta_array[order])
+
+        # Keep only the last running total for each day
+        last_of_day = np.append(day_array[1:] != day_array[:-1], True)
+        return cls(day_array[last_of_day], running[last_of_day])
+
+    def quantity_on(self, as_of: date) -> Decimal:
+        """Quantity held at the end of as_of"""
+        idx = np.searchsorted(self.dates, _to_day(as_of), side='right') - 1
+        return self.quantities[idx] if idx >= 0 else Decimal('0')
+
+    def quantities_on(self, as_of_dates: Iterable[date]) -> np.ndarray:
+        """Vectorized quantity_on for many dates"""
+        days = np.array([_to_day(d) for d in as_of_dates], dtype='datetime64[D]')
+        idx = np.searchsorted(self.dates, days, side='right') - 1
+        result = np.full(len(days), Decimal('0'), dtype=object)
+        held = idx >= 0
+        result[held] = self.quantities[idx[held]]
+        return result
+
+    def first_date(self) -> Optional[date]:
+        return self.dates[0].astype(date) if len(self.dates) else None
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __repr__(self):
+        return f"PositionSeries({len(self)} steps)"
+
+
+def load_ledger(
+    db: Session,
+    portfolio_id: int,
+    instrument_ids: Optional[Iterable[int]] = None
+) -> Dict[int, Tuple[List[date], List[Decimal]]]:
+    """Opening balances and transactions per instrument as (dates, deltas)"""
+    ledger: Dict[int, Tuple[List[date], List[Decimal]]] = {}
+
+    holdings = db.query(
+        models.Holding.instrument_id,
+        models.Holding.quantity,
+        models.Holding.acquisition_date
+    ).filter(models.Holding.portfolio_id == portfolio_id)
+
+    transactions = db.query(
+        models.Transaction.instrument_id,
+        models.Transaction.transaction_date,
+        models.Transaction.transaction_type,
+        models.Transaction.quantity
+    ).filter(models.Transaction.portfolio_id == portfolio_id)
+
+    if instrument_ids is not None:
+        instrument_ids = list(instrument_ids)
+        holdings = holdings.filter(models.Holding.instrument_id.in_(instrument_ids))
+        transactions = transactions.filter(models.Transaction.instrument_id.in_(instrument_ids))
+
+    # Opening balances first so same-day transactions apply on top of them
+    for instrument_id, quantity, acquisition_date in holdings.all():
+        dates, deltas = ledger.setdefault(instrument_id, ([], []))
+        dates.append(acquisition_date or _BEGINNING.astype(date))
+        deltas.append(Decimal(str(quantity)))
+
+    for instrument_id, tx_date, tx_type, quantity in transactions.order_by(
+        models.Transaction.transaction_date, models.Transaction.id
+    ).all():
+        dates, deltas = ledger.setdefault(instrument_id, ([], []))
+        dates.append(tx_date)
+        deltas.append(signed_quantity(tx_type, quantity))
+
+    return ledger
+
+
+def build_position_series(
+    db: Session,
+    portfolio_id: int,
+    instrument_ids: Optional[Iterable[int]] = None
+) -> Dict[int, PositionSeries]:
+    """Step series per instrument for a portfolio, from the full ledger"""
+    return {
+        instrument_id: PositionSeries.from_deltas(dates, deltas)
+        for instrument_id, (dates, deltas) in load_ledger(db, portfolio_id, instrument_ids).items()
+    }
+
+
+def positions_as_of(series: Dict[int, PositionSeries], as_of: date) -> Dict[int, Decimal]:
+    """Non-zero quantities per instrument at the end of as_of"""
+    positions = {}
+    for instrument_id, steps in series.items():
+        quantity = steps.quantity_on(as_of)
+        if quantity != 0:
+            positions[instrument_id] = quantity
+    return positions
+
+
+def get_positions(db: Session, portfolio_id: int, as_of: date) -> Dict[int, Decimal]:
+    """Quantity per instrument held in a portfolio on a date"""
+    return positions_as_of(build_position_series(db, portfolio_id), as_of)
+
+
+# ==================== MAINTAINED POSITION TABLES ====================
+
+def _ledger_version(db: Session, portfolio_id: int) -> int:
+    """Journal version of the portfolio's ledger, like cost_basis uses"""
+    return current_version(db, LEDGER_TABLES, portfolio_id)
+
+
+def _stored_version(db: Session, portfolio_id: int) -> Optional[int]:
+    """Ledger version the maintained positions reflect; None if never built"""
+    return db.query(models.PositionVersion.ledger_version).filter(
+        models.PositionVersion.portfolio_id == portfolio_id
+    ).scalar()
+
+
+def _stamp(db: Session, portfolio_id: int, version: int):
+    stmt = dialect_insert(db, models.PositionVersion).values(
+        portfolio_id=portfolio_id, ledger_version=version, updated_at=datetime.utcnow()
+    )
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=['portfolio_id'],
+        set_={'ledger_version': stmt.excluded.ledger_version, 'updated_at': stmt.excluded.updated_at}
+    ))
+
+
+def rebuild_position_tables(db: Session, portfolio_id: int) -> Dict[int, PositionSeries]:
+    """Replace a portfolio's maintained positions with a full ledger replay
+
+    Stamped with the ledger version read before the replay, so a change
+    landing meanwhile leaves the stamp behind rather than being missed.
+    Does not commit; runs inside the caller's transaction.
+    """
+    version = _ledger_version(db, portfolio_id)
+    series = build_position_series(db, portfolio_id)
+
+    db.execute(delete(models.PositionHistory).where(models.PositionHistory.portfolio_id == portfolio_id))
+    db.execute(delete(models.PositionCurrent).where(models.PositionCurrent.portfolio_id == portfolio_id))
+
+    history_rows = [
+        {
+            'portfolio_id': portfolio_id,
+            'instrument_id': instrument_id,
+            'effective_date': day.astype(date),
+            'quantity': quantity
+        }
+        for instrument_id, steps in series.items()
+        for day, quantity in zip(steps.dates, steps.quantities)
+    ]
+    current_rows = [
+        {
+            'portfolio_id': portfolio_id,
+            'instrument_id': instrument_id,
+            'quantity': steps.quantities[-1],
+            'last_change_date': steps.dates[-1].astype(date)
+        }
+        for instrument_id, steps in series.items() if len(steps)
+    ]
+    if history_rows:
+        db.execute(insert(models.PositionHistory), history_rows)
+    if current_rows:
+        db.execute(insert(models.PositionCurrent), current_rows)
+    _stamp(db, portfolio_id, version)
+
+    return series
+
+
+def _version_before(db: Session, portfolio_id: int, stamp: int, transaction_ids: List[int]) -> int:
+    """Ledger version just before the given (flushed) transactions were journaled"""
+    journal = models.ChangeJournal
+    first_own = db.query(func.min(journal.id)).filter(
+        journal.id > stamp,
+        journal.table_name == 'transactions',
+        journal.row_id.in_(transaction_ids)
+    ).scalar()
+    query = db.query(func.max(journal.id)).filter(
+        journal.table_name.in_(LEDGER_TABLES),
+        (journal.portfolio_id == portfolio_id) | (journal.portfolio_id == None)
+    )
+    if first_own is not None:
+        query = query.filter(journal.id < first_own)
+    version = query.scalar() or 0
+    settled = settled_version(db)
+    return version if settled is None else min(version, settled)
+
+
+def _greatest(db: Session, a, b):
+    """GREATEST(a, b); SQLite spells it as the two-argument MAX"""
+    if db.get_bind().dialect.name == 'sqlite':
+        return func.max(a, b)
+    return func.greatest(a, b)
+
+
+def _patch_position(db: Session, portfolio_id: int, instrument_id: int, from_date: date, delta: Decimal):
+    """Apply a quantity change to every step on or after from_date"""
+    steps = models.PositionHistory
+
+    # Make sure a step starts exactly on from_date, carrying the prior quantity
+    previous = db.query(steps.quantity).filter(
+        steps.portfolio_id == portfolio_id,
+        steps.instrument_id == instrument_id,
+        steps.effective_date < from_date
+    ).order_by(steps.effective_date.desc()).limit(1).scalar()
+
+    db.execute(
+        dialect_insert(db, steps).values(
+            portfolio_id=portfolio_id,
+            instrument_id=instrument_id,
+            effective_date=from_date,
+            quantity=previous if previous is not None else Decimal('0')
+        ).on_conflict_do_nothing(
+            index_elements=['portfolio_id', 'instrument_id', 'effective_date']
+        )
+    )
+
+    # Only the affected date range is touched
+    db.execute(
+        update(steps).where(
+            steps.portfolio_id == portfolio_id,
+            steps.instrument_id == instrument_id,
+            steps.effective_date >= from_date
+        ).values(quantity=steps.quantity + delta)
+    )
+
+    current = models.PositionCurrent
+    stmt = dialect_insert(db, current).values(
+        portfolio_id=portfolio_id,
+        instrument_id=instrument_id,
+        quantity=delta,
+        last_change_date=from_date,
+        updated_at=datetime.utcnow()
+    )
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=['portfolio_id', 'instrument_id'],
+            set_={
+                'quantity': current.quantity + stmt.excluded.quantity,
+                'last_change_date': _greatest(db, current.last_change_date, stmt.excluded.last_change_date),
+                'updated_at': stmt.excluded.updated_at
+            }
+        )
+    )
+
+
+def apply_transactions(db: Session, transactions: Iterable[models.Transaction]):
+    """Update maintained positions for newly inserted transactions
+
+    The transactions must already be flushed. Same-day changes to one
+    position are merged into a single patch. Does not commit.
+    """
+    deltas: Dict[Tuple[int, int, date], Decimal] = {}
+    portfolios: Dict[int, List[int]] = {}
+    for tx in transactions:
+        key = (tx.portfolio_id, tx.instrument_id, tx.transaction_date)
+        deltas[key] = deltas.get(key, Decimal('0')) + signed_quantity(tx.transaction_type, tx.quantity)
+        portfolios.setdefault(tx.portfolio_id, []).append(tx.id)
+
+    # Patching is only valid on top of tables that matched the ledger before
+    # these transactions; otherwise rebuild from the ledger, which already
+    # contains them
+    rebuilt = set()
+    for portfolio_id, transaction_ids in portfolios.items():
+        stamp = _stored_version(db, portfolio_id)
+        if stamp is None or stamp != _version_before(db, portfolio_id, stamp, transaction_ids):
+            rebuild_position_tables(db, portfolio_id)
+            rebuilt.add(portfolio_id)
+
+    for (portfolio_id, instrument_id, tx_date), delta in sorted(deltas.items()):
+        if portfolio_id not in rebuilt and delta != 0:
+            _patch_position(db, portfolio_id, instrument_id, tx_date, delta)
+    for portfolio_id in portfolios.keys() - rebuilt:
+        _stamp(db, portfolio_id, _ledger_version(db, portfolio_id))
+
+
+def sync_position_tables(db: Session, portfolio_ids: Optional[Iterable[int]] = None) -> int:
+    """Rebuild maintained positions that no longer match the ledger
+
+    Commits per portfolio. Returns the number of portfolios rebuilt.
+    """
+    if portfolio_ids is None:
+        portfolio_ids = [p.id for p in db.query(models.Portfolio.id)]
+    rebuilt = 0
+    for portfolio_id in portfolio_ids:
+        if _stored_version(db, portfolio_id) != _ledger_version(db, portfolio_id):
+            rebuild_position_tables(db, portfolio_id)
+            db.commit()
+            rebuilt += 1
+    return rebuilt
+
+
+def run_position_sync():
+    """Bring every portfolio's maintained positions up to date with the ledger"""
+    db = SessionLocal()
+    try:
+        rebuilt = sync_position_tables(db)
+        print(f"✓ Rebuilt maintained positions of {rebuilt} portfolios")
+    finally:
+        db.close()
+
+
+def load_position_series(db: Session, portfolio_id: int) -> Dict[int, PositionSeries]:
+    """Step series per instrument from the maintained positions table
+
+    Replays the ledger instead when the table is missing or behind it;
+    never writes.
+    """
+    if _stored_version(db, portfolio_id) != _ledger_version(db, portfolio_id):
+        return build_position_series(db, portfolio_id)
+
+    rows = db.query(
+        models.PositionHistory.instrument_id,
+        models.PositionHistory.effective_date,
+        models.PositionHistory.quantity
+    ).filter(
+        models.PositionHistory.portfolio_id == portfolio_id
+    ).order_by(
+        models.PositionHistory.instrument_id,
+        models.PositionHistory.effective_date
+    ).all()
+
+    grouped: Dict[int, Tuple[List[date], List[Decimal]]] = {}
+    for instrument_id, effective_date, quantity in rows:
+        dates, quantities = grouped.setdefault(instrument_id, ([], []))
+        dates.append(effective_date)
+        quantities.append(Decimal(str(quantity)))
+
+    return {
+        instrument_id: PositionSeries(
+            np.array(dates, dtype='datetime64[D]'),
+            np.array(quantities, dtype=object)
+        )
+        for instrument_id, (dates, quantities) in grouped.items()
+    }
@@ -0,0 +1,113 @@
+"""
+Sanity checks for freshly fetched prices, before they are stored
+
+Scrapers can misparse a page (another number in a matching <h2>, a bold
+span that is not the price) and a wrong price silently flows into every
+valuation. Each batch of new prices is checked against the recent automatic
+prices of its instrument in the price index, all instruments at once:
+
+- currency:  the page quoted a different currency than the instrument's
+- jump:      the price moved by more than MAX_JUMP× from the last price
+- z-score:   the log return from the last price is more than MAX_ZSCORE
+             standard deviations from the instrument's recent returns,
+             scaled by the gap since the last price
+
+Instruments with fewer than MIN_RETURNS returns of history skip the z-score
+(the jump and currency checks still apply). Failing prices are quarantined
+by the price ETL instead of written to prices. A reviewed price can be
+released into prices (crud.release_quarantined_price, POST
+/prices/quarantine/{id}/release), after which later fetches are checked
+against it, e.g. after a split.
+"""
+from datetime import date
+from typing import List, NamedTuple, Optional
+import numpy as np
+from sqlalchemy.orm import Session
+from .price_index import get_price_index
+
+HISTORY = 60          # recent prices per instrument the checks look at
+MIN_RETURNS = 10      # returns needed before the z-score applies
+MAX_ZSCORE = 6.0
+MAX_JUMP = 3.0        # new / last price ratio, either direction
+MIN_VOLATILITY = 0.005  # floor on the per-price-step log return deviation
+
+
+class PriceCandidate(NamedTuple):
+    instrument_id: int
+    price_date: date
+    price: float
+    currency: Optional[str]   # as quoted by the source, None if unknown
+    expected_currency: str    # the instrument's currency
+
+
+def check_prices(db: Session, candidates: List[PriceCandidate]) -> List[Optional[str]]:
+    """Reason each candidate looks wrong ('; '-joined), or None if it passes"""
+    index = get_price_index(db)
+
+    # Recent history of every candidate, flattened into one array with group ids
+    days, prices, groups = [], [], []
+    for k, candidate in enumerate(candidates):
+        auto, _, _ = index.curves(candidate.instrument_id)
+        if auto is None:
+            continue
+        curve_days, curve_prices = auto
+        end = np.searchsorted(curve_days, np.datetime64(candidate.price_date, 'D'), side='left')
+        start = max(0, end - HISTORY)
+        days.append(curve_days[start:end])
+        prices.append(curve_prices[start:end].astype(float))
+        groups.append(np.full(end - start, k))
+
+    n = len(candidates)
+    new = np.array([float(c.price) for c in candidates])
+    reasons = [[] for _ in candidates]
+
+    if days:
+        days = np.concatenate(days).astype('int64')
+        prices = np.concatenate(prices)
+        groups = np.concatenate(groups)
+    else:
+        # Sentinel row, masked out below
+        days, prices, groups = np.zeros(1, 'int64'), np.zeros(1), np.full(1, n)
+
+    counts = np.bincount(groups, minlength=n)[:n]
+    has_history = counts > 0
+    first_idx = np.minimum(np.cumsum(counts) - counts, len(prices) - 1)
+    last_idx = np.maximum(first_idx + counts - 1, 0)
+    last_price = np.where(has_history, prices[last_idx], np.nan)
+    last_day = days[last_idx]
+    first_day = days[first_idx]
+
+    # Log returns within each group (positions whose predecessor is in the same group)
+    valid = prices > 0
+    same = np.zeros(len(prices), dtype=bool)
+    same[1:] = (groups[1:] == groups[:-1]) & valid[1:] & valid[:-1]
+    log_prices = np.log(np.where(valid, prices, 1.0))
+    returns = np.zeros(len(prices))
+    returns[1:] = log_prices[1:] - log_prices[:-1]
+    n_returns = np.bincount(groups[same], minlength=n)[:n]
+    sums = np.bincount(groups[same], weights=returns[same], minlength=n)[:n]
+    squares = np.bincount(groups[same], weights=returns[same] ** 2, minlength=n)[:n]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / n_returns
+        std = np.sqrt(np.maximum(squares / n_returns - mean ** 2, 0.0))
+        sigma = np.maximum(std, MIN_VOLATILITY)
+        # Scale to the gap since the last price, in typical steps of this instrument
+        step = (last_day - first_day) / n_returns
+        gap = (np.array([np.datetime64(c.price_date, 'D').astype('int64') for c in candidates]) - last_day) / step
+        sigma = sigma * np.sqrt(np.maximum(gap, 1.0))
+
+        usable = has_history & (last_price > 0) & (new > 0)
+        ratio = np.where(usable, new / last_price, 1.0)
+        jump = np.maximum(ratio, 1.0 / ratio)
+        zscore = np.where(usable & (n_returns >= MIN_RETURNS), np.abs(np.log(ratio) - mean) / sigma, 0.0)
+
+    for k, candidate in enumerate(candidates):
+        if not new[k] > 0:
+            reasons[k].append(f"non-positive price {candidate.price}")
+        if candidate.currency and candidate.currency != candidate.expected_currency:
+            reasons[k].append(f"quoted in {candidate.currency}, instrument is {candidate.expected_currency}")
+        if jump[k] > MAX_JUMP:
+            reasons[k].append(f"{jump[k]:.1f}x jump from last price {last_price[k]:g}")
+        if zscore[k] > MAX_ZSCORE:
+            reasons[k].append(f"return z-score {zscore[k]:.1f}")
+    return ['; '.join(found) or None for found in reasons]
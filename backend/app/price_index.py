@@ -0,0 +1,255 @@
+"""
+Process-level as-of price index
+
+Keeps every price and manual override in memory as per-instrument arrays
+sorted by date, so "latest price on or before a date" is a bisect instead
+of a query. Three series are kept per instrument, matching the precedence
+of get_latest_price:
+
+- auto:   prices from a real source (source set and not 'test')
+- manual: manual_prices overrides
+- any:    all prices, the test-data fallback
+
+Rows the price ETL used to write when a scraper failed, copies of the last
+price under "<source> (carried forward)", are ignored: carrying a price
+forward is the as-of lookup itself, and PriceHit.price_date shows how old
+the price is.
+
+The index loads lazily on first use. Afterwards each get_price_index() call
+replays change_journal entries for prices and manual_prices since the last
+version it saw, so inserts, updates and deletes from any writer (ETL, API,
+importers, the mobile app) are picked up without reloading. Refreshes read
+committed rows only, through a short-lived session of their own.
+"""
+import threading
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+import numpy as np
+from sqlalchemy.orm import Session
+from . import models
+from .db import committed_reader
+from .journal import current_version, first_version
+
+PRICE_TABLES = ('prices', 'manual_prices')
+CARRIED_FORWARD_SUFFIX = ' (carried forward)'
+
+
+class PriceHit(NamedTuple):
+    price: Decimal
+    price_date: date
+    kind: str     # 'auto', 'manual' or 'test'
+    source: str   # price source, or who entered a manual price
+
+    @property
+    def label(self) -> str:
+        """Provenance as shown to users"""
+        return f"manual ({self.source or 'user'})" if self.kind == 'manual' else self.source
+
+
+class _Series:
+    """Rows of one instrument and kind, with date-sorted lookup arrays"""
+    __slots__ = ('rows', 'arrays', '_curve')
+
+    def __init__(self):
+        self.rows: Dict[int, tuple] = {}
+        self.arrays = ([], [], [])
+        self._curve = None
+
+    def rebuild(self):
+        # Sorted by (date, id): the last row of a date wins, like load_latest_prices
+        ordered = sorted((day, row_id, price, source) for row_id, (day, price, source) in self.rows.items())
+        # Swapped in one assignment so concurrent readers never see a mix
+        self.arrays = ([r[0] for r in ordered], [r[2] for r in ordered], [r[3] for r in ordered])
+        self._curve = None
+
+    def hit(self, as_of: date):
+        dates, prices, sources = self.arrays
+        i = bisect_right(dates, as_of)
+        return (prices[i - 1], dates[i - 1], sources[i - 1]) if i else None
+
+    def curve(self) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """(datetime64[D] dates, Decimal prices) for vectorized as-of lookups"""
+        dates, prices, _ = self.arrays
+        if not dates:
+            return None
+        if self._curve is None:
+            self._curve = (np.array(dates, dtype='datetime64[D]'), np.array(prices, dtype=object))
+        return self._curve
+
+
+class PriceIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def __getstate__(self):
+        # Picklable for worker processes; the lock is per process
+        return {k: v for k, v in self.__dict__.items() if k != '_lock'}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Forget everything; the next refresh reloads from the database"""
+        self._series: Dict[Tuple[str, int], _Series] = {}
+        self._row_keys: Dict[Tuple[str, int], Tuple[int, ...]] = {}
+        self.version: Optional[int] = None
+
+    # ----- loading -----
+
+    def _store_price(self, row_id, instrument_id, day, price, source):
+        if source and source.endswith(CARRIED_FORWARD_SUFFIX):
+            self._drop('prices', row_id)
+            return
+        kinds = ('any', 'auto') if source is not None and source != 'test' else ('any',)
+        self._store('prices', row_id, instrument_id, kinds, (day, price, source))
+
+    def _store(self, table, row_id, instrument_id, kinds, row):
+        self._drop(table, row_id)
+        for kind in kinds:
+            self._series.setdefault((kind, instrument_id), _Series()).rows[row_id] = row
+        self._row_keys[(table, row_id)] = (instrument_id, *kinds)
+
+    def _drop(self, table, row_id):
+        key = self._row_keys.pop((table, row_id), None)
+        if key:
+            instrument_id, *kinds = key
+            for kind in kinds:
+                self._series[(kind, instrument_id)].rows.pop(row_id, None)
+
+    def _load(self, db: Session, price_ids=None, manual_ids=None):
+        prices = db.query(
+            models.Price.id, models.Price.instrument_id, models.Price.price_date,
+            models.Price.price, models.Price.source
+        )
+        manual = db.query(
+            models.ManualPrice.id, models.ManualPrice.instrument_id, models.ManualPrice.override_date,
+            models.ManualPrice.price, models.ManualPrice.created_by
+        )
+        if price_ids is not None:
+            prices = prices.filter(models.Price.id.in_(price_ids)) if price_ids else []
+        if manual_ids is not None:
+            manual = manual.filter(models.ManualPrice.id.in_(manual_ids)) if manual_ids else []
+
+        touched = set()
+        for row_id, instrument_id, day, price, source in prices:
+            self._store_price(row_id, instrument_id, day, price, source)
+            touched.add(instrument_id)
+        for row_id, instrument_id, day, price, created_by in manual:
+            self._store('manual_prices', row_id, instrument_id, ('manual',), (day, price, created_by))
+            touched.add(instrument_id)
+        return touched
+
+    def refresh(self, db: Session):
+        """Bring the index up to the current journal version
+
+        Reads through a session of its own, so rows the caller has not
+        committed never reach the shared index.
+        """
+        with committed_reader(db) as reader:
+            self._refresh(reader)
+
+    def _refresh(self, db: Session):
+        version = current_version(db, PRICE_TABLES)
+        if version == self.version:
+            return
+
+        with self._lock:
+            if version == self.version:
+                return
+            if self.version is None or version < self.version or (first_version(db) or 0) > self.version + 1:
+                # First use, a different / reset database, or entries since
+                # the last refresh were pruned from the journal. Loaded off
+                # to the side: lookups keep reading the old series (they do
+                # not take the lock) until the new ones are swapped in.
+                fresh = PriceIndex()
+                fresh._load(db)
+                for series in fresh._series.values():
+                    series.rebuild()
+                self._row_keys = fresh._row_keys
+                self._series = fresh._series
+            else:
+                touched = self._replay(db, self.version)
+                for (kind, instrument_id), series in self._series.items():
+                    if instrument_id in touched:
+                        series.rebuild()
+            self.version = version
+
+    def _replay(self, db: Session, since: int) -> set:
+        entries = db.query(
+            models.ChangeJournal.table_name, models.ChangeJournal.row_id
+        ).filter(
+            models.ChangeJournal.id > since,
+            models.ChangeJournal.table_name.in_(PRICE_TABLES)
+        ).all()
+
+        changed = defaultdict(set)
+        for table_name, row_id in entries:
+            changed[table_name].add(row_id)
+
+        # Drop every changed row, then reload the ones that still exist
+        touched = set()
+        for table_name, row_ids in changed.items():
+            for row_id in row_ids:
+                key = self._row_keys.get((table_name, row_id))
+                if key:
+                    touched.add(key[0])
+                self._drop(table_name, row_id)
+        touched |= self._load(db, list(changed.get('prices', ())), list(changed.get('manual_prices', ())))
+        return touched
+
+    # ----- lookups -----
+
+    def _hit(self, kind: str, instrument_id: int, as_of: date) -> Optional[PriceHit]:
+        series = self._series.get((kind, instrument_id))
+        found = series.hit(as_of) if series else None
+        return PriceHit(found[0], found[1], kind, found[2]) if found else None
+
+    def candidates(self, instrument_id: int, as_of: date) -> Tuple[Optional[PriceHit], Optional[PriceHit]]:
+        """Latest automatic and latest manual price on or before as_of"""
+        return self._hit('auto', instrument_id, as_of), self._hit('manual', instrument_id, as_of)
+
+    def latest(self, instrument_id: int, as_of: date) -> Optional[PriceHit]:
+        """The price get_latest_price uses: the more recent of manual and
+        automatic (automatic wins ties), then test data"""
+        auto, manual = self.candidates(instrument_id, as_of)
+        if auto and manual:
+            return auto if auto.price_date >= manual.price_date else manual
+        if auto or manual:
+            return auto or manual
+        hit = self._hit('any', instrument_id, as_of)
+        return hit._replace(kind='test') if hit else None
+
+    def latest_many(self, instrument_ids: Iterable[int], as_of: date) -> Dict[int, PriceHit]:
+        hits = {}
+        for instrument_id in instrument_ids:
+            hit = self.latest(instrument_id, as_of)
+            if hit:
+                hits[instrument_id] = hit
+        return hits
+
+    def curves(self, instrument_id: int):
+        """(auto, manual, any) curves of an instrument, None where empty"""
+        def curve(kind):
+            series = self._series.get((kind, instrument_id))
+            return series.curve() if series else None
+        return curve('auto'), curve('manual'), curve('any')
+
+
+_index = PriceIndex()
+
+
+def get_price_index(db: Session) -> PriceIndex:
+    """The shared index, refreshed to the database's current data version"""
+    _index.refresh(db)
+    return _index
+
+
+def install_price_index(index: PriceIndex):
+    """Use an index loaded in another process (see etl/parallel_values.py)"""
+    global _index
+    _index = index
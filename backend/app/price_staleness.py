@@ -0,0 +1,83 @@
+"""
+Price staleness per instrument
+
+Carried-forward prices are not stored (the as-of lookup carries the last
+price forward), so how stale an instrument's price is cannot be read off
+the prices table. The price_staleness table keeps, per instrument, the date
+and source of the last automatic price and the number of trading days
+(on the instrument's calendar) it has been carried forward, as of the last
+check. The price ETL refreshes every row in one upsert from the price index.
+"""
+from datetime import date, datetime
+from typing import List
+import numpy as np
+from sqlalchemy.orm import Session
+from . import models
+from .db import dialect_insert
+from .price_index import get_price_index
+from .trading_calendar import calendar_for_currency, open_days_since
+
+
+def refresh_price_staleness(db: Session, as_of: date) -> int:
+    """Recompute every instrument's staleness as of a date; returns the row count"""
+    instruments = db.query(models.Instrument.id, models.Instrument.currency).all()
+    if not instruments:
+        return 0
+
+    index = get_price_index(db)
+    hits = [index.candidates(instrument_id, as_of)[0] for instrument_id, _ in instruments]
+
+    # Open days after the last price up to and including as_of, per calendar
+    calendars = np.array([calendar_for_currency(currency) for _, currency in instruments])
+    has_price = np.array([hit is not None for hit in hits])
+    last_days = np.array([hit.price_date if hit else as_of for hit in hits], dtype='datetime64[D]')
+    carried = np.zeros(len(instruments), dtype=int)
+    for calendar in set(calendars.tolist()):
+        mine = calendars == calendar
+        carried[mine] = open_days_since(last_days[mine], as_of, calendar)
+
+    now = datetime.utcnow()
+    rows = [
+        {
+            'instrument_id': instrument_id,
+            'last_price_date': hit.price_date if hit else None,
+            'last_price_source': hit.source if hit else None,
+            'days_carried_forward': int(days) if found else None,
+            'checked_date': as_of,
+            'updated_at': now
+        }
+        for (instrument_id, _), hit, days, found in zip(instruments, hits, carried, has_price)
+    ]
+    stmt = dialect_insert(db, models.PriceStaleness.__table__).values(rows)
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=['instrument_id'],
+        set_={column: stmt.excluded[column] for column in rows[0] if column != 'instrument_id'}
+    ))
+    db.commit()
+    return len(rows)
+
+
+def get_price_staleness(db: Session, min_days: int = 0) -> List[dict]:
+    """Stored staleness rows, most stale first; instruments never priced come first"""
+    rows = db.query(models.PriceStaleness, models.Instrument).join(
+        models.Instrument, models.Instrument.id == models.PriceStaleness.instrument_id
+    ).all()
+    results = [
+        {
+            "instrument_id": instrument.id,
+            "isin": instrument.isin,
+            "name": instrument.name,
+            "currency": instrument.currency,
+            "last_price_date": staleness.last_price_date.isoformat() if staleness.last_price_date else None,
+            "last_price_source": staleness.last_price_source,
+            "days_carried_forward": staleness.days_carried_forward,
+            "checked_date": staleness.checked_date.isoformat()
+        }
+        for staleness, instrument in rows
+        if staleness.days_carried_forward is None or staleness.days_carried_forward >= min_days
+    ]
+    never_priced = float('inf')
+    return sorted(
+        results,
+        key=lambda r: (-(r["days_carried_forward"] if r["days_carried_forward"] is not None else never_priced), r["name"])
+    )
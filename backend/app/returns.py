@@ -0,0 +1,257 @@
+"""
+Time-weighted and money-weighted returns
+
+Combines portfolio_values_daily with transaction cash flows so deposits and
+withdrawals do not show up as performance.
+
+- TWR: period returns between consecutive valuation dates,
+  r_i = (V_i - F_i) / V_{i-1} - 1, where F_i are the net flows after the
+  previous valuation date up to and including date i, chained with cumprod
+- XIRR: the annual rate that discounts the start value, every flow and the
+  end value to zero; solved with Newton iterations for all series at once
+
+A "series" is either the whole portfolio or a single instrument; all of
+them are computed together as rows of one matrix.
+"""
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import Optional, Tuple
+import numpy as np
+from sqlalchemy.orm import Session
+from . import models
+from .journal import current_version
+
+# Results kept, least recently used dropped first (one per date range asked for)
+RETURNS_CACHE_SIZE = 256
+
+# (portfolio_id, start, end, include_series) -> (data version, result)
+_returns_cache: 'OrderedDict[tuple, Tuple[int, dict]]' = OrderedDict()
+_returns_cache_lock = threading.Lock()
+
+
+def xirr(cash_flows: np.ndarray, years: np.ndarray, guess: float = 0.1,
+         tolerance: float = 1e-10, max_iterations: int = 100) -> np.ndarray:
+    """Vectorized XIRR
+
+    cash_flows is (series × points) from the investor's side (contributions
+    negative, withdrawals and end value positive), years the (points,)
+    offsets from the first point. Returns one annual rate per series, NaN
+    where Newton does not converge or the flows have no sign change.
+    """
+    cash_flows = np.atleast_2d(cash_flows)
+    rates = np.full(cash_flows.shape[0], guess)
+    converged = np.zeros(cash_flows.shape[0], dtype=bool)
+    failed = np.zeros(cash_flows.shape[0], dtype=bool)
+
+    # Rates near -100% overflow the discount factors; those series fail
+    with np.errstate(over='ignore', divide='ignore', invalid='ignore'):
+        for _ in range(max_iterations):
+            active = ~(converged | failed)
+            base = 1.0 + rates[:, None]
+            discount = base ** (-years[None, :])
+            npv = np.sum(cash_flows * discount, axis=1)
+            slope = np.sum(-years[None, :] * cash_flows * discount / base, axis=1)
+            step = npv / slope
+            finite = np.isfinite(step)
+            failed |= active & ~finite
+            step = np.where(active & finite, step, 0.0)
+            rates = np.maximum(rates - step, -0.9999)
+            converged |= active & finite & (np.abs(step) < tolerance)
+            if not (~(converged | failed)).any():
+                break
+
+    has_sign_change = (cash_flows > 0).any(axis=1) & (cash_flows < 0).any(axis=1)
+    return np.where(converged & has_sign_change, rates, np.nan)
+
+
+def time_weighted(values: np.ndarray, flows: np.ndarray) -> np.ndarray:
+    """Cumulative TWR per series on each valuation date
+
+    values and flows are (series × dates); flows[:, i] is the net inflow
+    since dates[i - 1]. Periods that start with no exposure return 0.
+    """
+    values = np.atleast_2d(values)
+    flows = np.atleast_2d(flows)
+    previous = values[:, :-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        period = np.where(previous > 0, (values[:, 1:] - flows[:, 1:]) / previous - 1.0, 0.0)
+    growth = np.cumprod(1.0 + period, axis=1)
+    return np.concatenate((np.zeros((values.shape[0], 1)), growth - 1.0), axis=1)
+
+
+def _data_version(db: Session, portfolio_id: int) -> int:
+    """Journal version of the inputs, so cached results expire when data changes"""
+    return current_version(db, ('portfolio_values_daily', 'transactions', 'fx_rates'), portfolio_id)
+
+
+def _load_values(db: Session, portfolio_id: int, start_date: Optional[date], end_date: Optional[date]):
+    """Valuation matrix (instrument × date) in HUF"""
+    query = db.query(
+        models.PortfolioValueDaily.instrument_id,
+        models.PortfolioValueDaily.snapshot_date,
+        models.PortfolioValueDaily.value_huf
+    ).filter(models.PortfolioValueDaily.portfolio_id == portfolio_id)
+    if start_date:
+        query = query.filter(models.PortfolioValueDaily.snapshot_date >= start_date)
+    if end_date:
+        query = query.filter(models.PortfolioValueDaily.snapshot_date <= end_date)
+
+    rows = query.all()
+    if not rows:
+        return None, None, None
+
+    instrument_col, date_col, value_col = zip(*rows)
+    instrument_ids, inst_idx = np.unique(np.array(instrument_col), return_inverse=True)
+    dates, date_idx = np.unique(np.array(date_col, dtype='datetime64[D]'), return_inverse=True)
+
+    # Instruments without a row on a valuation date are not held that day
+    values = np.zeros((len(instrument_ids), len(dates)))
+    np.add.at(values, (inst_idx, date_idx), np.array(value_col, dtype=np.float64))
+    return instrument_ids, dates, values
+
+
+def _load_flows(db: Session, portfolio_id: int, first: date, last: date):
+    """Net inflows in HUF per BUY/SELL after the first valuation date
+
+    Transactions without a price carry no cash and are skipped, as are
+    ADJUST corrections.
+    """
+    from .etl.calculate_values import get_fx_rate
+
+    rows = db.query(
+        models.Transaction.instrument_id,
+        models.Transaction.transaction_date,
+        models.Transaction.transaction_type,
+        models.Transaction.quantity,
+        models.Transaction.price,
+        models.Instrument.currency
+    ).join(
+        models.Instrument, models.Transaction.instrument_id == models.Instrument.id
+    ).filter(
+        models.Transaction.portfolio_id == portfolio_id,
+        models.Transaction.transaction_date > first,
+        models.Transaction.transaction_date <= last,
+        models.Transaction.transaction_type.in_(['BUY', 'SELL']),
+        models.Transaction.price != None
+    ).all()
+
+    fx_cache = {}
+    instrument_ids, dates, amounts = [], [], []
+    for instrument_id, tx_date, tx_type, quantity, price, currency in rows:
+        key = (currency, tx_date)
+        if key not in fx_cache:
+            fx_cache[key] = get_fx_rate(currency, 'HUF', tx_date, db)
+        if fx_cache[key] is None:
+            continue
+        sign = 1.0 if tx_type == 'BUY' else -1.0
+        instrument_ids.append(instrument_id)
+        dates.append(tx_date)
+        amounts.append(sign * float(quantity) * float(price) * float(fx_cache[key]))
+
+    return (
+        np.array(instrument_ids, dtype=np.int64),
+        np.array(dates, dtype='datetime64[D]'),
+        np.array(amounts, dtype=np.float64)
+    )
+
+
+def _nullable(value):
+    return None if value is None or np.isnan(value) else float(value)
+
+
+def calculate_returns(
+    db: Session,
+    portfolio_id: int,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    include_series: bool = False
+) -> Optional[dict]:
+    """TWR and XIRR for a portfolio and each of its instruments over a window
+
+    Results are cached until the portfolio's values or transactions change.
+    """
+    key = (portfolio_id, start_date, end_date, include_series)
+    version = _data_version(db, portfolio_id)
+    with _returns_cache_lock:
+        cached = _returns_cache.get(key)
+        if cached and cached[0] == version:
+            _returns_cache.move_to_end(key)
+            return cached[1]
+
+    instrument_ids, dates, values = _load_values(db, portfolio_id, start_date, end_date)
+    if instrument_ids is None:
+        return None
+
+    flow_instruments, flow_dates, flow_amounts = _load_flows(
+        db, portfolio_id, dates[0].astype(date), dates[-1].astype(date)
+    )
+    known = np.isin(flow_instruments, instrument_ids)
+    flow_rows = np.searchsorted(instrument_ids, flow_instruments[known])
+    flow_dates = flow_dates[known]
+    flow_amounts = flow_amounts[known]
+
+    # Row 0 is the whole portfolio, rows 1.. the instruments
+    series_values = np.vstack((values.sum(axis=0), values))
+
+    # TWR: bucket each flow into the valuation period it falls in
+    flows = np.zeros_like(series_values)
+    periods = np.searchsorted(dates, flow_dates, side='left')
+    np.add.at(flows, (flow_rows + 1, periods), flow_amounts)
+    np.add.at(flows, (np.zeros_like(periods), periods), flow_amounts)
+    twr = time_weighted(series_values, flows)
+
+    # XIRR: exact flow dates on a shared time axis
+    points = np.unique(np.concatenate((dates[[0, -1]], flow_dates)))
+    years = (points - points[0]).astype(np.float64) / 365.0
+    cash = np.zeros((series_values.shape[0], len(points)))
+    cash[:, 0] -= series_values[:, 0]
+    point_idx = np.searchsorted(points, flow_dates)
+    np.add.at(cash, (flow_rows + 1, point_idx), -flow_amounts)
+    np.add.at(cash, (np.zeros_like(point_idx), point_idx), -flow_amounts)
+    cash[:, -1] += series_values[:, -1]
+    irr = xirr(cash, years) if len(points) > 1 else np.full(series_values.shape[0], np.nan)
+
+    net_flows = flows.sum(axis=1)
+    names = {
+        i.id: i for i in db.query(models.Instrument).filter(
+            models.Instrument.id.in_(instrument_ids.tolist())
+        )
+    }
+
+    def summary(row: int) -> dict:
+        return {
+            'start_value_huf': float(series_values[row, 0]),
+            'end_value_huf': float(series_values[row, -1]),
+            'net_flows_huf': float(net_flows[row]),
+            'twr': float(twr[row, -1]),
+            'xirr': _nullable(irr[row])
+        }
+
+    result = {
+        'portfolio_id': portfolio_id,
+        'start_date': dates[0].astype(date).isoformat(),
+        'end_date': dates[-1].astype(date).isoformat(),
+        'portfolio': summary(0),
+        'instruments': [
+            {
+                'instrument_id': int(instrument_id),
+                'name': names[instrument_id].name if instrument_id in names else 'Unknown',
+                'isin': names[instrument_id].isin if instrument_id in names else None,
+                **summary(row + 1)
+            }
+            for row, instrument_id in enumerate(instrument_ids.tolist())
+        ]
+    }
+    if include_series:
+        result['twr_series'] = [
+            {'date': day, 'twr': float(value)}
+            for day, value in zip(np.datetime_as_string(dates, unit='D').tolist(), twr[0])
+        ]
+
+    with _returns_cache_lock:
+        _returns_cache[key] = (version, result)
+        _returns_cache.move_to_end(key)
+        while len(_returns_cache) > RETURNS_CACHE_SIZE:
+            _returns_cache.popitem(last=False)
+    return result
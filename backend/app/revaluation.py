@@ -0,0 +1,63 @@
+"""
+Dirty-range tracking for stored portfolio values
+
+Writes that change the inputs of an already calculated date (a back-dated
+transaction, manual price, market price or FX rate) record the affected
+(portfolio, instrument, from_date) range in revaluation_queue. The worker in
+etl/process_revaluations.py coalesces the queue and recalculates only those
+ranges.
+"""
+from datetime import date, datetime
+from typing import Iterable, Optional
+from sqlalchemy.orm import Session
+from . import models
+
+
+def mark_dirty(
+    db: Session,
+    from_date: date,
+    instrument_ids: Optional[Iterable[int]] = None,
+    portfolio_id: Optional[int] = None,
+    reason: Optional[str] = None
+) -> int:
+    """Queue recalculation of stored values on or after from_date
+
+    instrument_ids=None marks every instrument, portfolio_id=None every
+    portfolio. Nothing is queued when no stored value on or after from_date
+    could be affected. Does not commit; the entry belongs to the caller's
+    transaction. Returns the number of queued entries.
+    """
+    if instrument_ids is not None:
+        instrument_ids = list(instrument_ids)
+        if not instrument_ids:
+            return 0
+
+    affected = db.query(models.PortfolioValueDaily.id).filter(
+        models.PortfolioValueDaily.snapshot_date >= from_date
+    )
+    if portfolio_id is not None:
+        affected = affected.filter(models.PortfolioValueDaily.portfolio_id == portfolio_id)
+    if affected.first() is None:
+        return 0
+
+    now = datetime.utcnow()
+    entries = [
+        models.RevaluationQueue(
+            portfolio_id=portfolio_id,
+            instrument_id=instrument_id,
+            from_date=from_date,
+            reason=reason,
+            created_at=now
+        )
+        for instrument_id in (instrument_ids if instrument_ids is not None else [None])
+    ]
+    db.add_all(entries)
+    return len(entries)
+
+
+def mark_currency_dirty(db: Session, currency: str, from_date: date, reason: Optional[str] = None) -> int:
+    """Queue recalculation for every instrument quoted in a currency"""
+    instrument_ids = [
+        row.id for row in db.query(models.Instrument.id).filter(models.Instrument.currency == currency)
+    ]
+    return mark_dirty(db, from_date, instrument_ids, reason=reason)
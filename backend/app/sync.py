@@ -0,0 +1,178 @@
+"""
+Delta sync for clients that keep a local copy of the data
+
+Clients remember the version returned by their last sync and ask for
+everything that changed since. Changes come from change_journal: entries
+are coalesced per row (the last operation wins), surviving rows are read
+back in one query per table and removed rows are reported as deletes.
+
+since=0 (or a version older than the oldest kept journal entry) returns a
+full copy of the requested tables instead, paged by a cursor.
+"""
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Dict, Iterable, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from . import models
+from .journal import current_version, first_version
+
+# Tables the mobile and desktop clients read
+SYNC_TABLES = {
+    'instruments': models.Instrument,
+    'portfolio_values_daily': models.PortfolioValueDaily,
+    'transactions': models.Transaction,
+    'fx_rates': models.FxRate,
+    'wealth_categories': models.WealthCategory,
+    'wealth_values': models.WealthValue,
+    'total_wealth_snapshots': models.TotalWealthSnapshot,
+}
+
+
+def _serialize(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def _rows(
+    db: Session,
+    model,
+    ids: Optional[Iterable[int]] = None,
+    portfolio_id: Optional[int] = None,
+    after: int = 0,
+    limit: Optional[int] = None
+) -> list:
+    """Plain column dicts for a table in id order: the given ids, or rows of
+    one portfolio (tables with a portfolio_id column), after an id, up to a limit"""
+    table = model.__table__
+    query = db.query(table)
+    if ids is not None:
+        query = query.filter(table.c.id.in_(list(ids)))
+    if portfolio_id is not None and 'portfolio_id' in table.c:
+        query = query.filter(table.c.portfolio_id == portfolio_id)
+    if after:
+        query = query.filter(table.c.id > after)
+    query = query.order_by(table.c.id)
+    if limit is not None:
+        query = query.limit(limit)
+    return [{column: _serialize(value) for column, value in row._mapping.items()} for row in query]
+
+
+def _parse_cursor(cursor: str, tables: List[str]) -> Tuple[int, str, int]:
+    """(version, table, last id) of a full-copy page cursor"""
+    try:
+        version, table, after = cursor.split(':')
+        version, after = int(version), int(after)
+    except ValueError:
+        raise ValueError(f"Malformed sync cursor: {cursor}")
+    if table not in tables:
+        raise ValueError(f"Sync cursor table {table} is not among the requested tables")
+    return version, table, after
+
+
+def full_snapshot(
+    db: Session,
+    tables: List[str],
+    portfolio_id: Optional[int] = None,
+    limit: int = 5000,
+    cursor: Optional[str] = None
+) -> dict:
+    """Every row of the requested tables, at most `limit` rows per page
+
+    Every page carries the version read before the first page. When has_more
+    is set the client calls again with the returned cursor (and the same
+    tables and portfolio); rows changed while paging come again in the next
+    delta.
+    """
+    if cursor:
+        version, table, after = _parse_cursor(cursor, tables)
+        tables = tables[tables.index(table):]
+    else:
+        # Read before any rows, so nothing committed after it is missed
+        version, after = current_version(db), 0
+
+    changes, next_cursor, remaining = {}, None, limit
+    for position, name in enumerate(tables):
+        if remaining == 0:
+            next_cursor = f"{version}:{name}:0"
+            break
+        rows = _rows(db, SYNC_TABLES[name], portfolio_id=portfolio_id, after=after, limit=remaining + 1)
+        after = 0
+        if len(rows) > remaining:
+            rows = rows[:remaining]
+            next_cursor = f"{version}:{name}:{rows[-1]['id']}"
+        changes[name] = {'upserts': rows, 'deletes': []}
+        if next_cursor:
+            break
+        remaining -= len(rows)
+
+    return {
+        'version': version, 'full': True, 'has_more': next_cursor is not None,
+        'cursor': next_cursor, 'changes': changes
+    }
+
+
+def changes_since(
+    db: Session,
+    since: int,
+    tables: Optional[Iterable[str]] = None,
+    portfolio_id: Optional[int] = None,
+    limit: int = 5000,
+    cursor: Optional[str] = None
+) -> dict:
+    """Rows inserted, updated or deleted after version `since`
+
+    At most `limit` journal entries are consumed per call; when has_more is
+    set the client calls again with the returned version (or, while paging
+    a full copy, the returned cursor). Only settled versions are returned,
+    so no entry committed later can fall below one (see journal.py).
+    """
+    tables = list(tables) if tables else list(SYNC_TABLES)
+    unknown = [t for t in tables if t not in SYNC_TABLES]
+    if unknown:
+        raise ValueError(f"Tables not available for sync: {', '.join(unknown)}")
+
+    if cursor:
+        return full_snapshot(db, tables, portfolio_id, limit, cursor)
+
+    # Read before the journal: every entry up to it is visible below
+    upper = current_version(db)
+    oldest = first_version(db)
+    if since <= 0 or oldest is None or since < oldest - 1:
+        return full_snapshot(db, tables, portfolio_id, limit)
+
+    journal = db.query(
+        models.ChangeJournal.id,
+        models.ChangeJournal.table_name,
+        models.ChangeJournal.row_id,
+        models.ChangeJournal.operation,
+        models.ChangeJournal.portfolio_id
+    ).filter(
+        models.ChangeJournal.id > since,
+        models.ChangeJournal.id <= upper,
+        models.ChangeJournal.table_name.in_(tables)
+    ).order_by(models.ChangeJournal.id).limit(limit + 1).all()
+
+    has_more = len(journal) > limit
+    journal = journal[:limit]
+
+    # Last operation per row wins
+    latest: Dict[str, Dict[int, str]] = {}
+    for _, table_name, row_id, operation, entry_portfolio in journal:
+        if portfolio_id is not None and entry_portfolio not in (None, portfolio_id):
+            continue
+        latest.setdefault(table_name, {})[row_id] = operation
+
+    changes = {}
+    for table_name, operations in latest.items():
+        live_ids = [row_id for row_id, op in operations.items() if op != 'delete']
+        upserts = _rows(db, SYNC_TABLES[table_name], live_ids) if live_ids else []
+        # Rows deleted after this page was read show up as deletes too
+        found = {row['id'] for row in upserts}
+        deletes = sorted(row_id for row_id in operations if row_id not in found)
+        changes[table_name] = {'upserts': upserts, 'deletes': deletes}
+
+    version = journal[-1][0] if has_more else max(since, upper)
+    return {'version': version, 'full': False, 'has_more': has_more, 'cursor': None, 'changes': changes}
@@ -0,0 +1,139 @@
+"""
+Trading and business-day calendars
+
+- BET:      Budapest Stock Exchange, also used for MNB FX fixings
+- TARGET:   the euro system's settlement calendar, for EUR funds
+- WEEKDAYS: Monday to Friday, for markets without a calendar here
+
+Holidays are generated for CALENDAR_YEARS and held in numpy busday
+calendars, so checks over whole date ranges are vectorized. Hungarian
+bridge days are decreed each year and are read from a CSV with one line
+per year (data/bet_bridge_days.csv, or BET_BRIDGE_DAYS_FILE); a year
+with no bridge days is listed with an empty list. BÉT checks touching a
+year the file does not list print a warning, once per year, since its
+bridge days would be treated as open.
+
+The ETL skips fetches and stored values on closed days; reads resolve
+"as of" the last open day instead.
+"""
+import csv
+from datetime import date, timedelta
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, Iterable, List
+import numpy as np
+
+CALENDAR_YEARS = range(1990, 2061)
+
+BRIDGE_DAYS_FILE = Path(__file__).parent.parent.parent / "data" / "bet_bridge_days.csv"
+
+_warned_years = set()
+
+
+def easter_sunday(year: int) -> date:
+    """Gregorian Easter (anonymous algorithm)"""
+    a, b, c = year % 19, year // 100, year % 100
+    d, e = b // 4, b % 4
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = c // 4, c % 4
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def _bet_holidays(year: int) -> List[date]:
+    easter = easter_sunday(year)
+    fixed = [(1, 1), (3, 15), (5, 1), (8, 20), (10, 23), (11, 1), (12, 24), (12, 25), (12, 26), (12, 31)]
+    days = [date(year, month, day) for month, day in fixed]
+    days += [easter - timedelta(days=2), easter + timedelta(days=1), easter + timedelta(days=50)]
+    return days
+
+
+def _target_holidays(year: int) -> List[date]:
+    easter = easter_sunday(year)
+    return [
+        date(year, 1, 1), easter - timedelta(days=2), easter + timedelta(days=1),
+        date(year, 5, 1), date(year, 12, 25), date(year, 12, 26)
+    ]
+
+
+@lru_cache(maxsize=None)
+def bridge_days() -> Dict[int, List[date]]:
+    """Weekdays made rest days by government decree (BÉT closed), by year"""
+    from .config import settings
+    path = settings.bet_bridge_days_file or BRIDGE_DAYS_FILE
+    with open(path, newline='') as f:
+        return {
+            int(row['year']): [date.fromisoformat(d) for d in (row['bridge_days'] or '').split()]
+            for row in csv.DictReader(f)
+        }
+
+
+def _check_bridge_years(first: np.datetime64, last: np.datetime64, calendar: str):
+    """Warn once per year when a BÉT check reaches a year without bridge-day data"""
+    if calendar != 'BET':
+        return
+    covered = bridge_days()
+    first_year, last_year = (int(d.astype('datetime64[Y]').astype(int)) + 1970 for d in (first, last))
+    for year in range(first_year, last_year + 1):
+        if year not in covered and year not in _warned_years:
+            _warned_years.add(year)
+            print(f"⚠ No BÉT bridge days listed for {year}; any decreed rest days are treated as trading days")
+
+
+_HOLIDAYS = {
+    'BET': lambda: [d for y in CALENDAR_YEARS for d in _bet_holidays(y)]
+                   + sorted(d for days in bridge_days().values() for d in days),
+    'TARGET': lambda: [d for y in CALENDAR_YEARS for d in _target_holidays(y)],
+    'WEEKDAYS': lambda: [],
+}
+
+
+@lru_cache(maxsize=None)
+def _busdaycalendar(calendar: str) -> np.busdaycalendar:
+    if calendar not in _HOLIDAYS:
+        raise ValueError(f"Unknown calendar {calendar}; use one of {', '.join(_HOLIDAYS)}")
+    return np.busdaycalendar(weekmask='1111100', holidays=np.array(_HOLIDAYS[calendar](), dtype='datetime64[D]'))
+
+
+def calendar_for_currency(currency: str) -> str:
+    """Calendar an instrument's prices follow: BÉT for HUF, TARGET for EUR"""
+    return {'HUF': 'BET', 'EUR': 'TARGET'}.get(currency, 'WEEKDAYS')
+
+
+def is_trading_day(day: date, calendar: str = 'BET') -> bool:
+    _check_bridge_years(np.datetime64(day, 'D'), np.datetime64(day, 'D'), calendar)
+    return bool(np.is_busday(np.datetime64(day, 'D'), busdaycal=_busdaycalendar(calendar)))
+
+
+def open_days(days: np.ndarray, calendars: Iterable[str]) -> np.ndarray:
+    """Mask of datetime64[D] days on which any of the calendars is open"""
+    mask = np.zeros(len(days), dtype=bool)
+    for calendar in set(calendars):
+        if len(days):
+            _check_bridge_years(days.min(), days.max(), calendar)
+        mask |= np.is_busday(days, busdaycal=_busdaycalendar(calendar))
+    return mask
+
+
+def trading_days(start_date: date, end_date: date, calendar: str = 'BET') -> List[date]:
+    """Open days in [start_date, end_date]"""
+    days = np.arange(np.datetime64(start_date, 'D'), np.datetime64(end_date, 'D') + 1)
+    return days[open_days(days, [calendar])].astype(date).tolist()
+
+
+def open_days_since(days: np.ndarray, end_date: date, calendar: str = 'BET') -> np.ndarray:
+    """Number of open days after each datetime64[D] day, up to and including end_date"""
+    if len(days):
+        _check_bridge_years(min(days.min(), np.datetime64(end_date, 'D')), np.datetime64(end_date, 'D'), calendar)
+    return np.busday_count(days + 1, np.datetime64(end_date, 'D') + 1, busdaycal=_busdaycalendar(calendar))
+
+
+def previous_trading_day(day: date, calendar: str = 'BET') -> date:
+    """The latest open day on or before day"""
+    _check_bridge_years(np.datetime64(day, 'D'), np.datetime64(day, 'D'), calendar)
+    rolled = np.busday_offset(np.datetime64(day, 'D'), 0, roll='backward', busdaycal=_busdaycalendar(calendar))
+    return rolled.astype(date)
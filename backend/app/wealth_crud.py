@@ -2,11 +2,15 @@
 CRUD operations for wealth management
 """
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, func
+from sqlalchemy import and_, func, insert, update
 from datetime import date, datetime
-from typing import List, Optional
+from itertools import groupby
+from typing import Dict, Iterable, List, Optional
 from decimal import Decimal
+import numpy as np
 from . import models
+from .db import dialect_insert
+from .fx_curve import get_fx_curves
 
 # ==================== WEALTH CATEGORY OPERATIONS ====================
 
@@ -26,15 +30,15 @@ def add_wealth_category(
     is_liability: bool = False
 ) -> models.WealthCategory:
     """Add a new wealth category"""
-    category = models.WealthCategory(
-        category_type=category_type,
-        name=name,
-        currency=currency,
-        is_liability=is_liability
-    )
-    db.add(category)
+    category = db.scalars(
+        insert(models.WealthCategory).values(
+            category_type=category_type,
+            name=name,
+            currency=currency,
+            is_liability=is_liability
+        ).returning(models.WealthCategory)
+    ).one()
     db.commit()
-    db.refresh(category)
     return category
 
 
@@ -44,20 +48,24 @@ def update_wealth_category(
     **kwargs
 ) -> models.WealthCategory:
     """Update a wealth category"""
-    category = db.query(models.WealthCategory).filter(
-        models.WealthCategory.id == category_id
+    columns = models.WealthCategory.__table__.columns
+    values = {
+        key: value for key, value in kwargs.items()
+        if key in columns and key not in ['id', 'created_at']
+    }
+    values['updated_at'] = datetime.utcnow()
+    
+    category = db.scalars(
+        update(models.WealthCategory).where(
+            models.WealthCategory.id == category_id
+        ).values(**values).returning(models.WealthCategory)
     ).first()
     
     if not category:
+        db.rollback()
         raise ValueError(f"Wealth category {category_id} not found")
     
-    for key, value in kwargs.items():
-        if hasattr(category, key) and key not in ['id', 'created_at']:
-            setattr(category, key, value)
-    
-    category.updated_at = datetime.utcnow()
     db.commit()
-    db.refresh(category)
     return category
 
 
@@ -85,30 +93,30 @@ def add_or_update_wealth_value(
     note: Optional[str] = None
 ) -> models.WealthValue:
     """Add or update wealth value for a specific date"""
+    now = datetime.utcnow()
+    
+    # Single upsert on unique_wealth_value; RETURNING hands back the stored row
+    stmt = dialect_insert(db, models.WealthValue).values(
+        wealth_category_id=wealth_category_id,
+        value_date=value_date,
+        present_value=Decimal(str(present_value)),
+        note=note,
+        created_at=now,
+        updated_at=now
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['wealth_category_id', 'value_date'],
+        set_={
+            'present_value': stmt.excluded.present_value,
+            'note': stmt.excluded.note,
+            'updated_at': stmt.excluded.updated_at
+        }
+    ).returning(models.WealthValue)
     
-    # Check if value already exists
-    wealth_value = db.query(models.WealthValue).filter(
-        models.WealthValue.wealth_category_id == wealth_category_id,
-        models.WealthValue.value_date == value_date
-    ).first()
-    
-    if wealth_value:
-        # Update existing
-        wealth_value.present_value = Decimal(str(present_value))
-        wealth_value.note = note
-        wealth_value.updated_at = datetime.utcnow()
-    else:
-        # Create new
-        wealth_value = models.WealthValue(
-            wealth_category_id=wealth_category_id,
-            value_date=value_date,
-            present_value=Decimal(str(present_value)),
-            note=note
-        )
-        db.add(wealth_value)
-    
+    wealth_value = db.scalars(
+        stmt, execution_options={'populate_existing': True}
+    ).one()
     db.commit()
-    db.refresh(wealth_value)
     return wealth_value
 
 
@@ -144,6 +152,51 @@ def get_wealth_values(
     return results
 
 
+def get_wealth_values_as_of(
+    db: Session,
+    as_of: date,
+    category_type: Optional[str] = None
+) -> List[dict]:
+    """Latest wealth value on or before as_of for every category
+
+    One windowed query; categories are not copied to every date, so each
+    keeps its last recorded value until a newer one is entered.
+    """
+    ranked = db.query(
+        models.WealthValue.id,
+        func.row_number().over(
+            partition_by=models.WealthValue.wealth_category_id,
+            order_by=models.WealthValue.value_date.desc()
+        ).label('recency')
+    ).filter(
+        models.WealthValue.value_date <= as_of
+    ).subquery()
+    
+    query = db.query(models.WealthValue, models.WealthCategory).join(
+        models.WealthCategory
+    ).join(
+        ranked, and_(ranked.c.id == models.WealthValue.id, ranked.c.recency == 1)
+    )
+    
+    if category_type:
+        query = query.filter(models.WealthCategory.category_type == category_type)
+    
+    return [
+        {
+            "id": value.id,
+            "category_id": category.id,
+            "category_type": category.category_type,
+            "name": category.name,
+            "currency": category.currency,
+            "is_liability": category.is_liability,
+            "present_value": float(value.present_value),
+            "note": value.note,
+            "value_date": value.value_date.isoformat()
+        }
+        for value, category in query.order_by(models.WealthCategory.id).all()
+    ]
+
+
 def get_wealth_value_history(
     db: Session,
     wealth_category_id: int,
@@ -179,84 +232,230 @@ def delete_wealth_value(db: Session, value_id: int) -> bool:
 
 # ==================== TOTAL WEALTH CALCULATIONS ====================
 
-def get_latest_fx_rates(db: Session, target_date: date) -> dict:
-    """Get latest FX rates for a given date"""
-    fx_rates = {'HUF': 1.0}
-    
-    for currency in ['USD', 'EUR', 'GBP', 'CHF']:
-        fx_record = db.query(models.FxRate).filter(
-            models.FxRate.target_currency == currency,
-            models.FxRate.rate_date <= target_date
-        ).order_by(models.FxRate.rate_date.desc()).first()
-        
-        if fx_record:
-            fx_rates[currency] = float(fx_record.rate)
-        else:
-            # Fallback rates
-            fallback_rates = {'USD': 327.87, 'EUR': 380.23, 'GBP': 450.0, 'CHF': 400.0}
-            fx_rates[currency] = fallback_rates[currency]
-    
+def get_latest_fx_rates(db: Session, target_date: date, base_currency: str = 'HUF') -> dict:
+    """Get FX rates into base_currency for every known currency on a date
+
+    Rates come from the shared FX curves (see fx_curve.py); a currency whose
+    rates only start after target_date uses its first known rate.
+    """
+    fx = get_fx_curves(db)
+    fx_rates = {}
+    for currency in fx.currencies() | {base_currency}:
+        rate = fx.nearest(currency, base_currency, target_date)
+        if rate is not None:
+            fx_rates[currency] = float(rate)
     return fx_rates
 
 
-def calculate_total_wealth(
+def _rates_to_huf(db: Session, currencies: List[str], days: np.ndarray) -> np.ndarray:
+    """HUF rate of each currency as of the matching day, vectorized per currency
+
+    Days before a currency's first rate use that first rate, as
+    get_latest_fx_rates does; currencies without any rate are NaN.
+    """
+    fx = get_fx_curves(db)
+    currencies = np.array(currencies, dtype=object)
+    rates = np.ones(len(days))
+    for currency in set(currencies.tolist()):
+        mine = currencies == currency
+        first = fx.nearest(currency, 'HUF', date.min)
+        fallback = float(first) if first is not None else np.nan
+        rates[mine] = [float(r) if r is not None else fallback for r in fx.rates_on(currency, 'HUF', days[mine])]
+    return rates
+
+
+def wealth_values_in_huf(db: Session, wealth_values: List[dict]) -> List[dict]:
+    """Add fx_rate and value_huf to wealth values, each converted at the rate
+    of its own value_date; both are None for a currency without FX rates"""
+    if not wealth_values:
+        return wealth_values
+    days = np.array([wv['value_date'] for wv in wealth_values], dtype='datetime64[D]')
+    rates = _rates_to_huf(db, [wv['currency'] for wv in wealth_values], days)
+    for wv, rate in zip(wealth_values, rates.tolist()):
+        converted = not np.isnan(rate)
+        wv['fx_rate'] = rate if converted else None
+        wv['value_huf'] = wv['present_value'] * rate if converted else None
+    return wealth_values
+
+
+def _unconverted(category_id: int, name: str, currency: str) -> dict:
+    """A category left out of the totals for lack of an FX rate"""
+    return {'category_id': category_id, 'name': name, 'currency': currency}
+
+
+def _empty_breakdown() -> dict:
+    return {'cash': 0.0, 'property': 0.0, 'pension': 0.0, 'loans': 0.0, 'other': 0.0}
+
+
+def portfolio_subtotals(
     db: Session,
-    snapshot_date: date,
-    portfolio_id: int = 1
-) -> dict:
-    """Calculate total wealth combining portfolio and other assets"""
-    
-    # Get portfolio value
-    portfolio_values = db.query(models.PortfolioValueDaily).filter(
-        models.PortfolioValueDaily.portfolio_id == portfolio_id,
-        models.PortfolioValueDaily.snapshot_date == snapshot_date
+    snapshot_dates: List[date],
+    portfolio_ids: Optional[Iterable[int]] = None
+) -> List[dict]:
+    """Value of each portfolio as of its last valued day, for sorted dates
+
+    One query grouped by portfolio and day. portfolio_ids None means every
+    portfolio. Returns per portfolio its id, name, and value_huf and
+    value_date arrays aligned with snapshot_dates (0 / None before its first
+    valued day).
+    """
+    days = np.array(snapshot_dates, dtype='datetime64[D]')
+    query = db.query(
+        models.PortfolioValueDaily.portfolio_id,
+        models.Portfolio.name,
+        models.PortfolioValueDaily.snapshot_date,
+        func.sum(models.PortfolioValueDaily.value_huf)
+    ).join(
+        models.Portfolio, models.Portfolio.id == models.PortfolioValueDaily.portfolio_id
+    ).filter(
+        models.PortfolioValueDaily.snapshot_date <= snapshot_dates[-1]
+    )
+    if portfolio_ids is not None:
+        query = query.filter(models.PortfolioValueDaily.portfolio_id.in_(list(portfolio_ids)))
+    rows = query.group_by(
+        models.PortfolioValueDaily.portfolio_id, models.Portfolio.name, models.PortfolioValueDaily.snapshot_date
+    ).order_by(
+        models.PortfolioValueDaily.portfolio_id, models.PortfolioValueDaily.snapshot_date
     ).all()
     
-    portfolio_value_huf = sum(float(pv.value_huf) for pv in portfolio_values) if portfolio_values else 0.0
-    
-    # Get all wealth values for this date
-    wealth_values = get_wealth_values(db, snapshot_date)
-    
-    # Get latest FX rates
-    fx_rates = get_latest_fx_rates(db, snapshot_date)
-    
-    # Calculate assets and liabilities in HUF
-    total_assets_huf = 0.0
-    total_liabilities_huf = 0.0
-    
-    breakdown = {
-        'cash': 0.0,
-        'property': 0.0,
-        'pension': 0.0,
-        'loans': 0.0,
-        'other': 0.0
+    subtotals = []
+    for portfolio_id, mine in groupby(rows, key=lambda row: row[0]):
+        mine = list(mine)
+        valued_days = np.array([row[2] for row in mine], dtype='datetime64[D]')
+        sums = np.array([float(row[3] or 0) for row in mine])
+        idx = np.searchsorted(valued_days, days, side='right') - 1
+        found = idx >= 0
+        safe = np.maximum(idx, 0)
+        subtotals.append({
+            'portfolio_id': portfolio_id,
+            'name': mine[0][1],
+            'value_huf': np.where(found, sums[safe], 0.0),
+            'value_date': np.where(found, valued_days[safe], np.datetime64('NaT'))
+        })
+    return subtotals
+
+
+def _totals(snapshot_date: date, portfolios: List[dict], k: int, breakdown: dict, unconverted: List[dict]) -> dict:
+    """Totals of one date; k indexes the date in the portfolio_subtotals arrays
+
+    unconverted lists the categories left out of the totals because their
+    currency has no FX rate.
+    """
+    portfolios = [
+        {
+            'portfolio_id': p['portfolio_id'],
+            'name': p['name'],
+            'value_huf': float(p['value_huf'][k]),
+            'value_date': p['value_date'][k].astype(date).isoformat() if not np.isnat(p['value_date'][k]) else None
+        }
+        for p in portfolios
+    ]
+    portfolio_value_huf = sum(p['value_huf'] for p in portfolios)
+    total_liabilities_huf = breakdown['loans']
+    other_assets_huf = sum(value for key, value in breakdown.items() if key != 'loans')
+    return {
+        'snapshot_date': snapshot_date.isoformat(),
+        'portfolio_value_huf': portfolio_value_huf,
+        'portfolios': portfolios,
+        'other_assets_huf': other_assets_huf,
+        'total_assets_huf': portfolio_value_huf + other_assets_huf,
+        'total_liabilities_huf': total_liabilities_huf,
+        'net_wealth_huf': portfolio_value_huf + other_assets_huf - total_liabilities_huf,
+        'breakdown': breakdown,
+        'unconverted': unconverted
     }
-    
+
+
+def calculate_total_wealth(
+    db: Session,
+    snapshot_date: date,
+    portfolio_ids: Optional[Iterable[int]] = None
+) -> dict:
+    """Calculate total wealth combining portfolios and other assets
+
+    Consolidates the given portfolios, or all of them, with per-portfolio
+    subtotals. Both sides resolve as of snapshot_date: each portfolio's last
+    valued day and each category's latest value on or before it, converted
+    to HUF at the rate of that value's date. Categories in a currency without
+    FX rates are left out of the totals and listed under 'unconverted'.
+    """
+    portfolios = portfolio_subtotals(db, [snapshot_date], portfolio_ids)
+    
+    # Latest value of every category as of this date, in HUF
+    wealth_values = wealth_values_in_huf(db, get_wealth_values_as_of(db, snapshot_date))
+    
+    breakdown = _empty_breakdown()
+    unconverted = []
     for wv in wealth_values:
-        value_huf = wv['present_value'] * fx_rates.get(wv['currency'], 1.0)
-        
-        if wv['is_liability']:
+        if wv['value_huf'] is None:
+            unconverted.append(_unconverted(wv['category_id'], wv['name'], wv['currency']))
+        elif wv['is_liability']:
             # Loans are stored as positive values but represent liabilities
-            total_liabilities_huf += abs(value_huf)
-            breakdown['loans'] += abs(value_huf)
+            breakdown['loans'] += abs(wv['value_huf'])
         else:
-            total_assets_huf += value_huf
             cat_type = wv['category_type']
-            breakdown[cat_type] = breakdown.get(cat_type, 0.0) + value_huf
-    
-    other_assets_huf = total_assets_huf
-    net_wealth_huf = portfolio_value_huf + total_assets_huf - total_liabilities_huf
+            breakdown[cat_type] = breakdown.get(cat_type, 0.0) + wv['value_huf']
     
     return {
-        'snapshot_date': snapshot_date.isoformat(),
-        'portfolio_value_huf': portfolio_value_huf,
-        'other_assets_huf': other_assets_huf,
-        'total_assets_huf': portfolio_value_huf + total_assets_huf,
-        'total_liabilities_huf': total_liabilities_huf,
-        'net_wealth_huf': net_wealth_huf,
-        'breakdown': breakdown,
+        **_totals(snapshot_date, portfolios, 0, breakdown, unconverted),
         'wealth_details': wealth_values,
-        'fx_rates': fx_rates
+        'fx_rates': get_latest_fx_rates(db, snapshot_date)
+    }
+
+
+def calculate_wealth_totals(
+    db: Session,
+    snapshot_dates: List[date],
+    portfolio_ids: Optional[Iterable[int]] = None
+) -> Dict[date, dict]:
+    """calculate_total_wealth figures (without details) for many dates at once
+
+    One query for wealth values and one for daily portfolio sums up to the
+    last date, then as-of lookups and FX conversion over arrays. With
+    portfolio_ids None, every portfolio is included.
+    """
+    if not snapshot_dates:
+        return {}
+    snapshot_dates = sorted(set(snapshot_dates))
+    days = np.array(snapshot_dates, dtype='datetime64[D]')
+    last = snapshot_dates[-1]
+    
+    values = db.query(
+        models.WealthValue.wealth_category_id, models.WealthValue.value_date, models.WealthValue.present_value,
+        models.WealthCategory.name, models.WealthCategory.currency, models.WealthCategory.category_type, models.WealthCategory.is_liability
+    ).join(
+        models.WealthCategory
+    ).filter(
+        models.WealthValue.value_date <= last
+    ).order_by(
+        models.WealthValue.wealth_category_id, models.WealthValue.value_date
+    ).all()
+    
+    breakdown = {key: np.zeros(len(days)) for key in _empty_breakdown()}
+    unconverted = [[] for _ in snapshot_dates]
+    if values:
+        value_days = np.array([v.value_date for v in values], dtype='datetime64[D]')
+        value_huf = np.array([float(v.present_value) for v in values]) * _rates_to_huf(
+            db, [v.currency for v in values], value_days
+        )
+        starts = [0] + [k for k in range(1, len(values)) if values[k].wealth_category_id != values[k - 1].wealth_category_id]
+        for start, end in zip(starts, starts[1:] + [len(values)]):
+            category = values[start]
+            idx = np.searchsorted(value_days[start:end], days, side='right') - 1
+            latest = np.where(idx >= 0, value_huf[start:end][np.maximum(idx, 0)], 0.0)
+            for k in np.flatnonzero(np.isnan(latest)).tolist():
+                unconverted[k].append(_unconverted(category.wealth_category_id, category.name, category.currency))
+            latest = np.nan_to_num(latest, nan=0.0)
+            if category.is_liability:
+                breakdown['loans'] += np.abs(latest)
+            else:
+                breakdown.setdefault(category.category_type, np.zeros(len(days)))
+                breakdown[category.category_type] += latest
+    
+    portfolios = portfolio_subtotals(db, snapshot_dates, portfolio_ids)
+    return {
+        day: _totals(day, portfolios, k, {key: float(column[k]) for key, column in breakdown.items()}, unconverted[k])
+        for k, day in enumerate(snapshot_dates)
     }
 
 
@@ -275,38 +474,32 @@ def save_total_wealth_snapshot(
     
     net_wealth_huf = portfolio_value_huf + other_assets_huf - total_liabilities_huf
     
-    # Check if snapshot exists
-    snapshot = db.query(models.TotalWealthSnapshot).filter(
-        models.TotalWealthSnapshot.snapshot_date == snapshot_date
-    ).first()
-    
-    if snapshot:
-        # Update existing
-        snapshot.portfolio_value_huf = Decimal(str(portfolio_value_huf))
-        snapshot.other_assets_huf = Decimal(str(other_assets_huf))
-        snapshot.total_liabilities_huf = Decimal(str(total_liabilities_huf))
-        snapshot.net_wealth_huf = Decimal(str(net_wealth_huf))
-        snapshot.cash_huf = Decimal(str(cash_huf))
-        snapshot.property_huf = Decimal(str(property_huf))
-        snapshot.pension_huf = Decimal(str(pension_huf))
-        snapshot.other_huf = Decimal(str(other_huf))
-    else:
-        # Create new
-        snapshot = models.TotalWealthSnapshot(
-            snapshot_date=snapshot_date,
-            portfolio_value_huf=Decimal(str(portfolio_value_huf)),
-            other_assets_huf=Decimal(str(other_assets_huf)),
-            total_liabilities_huf=Decimal(str(total_liabilities_huf)),
-            net_wealth_huf=Decimal(str(net_wealth_huf)),
-            cash_huf=Decimal(str(cash_huf)),
-            property_huf=Decimal(str(property_huf)),
-            pension_huf=Decimal(str(pension_huf)),
-            other_huf=Decimal(str(other_huf))
-        )
-        db.add(snapshot)
+    values = {
+        'portfolio_value_huf': Decimal(str(portfolio_value_huf)),
+        'other_assets_huf': Decimal(str(other_assets_huf)),
+        'total_liabilities_huf': Decimal(str(total_liabilities_huf)),
+        'net_wealth_huf': Decimal(str(net_wealth_huf)),
+        'cash_huf': Decimal(str(cash_huf)),
+        'property_huf': Decimal(str(property_huf)),
+        'pension_huf': Decimal(str(pension_huf)),
+        'other_huf': Decimal(str(other_huf))
+    }
     
+    # Upsert on the unique snapshot_date and read the row back via RETURNING
+    stmt = dialect_insert(db, models.TotalWealthSnapshot).values(
+        snapshot_date=snapshot_date,
+        created_at=datetime.utcnow(),
+        **values
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['snapshot_date'],
+        set_=values
+    ).returning(models.TotalWealthSnapshot)
+    
+    snapshot = db.scalars(
+        stmt, execution_options={'populate_existing': True}
+    ).one()
     db.commit()
-    db.refresh(snapshot)
     return snapshot
 
 
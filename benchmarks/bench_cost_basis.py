@@ -0,0 +1,80 @@
+"""
+Benchmark the lot-matching engine on synthetic ledgers.
+
+Compares the vectorized FIFO and the average-cost pass against a plain
+Python lot queue on ledgers of 10k+ transactions.
+
+Usage:
+    python benchmarks/bench_cost_basis.py
+"""
+import os
+import sys
+import tempfile
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+# The engine is DB-free, but importing the backend needs a database URL
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.gettempdir()}/portfolio_bench.db")
+
+from backend.app.cost_basis import compute_lots
+
+
+def make_ledger(n: int, instruments: int = 40, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    instrument_ids = rng.integers(1, instruments + 1, n)
+    dates = np.datetime64("2015-01-01") + np.sort(rng.integers(0, 3650, n)).astype("timedelta64[D]")
+    quantities = rng.integers(1, 500, n).astype(float)
+    prices = rng.uniform(100, 20000, n).round(2)
+
+    held = {}
+    for i in range(n):
+        iid = instrument_ids[i]
+        if rng.random() < 0.4 and held.get(iid, 0) > 0:
+            quantities[i] = -min(quantities[i], held[iid])
+        held[iid] = held.get(iid, 0) + quantities[i]
+    return instrument_ids, dates, quantities, prices, quantities < 0
+
+
+def reference_fifo(instrument_ids, quantities, prices):
+    queues, realized = {}, {}
+    for iid, q, p in zip(instrument_ids.tolist(), quantities.tolist(), prices.tolist()):
+        lots = queues.setdefault(iid, deque())
+        if q > 0:
+            lots.append([q, p])
+            continue
+        remaining = -q
+        while remaining > 1e-12:
+            take = min(remaining, lots[0][0])
+            realized[iid] = realized.get(iid, 0.0) + take * (p - lots[0][1])
+            lots[0][0] -= take
+            remaining -= take
+            if lots[0][0] <= 1e-12:
+                lots.popleft()
+    return realized
+
+
+def timed(fn, repeat: int = 5):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+if __name__ == "__main__":
+    print(f"{'transactions':>12} {'fifo':>10} {'average':>10} {'python queue':>14}")
+    for n in (10_000, 50_000, 100_000):
+        ledger = make_ledger(n)
+        fifo_time, fifo = timed(lambda: compute_lots(*ledger, method="fifo"))
+        avg_time, _ = timed(lambda: compute_lots(*ledger, method="average"))
+        ref_time, ref = timed(lambda: reference_fifo(ledger[0], ledger[2], ledger[3]), repeat=1)
+
+        for iid, realized in ref.items():
+            assert abs(fifo[iid]["realized_gain"] - realized) <= 1e-6 * max(1.0, abs(realized))
+
+        print(f"{n:>12,} {fifo_time * 1000:>8.1f}ms {avg_time * 1000:>8.1f}ms {ref_time * 1000:>12.1f}ms")
@@ -0,0 +1,86 @@
+"""
+Benchmark the range backfill against valuing one date at a time.
+
+Seeds a throwaway SQLite database with 10 years of daily prices and FX
+rates for a 30-instrument portfolio, then times recalculate() over the whole
+range and calculate_portfolio_values() over a 30-day sample.
+
+Usage:
+    python benchmarks/bench_recalculate.py
+"""
+import os
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+_DB_FILE = os.path.join(tempfile.mkdtemp(prefix="portfolio_bench_"), "bench.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{_DB_FILE}"
+
+from backend.app import models
+from backend.app.db import SessionLocal, engine
+from backend.app.etl.calculate_values import calculate_portfolio_values
+from backend.app.etl.recalculate import recalculate
+
+START, END = date(2015, 1, 1), date(2024, 12, 31)
+CURRENCIES = ("HUF", "EUR", "USD")
+
+
+def seed(instruments: int = 30, transactions: int = 600, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    days = [START + timedelta(days=i) for i in range((END - START).days + 1)]
+    models.Base.metadata.drop_all(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as conn:
+        conn.execute(models.Portfolio.__table__.insert(), [{"id": 1, "name": "Bench"}])
+        conn.execute(models.Instrument.__table__.insert(), [
+            {"id": i, "isin": f"XX{i:010d}", "name": f"Instrument {i}", "currency": CURRENCIES[i % 3]}
+            for i in range(1, instruments + 1)
+        ])
+        conn.execute(models.Holding.__table__.insert(), [
+            {"portfolio_id": 1, "instrument_id": i, "quantity": 100, "acquisition_date": START, "acquisition_price": 50}
+            for i in range(1, instruments + 1)
+        ])
+        conn.execute(models.FxRate.__table__.insert(), [
+            {"rate_date": d, "base_currency": c, "target_currency": "HUF", "rate": round(float(rng.uniform(300, 420)), 4)}
+            for d in days if d.weekday() < 5 for c in ("EUR", "USD")
+        ])
+        conn.execute(models.Price.__table__.insert(), [
+            {"instrument_id": i, "price_date": d, "price": round(float(rng.uniform(40, 60)), 2),
+             "currency": CURRENCIES[i % 3], "source": "bench"}
+            for d in days if d.weekday() < 5 for i in range(1, instruments + 1)
+        ])
+        conn.execute(models.Transaction.__table__.insert(), [
+            {"portfolio_id": 1, "instrument_id": int(rng.integers(1, instruments + 1)),
+             "transaction_date": days[int(rng.integers(0, len(days)))],
+             "transaction_type": "BUY", "quantity": int(rng.integers(1, 50)),
+             "price": round(float(rng.uniform(40, 60)), 2)}
+            for _ in range(transactions)
+        ])
+
+
+if __name__ == "__main__":
+    seed()
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        rows = recalculate(1, START, END, db, chunk_size=1000)
+        backfill = time.perf_counter() - started
+
+        sample_days = 30
+        started = time.perf_counter()
+        for i in range(sample_days):
+            calculate_portfolio_values(1, END - timedelta(days=i), db)
+        per_date = (time.perf_counter() - started) / sample_days
+    finally:
+        db.close()
+
+    total_days = (END - START).days + 1
+    print(f"\nrecalculate():         {rows:,} rows over {total_days:,} days in {backfill:.1f}s")
+    print(f"per-date valuation:    {per_date * 1000:.0f}ms per date, "
+          f"~{per_date * total_days:.0f}s for the same range")
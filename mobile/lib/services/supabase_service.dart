@@ -31,24 +31,20 @@ class SupabaseService {
     DateTime? startDate,
     DateTime? endDate,
   }) async {
-    final data = await client
-        .from('portfolio_values_daily')
-        .select()
-        .order('snapshot_date', ascending: false);
-
-    // Filter in Dart since the old API doesn't support gte/lte easily
-    if (startDate != null || endDate != null) {
-      return data.where((item) {
-        final date = DateTime.parse(item['snapshot_date'] as String);
-        if (startDate != null && date.isBefore(startDate)) return false;
-        if (endDate != null && date.isAfter(endDate)) return false;
-        return true;
-      }).toList();
+    // Date range filtered server-side, so only the requested rows download
+    var query = client.from('portfolio_values_daily').select();
+    if (startDate != null) {
+      query = query.gte('snapshot_date', _isoDate(startDate));
     }
-
-    return data;
+    if (endDate != null) {
+      query = query.lte('snapshot_date', _isoDate(endDate));
+    }
+    return await query.order('snapshot_date', ascending: false);
   }
 
+  static String _isoDate(DateTime date) =>
+      date.toIso8601String().substring(0, 10);
+
   static Future<List<Map<String, dynamic>>> getPortfolioInstruments() async {
     return await client.from('instruments').select().order('name');
   }
@@ -62,25 +58,20 @@ class SupabaseService {
         .limit(1)
         .single();
 
-    final latestDate = latestSnapshot['snapshot_date'];
-
-    // Get all values for that date
-    final data = await client.from('portfolio_values_daily').select('''
-          *,
-          instruments(name, instrument_type, currency)
-        ''').order('instrument_id');
-
-    return data.where((item) => item['snapshot_date'] == latestDate).toList();
+    final latestDate = latestSnapshot['snapshot_date'] as String;
+    return await getPortfolioValuesByDate(latestDate);
   }
 
   static Future<List<Map<String, dynamic>>> getPortfolioValuesByDate(
       String date) async {
-    final data = await client.from('portfolio_values_daily').select('''
+    return await client
+        .from('portfolio_values_daily')
+        .select('''
           *,
           instruments(name, instrument_type, currency)
-        ''').order('instrument_id');
-
-    return data.where((item) => item['snapshot_date'] == date).toList();
+        ''')
+        .eq('snapshot_date', date)
+        .order('instrument_id');
   }
 
   static Future<List<String>> getAvailablePortfolioDates() async {
@@ -0,0 +1,61 @@
+"""
+Shared fixtures for the in-process API tests.
+
+The HTTP test scripts in this folder talk to a running server on localhost;
+these fixtures instead point the app at a throwaway SQLite database so the
+backend modules can be imported and exercised directly.
+"""
+import os
+import tempfile
+
+import pytest
+
+# Must happen before backend.app.config is imported anywhere
+_DB_FILE = os.path.join(tempfile.mkdtemp(prefix="portfolio_analyzer_tests_"), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{_DB_FILE}"
+
+
+@pytest.fixture
+def db_engine():
+    """Fresh schema for every test"""
+    from backend.app.db import engine
+    from backend.app import models, cost_basis, returns, price_index, fx_curve
+    models.Base.metadata.drop_all(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+    cost_basis._lot_cache.clear()
+    returns._returns_cache.clear()
+    # Journal versions restart with every fresh schema
+    price_index._index.reset()
+    fx_curve._curves.reset()
+    yield engine
+
+
+@pytest.fixture
+def db(db_engine):
+    from backend.app.db import SessionLocal
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def client(db_engine):
+    from fastapi.testclient import TestClient
+    from backend.app.main import app
+    return TestClient(app)
+
+
+@pytest.fixture
+def query_counter(db_engine):
+    """Collect every SQL statement sent to the database"""
+    from sqlalchemy import event
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db_engine, "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(db_engine, "before_cursor_execute", before_cursor_execute)
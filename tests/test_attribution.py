@@ -0,0 +1,72 @@
+"""
+Valuation change between two dates split into quantity, price and FX effects
+"""
+from datetime import date
+
+import pytest
+
+from backend.app import models, wealth_crud
+
+
+def _seed(db):
+    db.add(models.Portfolio(id=1, name="Main"))
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.Instrument(id=2, isin="US0378331005", name="Apple", currency="USD"))
+    db.add(models.Instrument(id=3, isin="IE00B4L5Y983", name="iShares World", currency="EUR"))
+    db.add(models.WealthCategory(id=1, category_type="cash", name="EUR account", currency="EUR"))
+    db.add(models.WealthCategory(id=2, category_type="loan", name="Mortgage", currency="HUF", is_liability=True))
+    for day, usd, eur in ((date(2024, 1, 31), 350, 380), (date(2024, 3, 28), 360, 390)):
+        db.add(models.FxRate(rate_date=day, base_currency="USD", target_currency="HUF", rate=usd))
+        db.add(models.FxRate(rate_date=day, base_currency="EUR", target_currency="HUF", rate=eur))
+    for day, instrument_id, quantity, price, fx_rate in (
+        (date(2024, 1, 31), 1, 10, 1500, 1), (date(2024, 1, 31), 2, 5, 180, 350),
+        (date(2024, 3, 28), 1, 12, 1600, 1), (date(2024, 3, 28), 2, 5, 170, 360),
+        (date(2024, 3, 28), 3, 2, 90, 390),
+    ):
+        db.add(models.PortfolioValueDaily(
+            portfolio_id=1, snapshot_date=day, instrument_id=instrument_id, quantity=quantity, price=price,
+            instrument_currency=["HUF", "USD", "EUR"][instrument_id - 1], fx_rate=fx_rate,
+            value_huf=quantity * price * fx_rate
+        ))
+    db.commit()
+    for category_id, day, value in (
+        (1, date(2024, 1, 31), 1000), (1, date(2024, 3, 28), 1200),
+        (2, date(2024, 1, 31), 20_000_000), (2, date(2024, 3, 28), 19_900_000),
+    ):
+        wealth_crud.add_or_update_wealth_value(db, category_id, day, value)
+
+
+def test_effects_add_up_to_the_change(client, db):
+    _seed(db)
+    # Both dates resolve as of the last valued day
+    result = client.get("/wealth/attribution", params={"start_date": "2024-02-04", "end_date": "2024-03-31"}).json()
+    effects = {
+        line["name"]: (line["quantity_effect_huf"], line["price_effect_huf"], line["fx_effect_huf"])
+        for line in result["instruments"] + result["wealth"]
+    }
+    assert effects == {
+        "Magyar Telekom": (2 * 1500, 12 * 100, 0),
+        "Apple": (0, 5 * -10 * 350, 5 * 170 * 10),
+        "iShares World": (2 * 90 * 390, 0, 0),
+        "EUR account": (0, 200 * 380, 1200 * 10),
+        "Mortgage": (0, 100_000, 0),
+    }
+    for line in result["instruments"] + result["wealth"]:
+        assert sum(effects[line["name"]]) == pytest.approx(line["change_huf"])
+
+    totals = result["totals"]
+    start = wealth_crud.calculate_total_wealth(db, date(2024, 2, 4))["net_wealth_huf"]
+    end = wealth_crud.calculate_total_wealth(db, date(2024, 3, 31))["net_wealth_huf"]
+    assert totals["change_huf"] == pytest.approx(end - start)
+    assert totals["quantity_effect_huf"] + totals["price_effect_huf"] + totals["fx_effect_huf"] == pytest.approx(end - start)
+
+
+def test_closed_position_and_bad_range(client, db):
+    _seed(db)
+    db.query(models.PortfolioValueDaily).filter_by(snapshot_date=date(2024, 3, 28), instrument_id=2).delete()
+    db.commit()
+    result = client.get("/wealth/attribution", params={"start_date": "2024-01-31", "end_date": "2024-03-28"}).json()
+    apple = next(line for line in result["instruments"] if line["name"] == "Apple")
+    assert (apple["quantity_effect_huf"], apple["price_effect_huf"], apple["fx_effect_huf"]) == (-5 * 180 * 350, 0, 0)
+
+    assert client.get("/wealth/attribution", params={"start_date": "2024-03-28", "end_date": "2024-01-31"}).status_code == 400
@@ -0,0 +1,71 @@
+"""
+Change journal: every write is recorded with an increasing version
+"""
+from datetime import date, datetime, timedelta
+
+from backend.app import crud, models, wealth_crud
+from backend.app.journal import current_version, prune_journal
+from backend.app.price_index import get_price_index
+
+
+def test_writes_are_journaled(db):
+    instrument = crud.add_new_instrument(db, "HU0000073507", "Magyar Telekom", "HUF")
+    crud.add_transaction(db, 1, instrument.id, date(2024, 1, 2), "BUY", 10, price=1500)
+    category = wealth_crud.add_wealth_category(db, "cash", "CIB account HUF", "HUF")
+    value = wealth_crud.add_or_update_wealth_value(db, category.id, date(2024, 1, 31), 1000)
+    wealth_crud.delete_wealth_value(db, value.id)
+
+    entries = [
+        (e.table_name, e.operation, e.portfolio_id)
+        for e in db.query(models.ChangeJournal).order_by(models.ChangeJournal.id)
+    ]
+    assert ("instruments", "insert", None) in entries
+    assert ("transactions", "insert", 1) in entries
+    assert entries[-1] == ("wealth_values", "delete", None)
+
+    assert current_version(db) == len(entries)
+    assert current_version(db, ["transactions"], portfolio_id=2) < current_version(db, ["transactions"], portfolio_id=1)
+
+
+def test_history_etag(client, db):
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.PortfolioValueDaily(
+        portfolio_id=1, snapshot_date=date(2024, 1, 31), instrument_id=1, quantity=1,
+        price=100, instrument_currency="HUF", fx_rate=1, value_huf=100
+    ))
+    db.commit()
+    params = {"start_date": "2024-01-01", "end_date": "2024-12-31"}
+
+    first = client.get("/portfolio/1/history", params=params)
+    etag = first.headers["etag"]
+    assert client.get("/portfolio/1/history", params=params, headers={"If-None-Match": etag}).status_code == 304
+
+    db.query(models.PortfolioValueDaily).update({"value_huf": 200})
+    db.commit()
+    changed = client.get("/portfolio/1/history", params=params, headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.json()[0]["value_huf"] == 200
+
+
+def test_prune_keeps_recent_entries_and_caches_reload(db):
+    crud.add_new_instrument(db, "HU0000073507", "Magyar Telekom", "HUF")
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 1, 2), price=1500, currency="HUF", source="BÉT"))
+    db.commit()
+    assert get_price_index(db).latest(1, date(2024, 1, 31)).price == 1500
+
+    # Entries older than the retention period: everything so far, with a
+    # price change the index has not seen yet
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 1, 3), price=1550, currency="HUF", source="BÉT"))
+    db.commit()
+    db.query(models.ChangeJournal).update({"changed_at": datetime.utcnow() - timedelta(days=60)})
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 1, 4), price=1600, currency="HUF", source="BÉT"))
+    db.commit()
+    entries = db.query(models.ChangeJournal).count()
+
+    assert prune_journal(db, retention_days=30, batch_size=1) == entries - 1
+    assert db.query(models.ChangeJournal).count() == 1
+    assert current_version(db) == entries
+
+    # Replaying the kept entry alone would miss the pruned one: the index reloads
+    index = get_price_index(db)
+    assert index.latest(1, date(2024, 1, 3)).price == 1550
+    assert index.latest(1, date(2024, 1, 31)).price == 1600
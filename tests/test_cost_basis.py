@@ -0,0 +1,132 @@
+"""
+Lot matching: FIFO and average cost against hand-computed ledgers
+"""
+from collections import deque
+from datetime import date
+
+import numpy as np
+import pytest
+
+from backend.app.cost_basis import compute_lots
+
+
+def _ledger(entries):
+    instrument_ids, dates, quantities, prices, realizes = zip(*entries)
+    return (
+        np.array(instrument_ids, dtype=np.int64),
+        np.array(dates, dtype="datetime64[D]"),
+        np.array(quantities, dtype=np.float64),
+        np.array(prices, dtype=np.float64),
+        np.array(realizes, dtype=bool),
+    )
+
+
+LEDGER = [
+    (1, date(2024, 1, 1), 10, 100.0, False),
+    (1, date(2024, 2, 1), 10, 120.0, False),
+    (1, date(2024, 3, 1), -15, 130.0, True),
+    (2, date(2024, 1, 5), 4, 50.0, False),
+    (1, date(2024, 4, 1), 5, 90.0, False),
+]
+
+
+def test_fifo():
+    result = compute_lots(*_ledger(LEDGER), method="fifo")
+    # Sold 10 @100 and 5 @120 for 15 @130
+    assert result[1]["realized_gain"] == pytest.approx(15 * 130 - (10 * 100 + 5 * 120))
+    assert result[1]["quantity"] == 10
+    assert result[1]["cost_basis"] == pytest.approx(5 * 120 + 5 * 90)
+    assert [lot["unit_cost"] for lot in result[1]["lots"]] == [120.0, 90.0]
+    assert result[2]["cost_basis"] == 200.0
+
+
+def test_average_cost():
+    result = compute_lots(*_ledger(LEDGER), method="average")
+    assert result[1]["realized_gain"] == pytest.approx(15 * (130 - 110))
+    assert result[1]["cost_basis"] == pytest.approx(5 * 110 + 5 * 90)
+
+
+def test_fifo_matches_lot_queue_on_random_ledger():
+    rng = np.random.default_rng(7)
+    n = 2000
+    instrument_ids = rng.integers(1, 6, n)
+    days = np.sort(rng.integers(0, 3000, n))
+    quantities = rng.integers(1, 50, n).astype(float)
+    prices = rng.uniform(10, 200, n).round(2)
+
+    # Sell only what is held so the reference never goes short
+    held = {}
+    for i in range(n):
+        iid = instrument_ids[i]
+        if rng.random() < 0.4 and held.get(iid, 0) > 0:
+            quantities[i] = -min(quantities[i], held[iid])
+        held[iid] = held.get(iid, 0) + quantities[i]
+
+    dates = np.datetime64("2015-01-01") + days.astype("timedelta64[D]")
+    result = compute_lots(instrument_ids, dates, quantities, prices, quantities < 0, method="fifo")
+
+    for iid in np.unique(instrument_ids):
+        lots, realized = deque(), 0.0
+        for q, p in zip(quantities[instrument_ids == iid], prices[instrument_ids == iid]):
+            if q > 0:
+                lots.append([q, p])
+                continue
+            remaining = -q
+            while remaining > 1e-12:
+                take = min(remaining, lots[0][0])
+                realized += take * (p - lots[0][1])
+                lots[0][0] -= take
+                remaining -= take
+                if lots[0][0] <= 1e-12:
+                    lots.popleft()
+        assert result[iid]["realized_gain"] == pytest.approx(realized, rel=1e-9, abs=1e-6)
+        assert result[iid]["cost_basis"] == pytest.approx(sum(q * p for q, p in lots), rel=1e-9, abs=1e-6)
+
+
+def test_sale_before_any_buy_closes_nothing():
+    ledger = [
+        (1, date(2024, 1, 1), -5, 150.0, True),
+        (1, date(2024, 2, 1), 10, 100.0, False),
+        (1, date(2024, 3, 1), -4, 120.0, True),
+        (1, date(2024, 4, 1), -20, 130.0, True),   # only 6 left to sell
+        (1, date(2024, 5, 1), 3, 110.0, False),
+    ]
+    fifo = compute_lots(*_ledger(ledger), method="fifo")[1]
+    average = compute_lots(*_ledger(ledger), method="average")[1]
+    assert fifo["realized_gain"] == pytest.approx(4 * 20 + 6 * 30)
+    assert average["realized_gain"] == pytest.approx(fifo["realized_gain"])
+    assert (fifo["quantity"], fifo["cost_basis"]) == (3, 330)
+    assert (average["quantity"], average["cost_basis"]) == (3, 330)
+
+
+def test_lot_cache_keeps_recent_dates_only(db, monkeypatch):
+    from backend.app import cost_basis, crud
+    monkeypatch.setattr(cost_basis, "LOT_CACHE_SIZE", 3)
+    instrument = crud.add_new_instrument(db, "HU0000073507", "Magyar Telekom", "HUF")
+    crud.add_transaction(db, 1, instrument.id, date(2024, 1, 2), "BUY", 10, price=1500)
+
+    for day in range(1, 11):
+        assert cost_basis.get_lot_state(db, 1, date(2024, 2, day))[instrument.id]["quantity"] == 10
+    assert list(cost_basis._lot_cache) == [(1, "fifo", date(2024, 2, day)) for day in (8, 9, 10)]
+
+
+def test_gains_in_huf_cost_lots_at_their_own_rate(db):
+    from backend.app import cost_basis, crud, models
+    from backend.app.etl.calculate_values import calculate_portfolio_values
+    instrument = crud.add_new_instrument(db, "AT0000605332", "Erste Bond", "EUR")
+    for day, rate in ((date(2024, 1, 2), 380), (date(2024, 3, 1), 400)):
+        db.add(models.FxRate(rate_date=day, base_currency="EUR", target_currency="HUF", rate=rate))
+    db.add(models.Price(instrument_id=instrument.id, price_date=date(2024, 3, 1), price=12,
+                        currency="EUR", source="Erste"))
+    db.commit()
+    crud.add_transaction(db, 1, instrument.id, date(2024, 1, 2), "BUY", 10, price=10)
+
+    gains, = cost_basis.calculate_gains(db, 1, date(2024, 3, 1))
+    assert gains["unrealized_gain"] == 20
+    assert gains["cost_basis_huf"] == 10 * 10 * 380
+    assert gains["unrealized_gain_huf"] == 10 * 12 * 400 - 10 * 10 * 380
+
+    # Agrees with the stored snapshot
+    calculate_portfolio_values(1, date(2024, 3, 1), db)
+    stored = db.query(models.PortfolioValueDaily).filter_by(instrument_id=instrument.id).one()
+    assert float(stored.unrealized_gain_huf) == gains["unrealized_gain_huf"]
@@ -0,0 +1,72 @@
+"""
+Server-sent events: ETL progress and data-version bumps
+"""
+import asyncio
+import json
+
+from backend.app import crud, events
+
+
+async def frames(stream, count):
+    """Parse the next `count` SSE frames into (id, event, data)"""
+    parsed = []
+    while len(parsed) < count:
+        frame = await asyncio.wait_for(anext(stream), timeout=5)
+        if frame.startswith(":"):
+            continue
+        fields = dict(line.split(": ", 1) for line in frame.strip().split("\n"))
+        parsed.append((int(fields["id"]), fields["event"], json.loads(fields["data"])))
+    return parsed
+
+
+def test_stream_publishes_events_and_version_bumps(db):
+    async def scenario():
+        stream = events.stream()
+        (first_id, event, data), = await frames(stream, 1)
+        assert event == "data_version"
+
+        # Published from another thread, like a background ETL run
+        await asyncio.to_thread(events.publish, "etl", {"status": "step_completed", "step": 1})
+        crud.add_new_instrument(db, "HU0000073507", "Magyar Telekom", "HUF")
+        events.check_data_version(force=True)
+
+        (_, etl, progress), (_, bump, version) = await frames(stream, 2)
+        assert (etl, progress["step"]) == ("etl", 1)
+        assert bump == "data_version" and version["version"] > data["version"]
+
+        # Reconnecting with Last-Event-ID replays what was missed
+        replay = events.stream(last_event_id=first_id)
+        assert [e for _, e, _ in await frames(replay, 2)] == ["etl", "data_version"]
+
+        # An id this run never handed out (a restarted server) starts over
+        restarted = events.stream(last_event_id=events._last_id + 1000)
+        (_, event, current), = await frames(restarted, 1)
+        assert (event, current["version"]) == ("data_version", version["version"])
+
+        for s in (stream, replay, restarted):
+            await s.aclose()
+        assert not events._subscribers
+
+    asyncio.run(scenario())
+
+
+def test_one_etl_run_at_a_time(client):
+    from backend.app import main
+
+    assert main._etl_lock.acquire(blocking=False)
+    try:
+        assert client.post("/etl/run-daily-update", params={"background": True}).status_code == 409
+    finally:
+        main._etl_lock.release()
+
+
+def test_etl_lock_released_when_the_worker_cannot_start(client, monkeypatch):
+    from backend.app import main
+
+    def no_threads(self):
+        raise RuntimeError("can't start new thread")
+
+    monkeypatch.setattr(main.threading.Thread, "start", no_threads)
+    client_no_raise = type(client)(main.app, raise_server_exceptions=False)
+    assert client_no_raise.post("/etl/run-daily-update", params={"background": True}).status_code == 500
+    assert not main._etl_lock.locked()
@@ -0,0 +1,63 @@
+"""
+FX curves: as-of lookups, inverse pairs and triangulation
+"""
+from datetime import date
+from decimal import Decimal
+
+import numpy as np
+
+from backend.app import models, wealth_crud
+from backend.app.fx_curve import get_fx_curves
+
+
+def _rate(db, day, base, target, rate):
+    db.add(models.FxRate(rate_date=day, base_currency=base, target_currency=target, rate=rate, source="MNB"))
+
+
+def _seed(db):
+    for day, eur, usd, czk in ((date(2024, 1, 2), 380, 350, 15.5), (date(2024, 1, 5), 390, 360, 15.8)):
+        _rate(db, day, "EUR", "HUF", eur)
+        _rate(db, day, "USD", "HUF", usd)
+        _rate(db, day, "CZK", "HUF", czk)
+    _rate(db, date(2024, 1, 3), "GBP", "EUR", Decimal("1.15"))  # only quoted against EUR
+    db.commit()
+
+
+def test_direct_inverse_and_triangulated_rates(db):
+    _seed(db)
+    fx = get_fx_curves(db)
+
+    assert fx.rate("EUR", "HUF", date(2024, 1, 4)) == 380
+    assert fx.rate("EUR", "HUF", date(2024, 1, 1)) is None
+    assert fx.rate("HUF", "EUR", date(2024, 1, 6)) == Decimal(1) / 390
+    # Through HUF: EUR/HUF ÷ USD/HUF, each leg as of the date
+    assert fx.rate("EUR", "USD", date(2024, 1, 4)) == Decimal(380) / 350
+    # Through EUR: GBP/EUR × EUR/HUF
+    assert fx.rate("GBP", "HUF", date(2024, 1, 2)) is None
+    assert fx.rate("GBP", "HUF", date(2024, 1, 6)) == Decimal("1.15") * 390
+    assert fx.rate("SEK", "HUF", date(2024, 1, 6)) is None
+
+    days = np.arange(np.datetime64("2024-01-01"), np.datetime64("2024-01-07"))
+    assert fx.rates_on("EUR", "USD", days).tolist() == [
+        fx.rate("EUR", "USD", d) for d in days.astype(date).tolist()
+    ]
+
+
+def test_reloads_when_rates_change(db):
+    _seed(db)
+    assert get_fx_curves(db).rate("EUR", "HUF", date(2024, 1, 10)) == 390
+    _rate(db, date(2024, 1, 8), "EUR", "HUF", 395)
+    db.commit()
+    assert get_fx_curves(db).rate("EUR", "HUF", date(2024, 1, 10)) == 395
+
+
+def test_wealth_rates_cover_every_stored_currency(db):
+    _seed(db)
+    rates = wealth_crud.get_latest_fx_rates(db, date(2024, 1, 4))
+    assert rates == {
+        "HUF": 1.0, "EUR": 380.0, "USD": 350.0, "CZK": 15.5, "GBP": float(Decimal("1.15") * 380)
+    }
+
+    in_eur = wealth_crud.get_latest_fx_rates(db, date(2024, 1, 6), base_currency="EUR")
+    assert in_eur["EUR"] == 1.0
+    assert in_eur["USD"] == float(Decimal(360) / 390)
@@ -0,0 +1,69 @@
+"""
+Process-pool valuation writes the same rows as valuing in-process
+"""
+from datetime import date
+
+from backend.app import models
+from backend.app.etl import parallel_values
+from backend.app.etl.parallel_values import plan_tasks, value_portfolios
+
+START, END = date(2024, 1, 1), date(2024, 2, 29)
+
+
+def _seed(db):
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.Instrument(id=2, isin="IE00B4L5Y983", name="iShares MSCI World", currency="EUR"))
+    for portfolio_id in (1, 2, 3):
+        db.add(models.Portfolio(id=portfolio_id, name=f"Portfolio {portfolio_id}"))
+        db.add(models.Holding(portfolio_id=portfolio_id, instrument_id=1, quantity=10 * portfolio_id))
+        db.add(models.Holding(portfolio_id=portfolio_id, instrument_id=2, quantity=portfolio_id))
+    db.add(models.FxRate(rate_date=date(2023, 12, 29), base_currency="EUR", target_currency="HUF", rate=380))
+    db.add(models.FxRate(rate_date=date(2024, 2, 1), base_currency="EUR", target_currency="HUF", rate=385))
+    db.add(models.Price(instrument_id=1, price_date=date(2023, 12, 29), price=1500, currency="HUF", source="BÉT"))
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 1, 20), price=1550, currency="HUF", source="BÉT"))
+    db.add(models.Price(instrument_id=2, price_date=date(2024, 1, 2), price=85, currency="EUR", source="yahoo"))
+    db.commit()
+
+
+def _stored(db):
+    db.expire_all()
+    return {
+        (r.portfolio_id, r.snapshot_date, r.instrument_id): (r.quantity, r.price, r.value_huf, r.value_eur)
+        for r in db.query(models.PortfolioValueDaily)
+    }
+
+
+def test_plan_tasks_covers_range_in_chunks():
+    tasks = plan_tasks([1, 2], START, END, chunk_days=30)
+    assert tasks == [
+        (1, date(2024, 1, 1), date(2024, 1, 30)), (1, date(2024, 1, 31), date(2024, 2, 29)),
+        (2, date(2024, 1, 1), date(2024, 1, 30)), (2, date(2024, 1, 31), date(2024, 2, 29)),
+    ]
+
+
+def test_pool_matches_in_process(db):
+    _seed(db)
+    assert value_portfolios(db, [1, 2, 3], START, END, workers=1) == 3 * (60 + 59)  # no EUR fund price on Jan 1
+    expected = _stored(db)
+
+    db.query(models.PortfolioValueDaily).delete()
+    db.commit()
+    assert value_portfolios(db, [1, 2, 3], START, END, workers=2, chunk_days=20) == 3 * (60 + 59)
+    assert _stored(db) == expected
+
+
+def test_small_runs_in_process_and_keep_imported_history(db, monkeypatch):
+    _seed(db)
+    # Month-end row as the history CSV imports write it
+    db.add(models.Instrument(id=3, isin="HU0000702709", name="Imported fund", currency="HUF"))
+    db.add(models.PortfolioValueDaily(portfolio_id=1, snapshot_date=date(2024, 1, 31), instrument_id=3, quantity=1,
+                                      price=5_000_000, instrument_currency="HUF", fx_rate=1, value_huf=5_000_000))
+    db.commit()
+
+    def no_pool(*args, **kwargs):
+        raise AssertionError("process pool started")
+    monkeypatch.setattr(parallel_values, "ProcessPoolExecutor", no_pool)
+    assert value_portfolios(db, [1, 2, 3], date(2024, 1, 31), date(2024, 1, 31), workers=4) == 6
+    assert value_portfolios(db, [1, 2, 3], START, END, workers=4) == 3 * (60 + 59)
+
+    assert _stored(db)[(1, date(2024, 1, 31), 3)][2] == 5_000_000
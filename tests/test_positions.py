@@ -0,0 +1,116 @@
+"""
+Position engine: quantities derived from the transaction ledger
+"""
+from datetime import date
+from decimal import Decimal
+
+from backend.app import models
+from backend.app.positions import PositionSeries, build_position_series, get_positions
+
+
+def _seed(db):
+    db.add(models.Portfolio(id=1, name="Main"))
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.Instrument(id=2, isin="HU0000153937", name="MOL", currency="HUF"))
+    db.add(models.Holding(portfolio_id=1, instrument_id=1, quantity=100, acquisition_date=date(2024, 1, 1)))
+    for tx_date, tx_type, quantity, instrument_id in [
+        (date(2024, 3, 1), "BUY", 50, 1),
+        (date(2024, 6, 1), "SELL", 30, 1),
+        (date(2024, 6, 1), "ADJUST", -5, 1),
+        (date(2024, 2, 1), "BUY", 10, 2),
+        (date(2024, 4, 1), "SELL", 10, 2),
+    ]:
+        db.add(models.Transaction(
+            portfolio_id=1, instrument_id=instrument_id, transaction_date=tx_date,
+            transaction_type=tx_type, quantity=quantity
+        ))
+    db.commit()
+
+
+def test_step_series_collapses_same_day_entries():
+    series = PositionSeries.from_deltas(
+        [date(2024, 6, 1), date(2024, 1, 1), date(2024, 6, 1)],
+        [Decimal("-30"), Decimal("100"), Decimal("-5")]
+    )
+    assert len(series) == 2
+    assert series.quantity_on(date(2023, 12, 31)) == 0
+    assert series.quantity_on(date(2024, 5, 31)) == 100
+    assert series.quantity_on(date(2024, 6, 1)) == 65
+    assert list(series.quantities_on([date(2023, 1, 1), date(2024, 1, 1)])) == [0, 100]
+
+
+def test_positions_follow_ledger(db):
+    _seed(db)
+    series = build_position_series(db, 1)
+    assert series[1].quantity_on(date(2024, 3, 15)) == 150
+    assert series[1].quantity_on(date(2024, 6, 1)) == 115
+
+    # Fully sold positions drop out
+    assert get_positions(db, 1, date(2024, 3, 1)) == {1: 150, 2: 10}
+    assert get_positions(db, 1, date(2024, 4, 1)) == {1: 150}
+
+
+def _position_rows(db):
+    return [
+        (r.instrument_id, r.effective_date, float(r.quantity))
+        for r in db.query(models.PositionHistory).order_by(
+            models.PositionHistory.instrument_id, models.PositionHistory.effective_date
+        )
+    ]
+
+
+def test_incremental_maintenance_matches_full_rebuild(db):
+    from backend.app import crud
+    from backend.app.positions import rebuild_position_tables
+    _seed(db)
+    rebuild_position_tables(db, 1)  # seed maintained tables
+    db.commit()
+
+    # Back-dated trade between existing steps, then a bulk batch
+    crud.add_transaction(db, 1, 1, date(2024, 4, 15), "SELL", 20)
+    before_trade = [r for r in _position_rows(db) if r[1] < date(2024, 4, 15)]
+    crud.add_transactions(db, [
+        {"portfolio_id": 1, "instrument_id": 2, "transaction_date": date(2024, 5, 1),
+         "transaction_type": "BUY", "quantity": 7},
+        {"portfolio_id": 1, "instrument_id": 2, "transaction_date": date(2024, 5, 1),
+         "transaction_type": "BUY", "quantity": 3},
+    ])
+    incremental = _position_rows(db)
+    assert [r for r in incremental if r[1] < date(2024, 4, 15)] == before_trade
+
+    rebuild_position_tables(db, 1)
+    db.commit()
+    assert _position_rows(db) == incremental
+
+    current = {r.instrument_id: float(r.quantity) for r in db.query(models.PositionCurrent)}
+    assert current == {1: 95.0, 2: 10.0}
+
+
+def test_writes_bypassing_the_api_are_replayed_until_synced(db):
+    from backend.app import crud
+    from backend.app.positions import load_position_series, sync_position_tables
+    _seed(db)
+    # Never built: reads replay the ledger and write nothing
+    assert load_position_series(db, 1)[1].quantity_on(date(2024, 6, 1)) == 115
+    assert db.query(models.PositionHistory).count() == 0
+    assert sync_position_tables(db) == 1
+    rows = _position_rows(db)
+
+    # A direct insert, as the mobile app does
+    db.add(models.Transaction(portfolio_id=1, instrument_id=1, transaction_date=date(2024, 7, 1),
+                              transaction_type="BUY", quantity=5))
+    db.commit()
+    assert load_position_series(db, 1)[1].quantity_on(date(2024, 7, 1)) == 120
+    assert _position_rows(db) == rows
+
+    # The next API write patches nothing on top of stale tables
+    crud.add_transaction(db, 1, 2, date(2024, 8, 1), "BUY", 3)
+    assert sync_position_tables(db) == 0
+    series = load_position_series(db, 1)
+    assert (series[1].quantity_on(date(2024, 7, 1)), series[2].quantity_on(date(2024, 8, 1))) == (120, 3)
+
+    # Holdings edits move the ledger version too
+    db.query(models.Holding).update({"quantity": 90})
+    db.commit()
+    assert load_position_series(db, 1)[1].quantity_on(date(2024, 7, 1)) == 110
+    assert sync_position_tables(db) == 1
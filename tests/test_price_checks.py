@@ -0,0 +1,93 @@
+"""
+Batch sanity checks of fetched prices against recent history
+"""
+from datetime import date, timedelta
+from decimal import Decimal
+
+import pytest
+
+from backend.app import models
+from backend.app.price_checks import PriceCandidate, check_prices
+
+DAY = date(2024, 3, 1)
+
+
+def _seed(db):
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.Instrument(id=2, isin="HU0000702709", name="Erste Bond Fund", currency="HUF", instrument_type="fund"))
+    db.add(models.Instrument(id=3, isin="HU0000153937", name="MOL", currency="HUF"))
+    for k in range(30):
+        day = DAY - timedelta(days=30 - k)
+        # About 1% daily moves for the stock, a slowly rising fund
+        db.add(models.Price(instrument_id=1, price_date=day, price=1500 * (1.01 if k % 2 else 0.99), currency="HUF", source="BÉT"))
+        db.add(models.Price(instrument_id=2, price_date=day, price=2.4 + k * 0.001, currency="HUF", source="Erste Market"))
+    db.add(models.Price(instrument_id=3, price_date=DAY - timedelta(days=1), price=2800, currency="HUF", source="BÉT"))
+    db.commit()
+
+
+def test_outliers_flagged_in_one_batch(db):
+    _seed(db)
+    reasons = check_prices(db, [
+        PriceCandidate(1, DAY, 1510, "HUF", "HUF"),       # ordinary move
+        PriceCandidate(1, DAY, 1800, "HUF", "HUF"),       # +20%: far outside 1% moves
+        PriceCandidate(2, DAY, 2446.675, "HUF", "HUF"),   # decimal point lost
+        PriceCandidate(2, DAY, 2.43, "EUR", "HUF"),       # another currency's NAV
+        PriceCandidate(3, DAY, 2900, None, "HUF"),        # too little history for a z-score
+        PriceCandidate(3, DAY, 280, None, "HUF"),
+        PriceCandidate(4, DAY, 100, None, "HUF"),         # no history at all
+    ])
+    assert reasons[0] is None
+    assert "z-score" in reasons[1] and "jump" not in reasons[1]
+    assert "jump" in reasons[2]
+    assert reasons[3] == "quoted in EUR, instrument is HUF"
+    assert reasons[4] is None
+    assert "10.0x jump" in reasons[5]
+    assert reasons[6] is None
+    assert check_prices(db, []) == []
+
+
+def test_price_fetch_quarantines_outliers(db):
+    pytest.importorskip("requests")
+    pytest.importorskip("bs4")
+    from backend.app.etl.fetch_prices import store_checked_prices
+    _seed(db)
+
+    telekom, fund = db.get(models.Instrument, 1), db.get(models.Instrument, 2)
+    results = store_checked_prices([
+        (telekom, Decimal("1510"), "BÉT", "HUF"),
+        (fund, Decimal("2446.675"), "Erste Market", "HUF"),
+    ], DAY, db)
+    assert results == [(True, "fetched"), (True, "quarantined")]
+
+    held, = db.query(models.PriceQuarantine).all()
+    assert (held.instrument_id, float(held.price), held.source) == (2, 2446.675, "Erste Market")
+    assert db.query(models.Price).filter_by(price_date=DAY).count() == 1
+
+    # Re-running the fetch does not queue the same price again
+    assert store_checked_prices([(fund, Decimal("2446.675"), "Erste Market", "HUF")], DAY, db) == [(True, "quarantined")]
+    assert db.query(models.PriceQuarantine).count() == 1
+
+
+def test_quarantined_price_released_after_review(client, db):
+    _seed(db)
+    # A 1:10 split: every fetch from now on fails the jump check
+    db.add(models.PriceQuarantine(instrument_id=3, price_date=DAY, price=280, currency="HUF", source="BÉT",
+                                  reason="10.0x jump from last price 2800"))
+    db.add(models.PriceQuarantine(instrument_id=1, price_date=DAY, price=1510, currency="EUR", source="BÉT",
+                                  reason="quoted in EUR, instrument is HUF"))
+    db.commit()
+
+    held = client.get("/prices/quarantine").json()
+    assert [(h["instrument_name"], h["price"]) for h in held] == [("Magyar Telekom", 1510), ("MOL", 280)]
+    split, wrong_currency = held[1]["id"], held[0]["id"]
+
+    assert client.post(f"/prices/quarantine/{wrong_currency}/release").status_code == 400
+    released = client.post(f"/prices/quarantine/{split}/release").json()
+    assert (released["price_date"], released["price"], released["source"]) == (DAY.isoformat(), 280, "BÉT")
+    assert client.post(f"/prices/quarantine/{split}/release").status_code == 404
+
+    # Later prices are checked against the released one
+    assert check_prices(db, [PriceCandidate(3, DAY + timedelta(days=1), 285, None, "HUF")]) == [None]
+
+    assert client.delete(f"/prices/quarantine/{wrong_currency}").status_code == 200
+    assert client.get("/prices/quarantine").json() == []
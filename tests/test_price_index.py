@@ -0,0 +1,119 @@
+"""
+In-memory price index: lazy load, incremental refresh, snapshot provenance
+"""
+from datetime import date
+
+import pytest
+
+from backend.app import crud, models
+from backend.app.etl.calculate_values import calculate_portfolio_values
+from backend.app.price_index import get_price_index
+
+
+def _seed(db):
+    db.add(models.Portfolio(id=1, name="Main"))
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.Holding(portfolio_id=1, instrument_id=1, quantity=10))
+    db.add(models.Price(id=1, instrument_id=1, price_date=date(2024, 1, 2), price=1500, currency="HUF", source="BÉT"))
+    db.commit()
+
+
+def test_refresh_replays_inserts_updates_and_deletes(db, query_counter):
+    _seed(db)
+    index = get_price_index(db)
+    assert index.latest(1, date(2024, 1, 31)).price == 1500
+
+    # Nothing changed: one version check, no reload
+    query_counter.clear()
+    get_price_index(db)
+    assert len(query_counter) == 1
+
+    db.add(models.Price(id=2, instrument_id=1, price_date=date(2024, 1, 10), price=1520, currency="HUF", source="BÉT"))
+    db.commit()
+    assert get_price_index(db).latest(1, date(2024, 1, 31)).price == 1520
+
+    crud.add_manual_price(db, 1, date(2024, 1, 20), 1600, "HUF", created_by="anna")
+    hit = get_price_index(db).latest(1, date(2024, 1, 31))
+    assert (hit.price, hit.label) == (1600, "manual (anna)")
+
+    db.query(models.Price).filter_by(id=1).update({"price": 1400})
+    db.query(models.Price).filter_by(id=2).delete()
+    db.query(models.ManualPrice).delete()
+    db.commit()
+    hit = get_price_index(db).latest(1, date(2024, 1, 31))
+    assert (hit.price, hit.price_date, hit.label) == (1400, date(2024, 1, 2), "BÉT")
+
+
+def test_snapshot_price_source(client, db):
+    _seed(db)
+    crud.add_manual_price(db, 1, date(2024, 1, 20), 1600, "HUF", created_by="anna")
+    calculate_portfolio_values(1, date(2024, 1, 31), db)
+
+    item, = client.get("/portfolio/1/snapshot", params={"snapshot_date": "2024-01-31"}).json()
+    assert (item["price"], item["price_source"]) == (1600, "manual (anna)")
+
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 1, 25), price=1550, currency="HUF", source="BÉT"))
+    db.commit()
+    calculate_portfolio_values(1, date(2024, 1, 31), db)
+    item, = client.get("/portfolio/1/snapshot", params={"snapshot_date": "2024-01-31"}).json()
+    assert (item["price"], item["price_source"]) == (1550, "BÉT")
+
+
+def test_carry_forward_resolved_at_read_time(client, db):
+    _seed(db)
+    # Left over from before carry-forward moved to the as-of lookup
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 1, 3), price=1500, currency="HUF",
+                        source="BÉT (carried forward)"))
+    db.commit()
+    hit = get_price_index(db).latest(1, date(2024, 1, 31))
+    assert (hit.price, hit.price_date, hit.source) == (1500, date(2024, 1, 2), "BÉT")
+
+    calculate_portfolio_values(1, date(2024, 1, 31), db)
+    item, = client.get("/portfolio/1/snapshot", params={"snapshot_date": "2024-01-31"}).json()
+    assert (item["price_source"], item["price_date"], item["price_age_days"]) == ("BÉT", "2024-01-02", 29)
+
+
+def test_price_fetch_writes_no_carried_forward_rows(db):
+    pytest.importorskip("requests")
+    pytest.importorskip("bs4")
+    from backend.app.etl.fetch_prices import fetch_and_store_price
+    _seed(db)
+
+    # No fetcher for this type, like a failed scrape
+    instrument = db.get(models.Instrument, 1)
+    assert fetch_and_store_price(instrument, date(2024, 1, 31), db) == (True, "carried_forward")
+    assert db.query(models.Price).count() == 1
+
+
+def test_uncommitted_rows_stay_out_of_the_shared_index(db):
+    _seed(db)
+    get_price_index(db)
+
+    db.add(models.Price(id=2, instrument_id=1, price_date=date(2024, 1, 10), price=1520, currency="HUF", source="BÉT"))
+    db.flush()
+    assert get_price_index(db).latest(1, date(2024, 1, 31)).price == 1500
+
+    db.rollback()
+    assert get_price_index(db).latest(1, date(2024, 1, 31)).price == 1500
+
+
+def test_reload_swaps_in_a_complete_index(db, monkeypatch):
+    from backend.app import price_index
+    _seed(db)
+    index = get_price_index(db)
+    seen = []
+
+    # Lookups made while the reload is reading rows still see the old index
+    real_load = price_index.PriceIndex._load
+
+    def load_and_look(self, *args, **kwargs):
+        touched = real_load(self, *args, **kwargs)
+        seen.append(index.latest(1, date(2024, 1, 31)))
+        return touched
+
+    monkeypatch.setattr(price_index.PriceIndex, "_load", load_and_look)
+    index.version += 1000  # as if the database had been reset
+    assert index.latest(1, date(2024, 1, 31)).price == 1500
+    get_price_index(db)
+    assert [hit.price for hit in seen] == [1500]
+    assert index.latest(1, date(2024, 1, 31)).price == 1500
@@ -0,0 +1,42 @@
+"""
+Per-instrument price staleness, refreshed in bulk and served to the dashboard
+"""
+from datetime import date
+
+from backend.app import models
+from backend.app.price_staleness import refresh_price_staleness
+
+
+def _seed(db):
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.Instrument(id=2, isin="IE00B4L5Y983", name="iShares World", currency="EUR"))
+    db.add(models.Instrument(id=3, isin="HU0000702709", name="Erste Bond Fund", currency="HUF"))
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 3, 28), price=1500, currency="HUF", source="BÉT"))
+    db.add(models.Price(instrument_id=2, price_date=date(2024, 3, 20), price=90, currency="EUR", source="Erste Market"))
+    # Left-over carried-forward copy: not a real price
+    db.add(models.Price(instrument_id=2, price_date=date(2024, 3, 27), price=90, currency="EUR",
+                        source="Erste Market (carried forward)"))
+    db.commit()
+
+
+def test_staleness_refreshed_in_bulk(client, db, query_counter):
+    _seed(db)
+    refresh_price_staleness(db, date(2024, 4, 2))
+    query_counter.clear()
+    assert refresh_price_staleness(db, date(2024, 4, 3)) == 3
+    # Instruments, price index version check, one upsert for all rows
+    assert len(query_counter) <= 3
+    assert len([q for q in query_counter if "price_staleness" in q]) == 1
+
+    rows = client.get("/prices/staleness").json()
+    assert [(r["name"], r["last_price_date"], r["last_price_source"], r["days_carried_forward"]) for r in rows] == [
+        ("Erste Bond Fund", None, None, None),
+        # Mar 21-22, 25-28, Apr 2-3 (Good Friday and Easter Monday closed on TARGET)
+        ("iShares World", "2024-03-20", "Erste Market", 8),
+        # Apr 2-3 (Good Friday and Easter Monday closed on BÉT)
+        ("Magyar Telekom", "2024-03-28", "BÉT", 2),
+    ]
+    assert rows[1]["checked_date"] == "2024-04-03"
+    assert [r["name"] for r in client.get("/prices/staleness", params={"min_days": 5}).json()] == [
+        "Erste Bond Fund", "iShares World"
+    ]
@@ -0,0 +1,122 @@
+"""
+Range backfill: recalculate() matches valuing each date on its own
+"""
+from datetime import date, timedelta
+from decimal import Decimal
+
+import numpy as np
+import pytest
+
+from backend.app import crud, models, positions
+from backend.app.cost_basis import compute_lots
+from backend.app.etl.calculate_values import calculate_portfolio_values
+from backend.app.etl.recalculate import _cost_basis_segments, recalculate
+
+START, END = date(2024, 1, 1), date(2024, 3, 31)
+
+
+def _seed(db):
+    db.add(models.Portfolio(id=1, name="Main"))
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.Instrument(id=2, isin="IE00B4L5Y983", name="iShares MSCI World", currency="EUR"))
+    db.add(models.Instrument(id=3, isin="US0378331005", name="Apple", currency="USD"))
+    db.add(models.Holding(portfolio_id=1, instrument_id=1, quantity=10))
+    db.add(models.Holding(portfolio_id=1, instrument_id=2, quantity=4,
+                          acquisition_date=date(2023, 12, 1), acquisition_price=80))
+    for day, eur, usd in ((date(2023, 11, 30), 380, 350), (date(2024, 1, 15), 385, 355), (date(2024, 3, 1), 390, 360)):
+        db.add(models.FxRate(rate_date=day, base_currency="EUR", target_currency="HUF", rate=eur))
+        db.add(models.FxRate(rate_date=day, base_currency="USD", target_currency="HUF", rate=usd))
+    db.add(models.Price(instrument_id=1, price_date=date(2023, 12, 29), price=1500, currency="HUF", source="test"))
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 2, 1), price=1550, currency="HUF", source="BÉT"))
+    db.add(models.Price(instrument_id=2, price_date=date(2024, 1, 2), price=85, currency="EUR", source="yahoo"))
+    db.add(models.Price(instrument_id=2, price_date=date(2024, 2, 20), price=88, currency="EUR", source="yahoo"))
+    db.add(models.ManualPrice(instrument_id=2, override_date=date(2024, 2, 10), price=90, currency="EUR"))
+    db.add(models.Price(instrument_id=3, price_date=date(2024, 1, 2), price=180, currency="USD", source="yahoo"))
+    db.commit()
+    crud.add_transaction(db, 1, 3, date(2024, 1, 20), "BUY", 5, price=175)
+    crud.add_transaction(db, 1, 2, date(2024, 2, 5), "BUY", 2, price=86)
+    crud.add_transaction(db, 1, 3, date(2024, 3, 10), "SELL", 5, price=190)
+
+
+def _stored(db):
+    db.expire_all()
+    return {
+        (r.snapshot_date, r.instrument_id): (r.quantity, r.price, r.fx_rate, r.value_huf, r.cost_basis_huf)
+        for r in db.query(models.PortfolioValueDaily)
+    }
+
+
+def _round(values):
+    return {
+        key: tuple(None if v is None else round(float(v), 4) for v in value)
+        for key, value in values.items()
+    }
+
+
+def test_matches_per_date_valuation(db):
+    _seed(db)
+    day = START
+    while day <= END:
+        calculate_portfolio_values(1, day, db)
+        day += timedelta(days=1)
+    expected = _stored(db)
+
+    db.query(models.PortfolioValueDaily).delete()
+    db.commit()
+    written = recalculate(1, START, END, db, chunk_size=50)
+
+    assert written == len(expected)
+    assert _round(_stored(db)) == _round(expected)
+    # Apple was sold on 2024-03-10
+    assert (date(2024, 3, 9), 3) in expected and (date(2024, 3, 10), 3) not in expected
+
+
+def test_removes_rows_for_positions_no_longer_held(db):
+    _seed(db)
+    recalculate(1, START, END, db)
+    # Apple now bought and sold before the range
+    for transaction in db.query(models.Transaction).filter_by(instrument_id=3):
+        transaction.transaction_date -= timedelta(days=90)
+    db.flush()
+    positions.rebuild_position_tables(db, 1)
+    db.commit()
+    recalculate(1, START, END, db)
+
+    assert not any(instrument_id == 3 for _, instrument_id in _stored(db))
+
+
+def test_keeps_imported_history_rows(db):
+    _seed(db)
+    # Month-end row as the history CSV imports write it, for an instrument without transactions
+    db.add(models.Instrument(id=4, isin="HU0000702709", name="Imported fund", currency="HUF"))
+    db.add(models.PortfolioValueDaily(portfolio_id=1, snapshot_date=date(2024, 2, 29), instrument_id=4, quantity=1,
+                                      price=5_000_000, instrument_currency="HUF", fx_rate=1, value_huf=5_000_000))
+    db.commit()
+    recalculate(1, START, END, db)
+
+    assert _stored(db)[(date(2024, 2, 29), 4)][3] == 5_000_000
+
+
+def test_cost_basis_segments_match_lots_per_date():
+    class Rates:
+        """No rate before day 200, then 380"""
+        def rates_on(self, base, target, days):
+            return np.array([Decimal("380") if d >= 200 else None for d in days.astype("int64").tolist()], dtype=object)
+
+    rng = np.random.default_rng(3)
+    n = 300
+    days = np.sort(rng.integers(0, 400, n)).astype("datetime64[D]")
+    quantities = rng.integers(1, 20, n) * np.where(rng.random(n) < 0.4, -1.0, 1.0)
+    prices = rng.choice([0.0, 10.5, 99.25], n)
+    ledger = (np.ones(n, dtype=np.int64), days, quantities, prices, quantities < 0)
+
+    changes, huf, local, has_cost = _cost_basis_segments(ledger, 1, Rates(), "EUR", np.datetime64(100, "D"))
+    for change, huf_part, local_part, cost in zip(changes, huf, local, has_cost):
+        upto = days <= change
+        state = compute_lots(*(column[upto] for column in ledger)).get(1)
+        lots = state["lots"] if state and state["cost_basis"] else []
+        assert cost == bool(lots)
+        expected_huf = sum(Decimal(str(l["quantity"] * l["unit_cost"])) * 380 for l in lots if l["date"] >= "1970-07-20")
+        expected_local = sum(Decimal(str(l["quantity"] * l["unit_cost"])) for l in lots if l["date"] < "1970-07-20")
+        assert float(huf_part) == pytest.approx(float(expected_huf))
+        assert float(local_part) == pytest.approx(float(expected_local))
@@ -0,0 +1,75 @@
+"""
+USD and EUR values stored alongside value_huf, and the currency= API parameter
+"""
+from datetime import date
+from decimal import Decimal
+
+from backend.app import models
+from backend.app.etl.calculate_values import calculate_portfolio_values
+from backend.app.etl.recalculate import recalculate
+
+
+def _seed(db):
+    db.add(models.Portfolio(id=1, name="Main"))
+    db.add(models.Instrument(id=1, isin="US0378331005", name="Apple", currency="USD"))
+    db.add(models.Instrument(id=2, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.Holding(portfolio_id=1, instrument_id=1, quantity=10))
+    db.add(models.Holding(portfolio_id=1, instrument_id=2, quantity=100))
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 1, 2), price=200, currency="USD", source="Yahoo"))
+    db.add(models.Price(instrument_id=2, price_date=date(2024, 1, 2), price=1500, currency="HUF", source="BÉT"))
+    for day, usd, eur in ((date(2024, 1, 2), 350, 380), (date(2024, 1, 4), 360, 390)):
+        db.add(models.FxRate(rate_date=day, base_currency="USD", target_currency="HUF", rate=usd))
+        db.add(models.FxRate(rate_date=day, base_currency="EUR", target_currency="HUF", rate=eur))
+    db.commit()
+
+
+def _stored(db, day):
+    db.expire_all()
+    return {
+        pv.instrument_id: pv
+        for pv in db.query(models.PortfolioValueDaily).filter_by(portfolio_id=1, snapshot_date=day)
+    }
+
+
+def test_values_converted_at_the_snapshot_rate(db):
+    _seed(db)
+    calculate_portfolio_values(1, date(2024, 1, 3), db)
+
+    stored = _stored(db, date(2024, 1, 3))
+    assert stored[1].value_huf == 700000
+    assert round(stored[1].value_huf_usd, 6) == 2000
+    assert round(stored[1].value_eur, 6) == round(Decimal(700000) / 380, 6)
+    assert round(stored[2].value_huf_usd, 6) == round(Decimal(150000) / 350, 6)
+
+
+def test_recalculate_matches_per_date_valuation(db):
+    _seed(db)
+    recalculate(1, date(2024, 1, 2), date(2024, 1, 5), db)
+    ranged = {day: {i: (pv.value_huf_usd, pv.value_eur) for i, pv in _stored(db, day).items()}
+              for day in (date(2024, 1, 3), date(2024, 1, 5))}
+
+    for day, values in ranged.items():
+        calculate_portfolio_values(1, day, db)
+        assert {i: (pv.value_huf_usd, pv.value_eur) for i, pv in _stored(db, day).items()} == values
+    assert round(ranged[date(2024, 1, 5)][1][0], 6) == 2000
+
+
+def test_summary_and_history_in_reporting_currency(client, db):
+    _seed(db)
+    calculate_portfolio_values(1, date(2024, 1, 3), db)
+
+    summary = client.get("/portfolio/1/summary", params={"snapshot_date": "2024-01-03", "currency": "usd"}).json()
+    assert summary["currency"] == "USD"
+    assert summary["total_value_huf"] == 850000
+    assert round(summary["total_value"], 2) == round(2000 + 150000 / 350, 2)
+
+    history = client.get("/portfolio/1/history", params={
+        "start_date": "2024-01-03", "end_date": "2024-01-03", "currency": "EUR"
+    }).json()
+    assert {row["reporting_currency"] for row in history} == {"EUR"}
+    assert round(sum(row["value"] for row in history), 2) == round(850000 / 380, 2)
+
+    assert client.get("/portfolio/1/summary", params={"currency": "GBP"}).status_code == 400
+    assert client.get("/portfolio/1/history", params={
+        "start_date": "2024-01-03", "end_date": "2024-01-03", "currency": "GBP"
+    }).status_code == 400
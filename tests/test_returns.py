@@ -0,0 +1,67 @@
+"""
+Returns engine: TWR chaining and vectorized XIRR
+"""
+from datetime import date
+
+import numpy as np
+import pytest
+
+from backend.app import models
+from backend.app.returns import calculate_returns, time_weighted, xirr
+
+
+def test_xirr_matches_known_rates():
+    years = np.array([0.0, 1.0, 2.0])
+    cash = np.array([
+        [-1000.0, 0.0, 1210.0],      # 10% a year
+        [-1000.0, -1000.0, 2100.0],  # x^2 + x = 2.1
+        [-1000.0, 0.0, 0.0],         # no sign change
+    ])
+    rates = xirr(cash, years)
+    assert rates[0] == pytest.approx(0.10)
+    assert rates[1] == pytest.approx((np.sqrt(9.4) - 1) / 2 - 1)
+    assert np.isnan(rates[2])
+
+
+def test_xirr_overflow_is_not_a_root():
+    years = np.array([0.0, 50.0, 100.0])
+    # NPV overflows near -100%: no overflow warnings and no rate reported
+    with np.errstate(all="raise"):
+        rate, = xirr(np.array([-100.0, 0.0, 1e-3]), years)
+    assert np.isnan(rate)
+
+
+def test_twr_ignores_deposits():
+    values = np.array([[100.0, 110.0, 221.0]])
+    flows = np.array([[0.0, 0.0, 100.0]])  # deposit 100 before the last date
+    twr = time_weighted(values, flows)
+    assert twr[0, 1] == pytest.approx(0.10)
+    assert twr[0, 2] == pytest.approx(1.10 * (121.0 / 110.0) - 1)
+
+
+def test_portfolio_returns_endpoint_data(db):
+    db.add(models.Portfolio(id=1, name="Main"))
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    for snapshot_date, quantity, value in [
+        (date(2024, 1, 1), 10, 1000.0),
+        (date(2024, 7, 1), 20, 2200.0),  # includes the purchase that day
+        (date(2025, 1, 1), 20, 2420.0),
+    ]:
+        db.add(models.PortfolioValueDaily(
+            portfolio_id=1, snapshot_date=snapshot_date, instrument_id=1, quantity=quantity,
+            price=value / quantity, instrument_currency="HUF", fx_rate=1, value_huf=value
+        ))
+    db.add(models.Transaction(
+        portfolio_id=1, instrument_id=1, transaction_date=date(2024, 7, 1),
+        transaction_type="BUY", quantity=10, price=110
+    ))
+    db.commit()
+
+    result = calculate_returns(db, 1, include_series=True)
+    # 10% in each half year regardless of the mid-year purchase
+    assert result["portfolio"]["twr"] == pytest.approx(0.21)
+    assert result["portfolio"]["net_flows_huf"] == pytest.approx(1100)
+    assert result["instruments"][0]["twr"] == pytest.approx(result["portfolio"]["twr"])
+    assert result["portfolio"]["xirr"] > 0
+    assert len(result["twr_series"]) == 3
+    assert calculate_returns(db, 1, include_series=True) is result  # cached
@@ -0,0 +1,82 @@
+"""
+Dirty-range queue: back-dated writes recalculate only stale stored values
+"""
+from datetime import date
+
+from backend.app import crud, models
+from backend.app.etl.calculate_values import calculate_portfolio_values
+from backend.app.etl.process_revaluations import dirty_runs, process_revaluation_queue
+from backend.app.etl.recalculate import recalculate
+
+DATES = [date(2024, 1, 31), date(2024, 2, 29), date(2024, 3, 31)]
+
+
+def _seed(db):
+    db.add(models.Portfolio(id=1, name="Main"))
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.Instrument(id=2, isin="HU0000153937", name="MOL", currency="HUF"))
+    db.add(models.Holding(portfolio_id=1, instrument_id=1, quantity=10))
+    db.add(models.Holding(portfolio_id=1, instrument_id=2, quantity=5))
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 1, 1), price=100, currency="HUF", source="BÉT"))
+    db.add(models.Price(instrument_id=2, price_date=date(2024, 1, 1), price=200, currency="HUF", source="BÉT"))
+    db.commit()
+    for snapshot_date in DATES:
+        calculate_portfolio_values(1, snapshot_date, db)
+
+
+def _values(db):
+    return {
+        (r.snapshot_date, r.instrument_id): (float(r.quantity), float(r.value_huf), r.calculated_at)
+        for r in db.query(models.PortfolioValueDaily)
+    }
+
+
+def test_back_dated_manual_price_revalues_only_later_dates(db):
+    _seed(db)
+    before = _values(db)
+
+    crud.add_manual_price(db, 1, date(2024, 2, 15), 120, "HUF")
+    assert db.query(models.RevaluationQueue).count() == 1
+    assert process_revaluation_queue(db) == 2
+    after = _values(db)
+
+    assert after[(DATES[0], 1)] == before[(DATES[0], 1)]
+    assert after[(DATES[1], 1)][1] == 1200.0
+    assert after[(DATES[2], 1)][1] == 1200.0
+    # Other instruments are untouched
+    for snapshot_date in DATES:
+        assert after[(snapshot_date, 2)] == before[(snapshot_date, 2)]
+    assert db.query(models.RevaluationQueue).count() == 0
+
+
+def test_back_dated_sell_removes_closed_positions(db):
+    _seed(db)
+    crud.add_transaction(db, 1, 2, date(2024, 3, 1), "SELL", 5, price=210)
+    crud.add_transaction(db, 1, 1, date(2024, 2, 1), "BUY", 10, price=100)
+    process_revaluation_queue(db)
+    after = _values(db)
+
+    assert (DATES[2], 2) not in after
+    assert (DATES[1], 2) in after
+    assert after[(DATES[0], 1)][0] == 10.0
+    assert after[(DATES[1], 1)][0] == 20.0
+
+
+def test_consecutive_dates_are_revalued_in_runs(db):
+    _seed(db)
+    recalculate(1, date(2024, 2, 1), date(2024, 2, 10), db)
+    stored = sorted({r.snapshot_date for r in db.query(models.PortfolioValueDaily)})
+    dirty = {1: date(2024, 2, 5), 2: date(2024, 2, 8)}
+    assert dirty_runs(dirty, stored) == [
+        (date(2024, 2, 5), date(2024, 2, 7), {1}),
+        (date(2024, 2, 8), date(2024, 2, 10), {1, 2}),
+        (date(2024, 2, 29), date(2024, 2, 29), {1, 2}),
+        (date(2024, 3, 31), date(2024, 3, 31), {1, 2}),
+    ]
+
+    crud.add_manual_price(db, 1, date(2024, 2, 5), 120, "HUF")
+    # Instrument 1 on 5–10 February and both month ends
+    assert process_revaluation_queue(db) == 8
+    after = _values(db)
+    assert after[(date(2024, 2, 4), 1)][1] == 1000.0
+    assert {after[(day, 1)][1] for day in stored if day >= date(2024, 2, 5)} == {1200.0}
@@ -0,0 +1,72 @@
+"""
+Delta sync: clients get only what changed since their last version
+"""
+from datetime import date
+
+from backend.app import crud, wealth_crud
+
+
+def test_full_then_delta(client, db):
+    instrument = crud.add_new_instrument(db, "HU0000073507", "Magyar Telekom", "HUF")
+    crud.add_transaction(db, 1, instrument.id, date(2024, 1, 2), "BUY", 10, price=1500)
+
+    full = client.get("/sync").json()
+    assert full["full"] is True
+    assert [r["isin"] for r in full["changes"]["instruments"]["upserts"]] == ["HU0000073507"]
+    assert len(full["changes"]["transactions"]["upserts"]) == 1
+
+    category = wealth_crud.add_wealth_category(db, "cash", "CIB account HUF", "HUF")
+    value = wealth_crud.add_or_update_wealth_value(db, category.id, date(2024, 1, 31), 1000)
+    wealth_crud.add_or_update_wealth_value(db, category.id, date(2024, 1, 31), 1200)
+    removed = wealth_crud.add_or_update_wealth_value(db, category.id, date(2024, 2, 29), 900)
+    wealth_crud.delete_wealth_value(db, removed.id)
+
+    delta = client.get("/sync", params={"since": full["version"]}).json()
+    assert delta["full"] is False and delta["has_more"] is False
+    assert set(delta["changes"]) == {"wealth_categories", "wealth_values"}
+    values = delta["changes"]["wealth_values"]
+    assert [(r["id"], r["present_value"]) for r in values["upserts"]] == [(value.id, 1200)]
+    assert values["deletes"] == [removed.id]
+
+    empty = client.get("/sync", params={"since": delta["version"]}).json()
+    assert empty["changes"] == {} and empty["version"] == delta["version"]
+
+
+def test_paging_and_filters(client, db):
+    instrument = crud.add_new_instrument(db, "HU0000073507", "Magyar Telekom", "HUF")
+    since = client.get("/sync").json()["version"]
+    for day in range(1, 4):
+        crud.add_transaction(db, 1, instrument.id, date(2024, 1, day), "BUY", 1, price=1500)
+    crud.add_transaction(db, 2, instrument.id, date(2024, 1, 5), "BUY", 1, price=1500)
+
+    page = client.get("/sync", params={"since": since, "tables": "transactions", "limit": 2}).json()
+    assert page["has_more"] is True
+    assert len(page["changes"]["transactions"]["upserts"]) == 2
+
+    rest = client.get("/sync", params={"since": page["version"], "tables": "transactions", "portfolio_id": 1}).json()
+    assert rest["has_more"] is False
+    assert [r["portfolio_id"] for r in rest["changes"]["transactions"]["upserts"]] == [1]
+
+    assert client.get("/sync", params={"tables": "change_journal"}).status_code == 400
+
+
+def test_full_copy_is_paged(client, db):
+    instrument = crud.add_new_instrument(db, "HU0000073507", "Magyar Telekom", "HUF")
+    for day in range(1, 4):
+        crud.add_transaction(db, 1, instrument.id, date(2024, 1, day), "BUY", 1, price=1500)
+    crud.add_transaction(db, 2, instrument.id, date(2024, 1, 5), "BUY", 1, price=1500)
+    params = {"tables": "instruments,transactions", "portfolio_id": 1, "limit": 2}
+
+    pages = [client.get("/sync", params=params).json()]
+    while pages[-1]["has_more"]:
+        pages.append(client.get("/sync", params={**params, "cursor": pages[-1]["cursor"]}).json())
+
+    assert len(pages) == 2
+    assert all(page["full"] and page["version"] == pages[0]["version"] for page in pages)
+    assert all(sum(len(c["upserts"]) for c in page["changes"].values()) <= 2 for page in pages)
+    transactions = [r for page in pages for r in page["changes"].get("transactions", {"upserts": []})["upserts"]]
+    assert [(r["portfolio_id"], r["transaction_date"]) for r in transactions] == [
+        (1, "2024-01-01"), (1, "2024-01-02"), (1, "2024-01-03")
+    ]
+
+    assert client.get("/sync", params={**params, "cursor": "not-a-cursor"}).status_code == 400
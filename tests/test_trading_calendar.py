@@ -0,0 +1,80 @@
+"""
+BÉT / TARGET calendars, trading-day backfills and as-of reads
+"""
+from datetime import date
+
+from backend.app import models, trading_calendar
+from backend.app.config import settings
+from backend.app.etl.recalculate import recalculate
+from backend.app.trading_calendar import (
+    calendar_for_currency, easter_sunday, is_trading_day, previous_trading_day, trading_days
+)
+
+
+def test_easter():
+    assert [easter_sunday(y) for y in (2019, 2024, 2025, 2026)] == [
+        date(2019, 4, 21), date(2024, 3, 31), date(2025, 4, 20), date(2026, 4, 5)
+    ]
+
+
+def test_bet_and_target_holidays():
+    # National day, Good Friday, Whit Monday, bridge day, Christmas Eve
+    for day in (date(2024, 3, 15), date(2024, 3, 29), date(2024, 5, 20), date(2024, 8, 19), date(2024, 12, 24)):
+        assert not is_trading_day(day, "BET")
+    assert is_trading_day(date(2024, 3, 15), "TARGET")
+    assert not is_trading_day(date(2024, 3, 29), "TARGET")
+    assert not is_trading_day(date(2024, 3, 16), "WEEKDAYS")
+
+    assert trading_days(date(2024, 3, 11), date(2024, 3, 17)) == [date(2024, 3, d) for d in (11, 12, 13, 14)]
+    assert previous_trading_day(date(2024, 3, 17)) == date(2024, 3, 14)
+    assert [calendar_for_currency(c) for c in ("HUF", "EUR", "USD")] == ["BET", "TARGET", "WEEKDAYS"]
+
+
+def test_bridge_days_come_from_the_data_file_and_uncovered_years_warn(tmp_path, monkeypatch, capsys):
+    bridge_file = tmp_path / "bridge_days.csv"
+    bridge_file.write_text("year,bridge_days\n2027,2027-03-16\n2028,\n")
+    monkeypatch.setattr(settings, "bet_bridge_days_file", str(bridge_file))
+    monkeypatch.setattr(trading_calendar, "_warned_years", set())
+    caches = (trading_calendar.bridge_days, trading_calendar._busdaycalendar)
+    for cache in caches:
+        cache.cache_clear()
+    try:
+        assert not is_trading_day(date(2027, 3, 16))
+        assert is_trading_day(date(2028, 3, 16))
+        assert capsys.readouterr().out == ""
+
+        # 2029 is not listed: warned about once, not on every check
+        assert is_trading_day(date(2029, 3, 16))
+        trading_days(date(2029, 1, 1), date(2029, 1, 31))
+        assert capsys.readouterr().out.count("2029") == 1
+    finally:
+        monkeypatch.undo()
+        for cache in caches:
+            cache.cache_clear()
+
+
+def _seed(db):
+    db.add(models.Portfolio(id=1, name="Main"))
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.Holding(portfolio_id=1, instrument_id=1, quantity=10))
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 3, 1), price=1500, currency="HUF", source="BÉT"))
+    db.add(models.Price(instrument_id=1, price_date=date(2024, 3, 14), price=1550, currency="HUF", source="BÉT"))
+    db.commit()
+
+
+def test_backfill_skips_closed_days_and_reads_resolve_as_of(client, db):
+    _seed(db)
+    recalculate(1, date(2024, 3, 11), date(2024, 3, 17), db)
+    assert db.query(models.PortfolioValueDaily).count() == 7
+
+    # Thursday 14th is the last open day: 15th is a holiday, then the weekend
+    recalculate(1, date(2024, 3, 11), date(2024, 3, 17), db, trading_days_only=True)
+    db.expire_all()
+    stored = [r.snapshot_date for r in db.query(models.PortfolioValueDaily).order_by(models.PortfolioValueDaily.snapshot_date)]
+    assert stored == trading_days(date(2024, 3, 11), date(2024, 3, 17))
+
+    summary = client.get("/portfolio/1/summary", params={"snapshot_date": "2024-03-17"}).json()
+    assert (summary["value_date"], summary["total_value_huf"]) == ("2024-03-14", 15500)
+    item, = client.get("/portfolio/1/snapshot", params={"snapshot_date": "2024-03-16"}).json()
+    assert item["value_huf"] == 15500
+    assert client.get("/portfolio/1/snapshot", params={"snapshot_date": "2024-03-10"}).status_code == 404
@@ -0,0 +1,100 @@
+"""
+Set-based valuation: constant query count and get_latest_price precedence
+"""
+from datetime import date
+
+from backend.app import models
+from backend.app.price_index import get_price_index
+from backend.app.fx_curve import get_fx_curves
+from backend.app.etl.calculate_values import (
+    calculate_portfolio_values, get_fx_rate, get_latest_price, load_fx_rates, load_latest_prices
+)
+
+
+def _price(db, instrument_id, day, price, source="BÉT"):
+    db.add(models.Price(instrument_id=instrument_id, price_date=day, price=price, currency="HUF", source=source))
+
+
+def _manual(db, instrument_id, day, price):
+    db.add(models.ManualPrice(instrument_id=instrument_id, override_date=day, price=price, currency="HUF"))
+
+
+def test_price_precedence_matches_get_latest_price(db):
+    for i in range(1, 7):
+        db.add(models.Instrument(id=i, isin=f"HU000000000{i}", name=f"Instrument {i}", currency="HUF"))
+    _price(db, 1, date(2024, 1, 10), 100)            # automatic only
+    _manual(db, 2, date(2024, 1, 5), 90)             # manual newer than automatic
+    _price(db, 2, date(2024, 1, 1), 80)
+    _manual(db, 3, date(2024, 1, 5), 70)             # tie: automatic wins
+    _price(db, 3, date(2024, 1, 5), 75)
+    _price(db, 4, date(2024, 1, 3), 60, "test")      # test data as last resort
+    _price(db, 5, date(2024, 1, 3), 50, "test")      # test data loses to manual
+    _manual(db, 5, date(2024, 1, 1), 55)
+    _price(db, 1, date(2024, 2, 1), 110)             # instrument 6 has nothing
+    db.commit()
+
+    expected = {
+        date(2023, 12, 31): {},
+        date(2024, 1, 4): {1: None, 2: 80, 3: None, 4: 60, 5: 55},
+        date(2024, 1, 31): {1: 100, 2: 90, 3: 75, 4: 60, 5: 55},
+        date(2024, 3, 1): {1: 110, 2: 90, 3: 75, 4: 60, 5: 55},
+    }
+    for day, prices in expected.items():
+        prices = {i: p for i, p in prices.items() if p is not None}
+        assert load_latest_prices(db, range(1, 7), day) == prices
+        assert {i: get_latest_price(i, day, db) for i in range(1, 7)} == {i: prices.get(i) for i in range(1, 7)}
+
+
+def test_fx_rates_match_get_fx_rate(db):
+    for day, rate in ((date(2024, 1, 2), 380), (date(2024, 1, 5), 385), (date(2024, 2, 1), 390)):
+        db.add(models.FxRate(rate_date=day, base_currency="EUR", target_currency="HUF", rate=rate))
+    db.commit()
+
+    keys = [("EUR", date(2024, 1, 1)), ("EUR", date(2024, 1, 4)), ("EUR", date(2024, 3, 1)),
+            ("USD", date(2024, 1, 4)), ("HUF", date(2024, 1, 4))]
+    rates = load_fx_rates(db, keys)
+    assert rates == {key: get_fx_rate(key[0], "HUF", key[1], db) for key in keys}
+
+
+def _portfolio(db, portfolio_id, holdings):
+    db.add(models.Portfolio(id=portfolio_id, name=f"Portfolio {portfolio_id}"))
+    for k in range(holdings):
+        instrument_id = portfolio_id * 100 + k
+        db.add(models.Instrument(id=instrument_id, isin=f"HU{instrument_id:010d}", name="Share", currency="EUR"))
+        db.add(models.Holding(portfolio_id=portfolio_id, instrument_id=instrument_id, quantity=10,
+                              acquisition_date=date(2024, 1, 2), acquisition_price=5))
+        _price(db, instrument_id, date(2024, 1, 2), 6)
+        _manual(db, instrument_id, date(2024, 1, 3), 7)
+
+
+def test_query_count_does_not_grow_with_holdings(db, query_counter):
+    db.add(models.FxRate(rate_date=date(2024, 1, 2), base_currency="EUR", target_currency="HUF", rate=400))
+    _portfolio(db, 1, 2)
+    _portfolio(db, 2, 12)
+    db.commit()
+
+    # Loaded once per process, not per valuation
+    get_price_index(db)
+    get_fx_curves(db)
+
+    counts = []
+    for portfolio_id in (1, 2):
+        query_counter.clear()
+        calculate_portfolio_values(portfolio_id, date(2024, 1, 31), db)
+        counts.append(len(query_counter))
+        assert sum("portfolio_values_daily" in s and s.lstrip().upper().startswith("INSERT")
+                   for s in query_counter) == 1
+    assert counts[0] == counts[1]
+
+    rows = db.query(models.PortfolioValueDaily).filter_by(portfolio_id=2).all()
+    assert len(rows) == 12
+    assert {float(r.value_huf) for r in rows} == {10 * 7 * 400}
+    assert {float(r.cost_basis_huf) for r in rows} == {10 * 5 * 400}
+
+    # Recalculating updates the same rows in place
+    _manual(db, 200, date(2024, 1, 30), 8)
+    db.commit()
+    calculate_portfolio_values(2, date(2024, 1, 31), db)
+    db.expire_all()
+    assert db.query(models.PortfolioValueDaily).filter_by(portfolio_id=2).count() == 12
+    assert float(db.query(models.PortfolioValueDaily).filter_by(instrument_id=200).one().value_huf) == 10 * 8 * 400
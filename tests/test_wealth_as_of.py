@@ -0,0 +1,54 @@
+"""
+Total wealth resolves each category's latest value on or before the date
+"""
+from datetime import date
+
+from backend.app import models, wealth_crud
+
+
+def _seed(db):
+    db.add(models.Portfolio(id=1, name="Main"))
+    db.add(models.WealthCategory(id=1, category_type="cash", name="Current account", currency="HUF"))
+    db.add(models.WealthCategory(id=2, category_type="property", name="Flat", currency="HUF"))
+    db.add(models.WealthCategory(id=3, category_type="loan", name="Mortgage", currency="HUF", is_liability=True))
+    db.commit()
+    for category_id, day, value in (
+        (1, date(2024, 1, 31), 1_000_000), (1, date(2024, 3, 31), 1_200_000),
+        (2, date(2023, 12, 31), 50_000_000),
+        (3, date(2024, 2, 29), 20_000_000),
+    ):
+        wealth_crud.add_or_update_wealth_value(db, category_id, day, value)
+
+
+def test_values_resolved_as_of(db):
+    _seed(db)
+    latest = {v["name"]: (v["present_value"], v["value_date"]) for v in wealth_crud.get_wealth_values_as_of(db, date(2024, 3, 15))}
+    assert latest == {
+        "Current account": (1_000_000, "2024-01-31"),
+        "Flat": (50_000_000, "2023-12-31"),
+        "Mortgage": (20_000_000, "2024-02-29"),
+    }
+    assert [v["name"] for v in wealth_crud.get_wealth_values_as_of(db, date(2024, 3, 15), "cash")] == ["Current account"]
+    assert wealth_crud.get_wealth_values_as_of(db, date(2023, 6, 30)) == []
+
+
+def test_total_wealth_on_any_date(client, db, query_counter):
+    _seed(db)
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.PortfolioValueDaily(portfolio_id=1, snapshot_date=date(2024, 3, 14), instrument_id=1, quantity=10,
+                                      price=1550, instrument_currency="HUF", fx_rate=1, value_huf=15500))
+    db.commit()
+
+    total = client.get("/wealth/total/2024-03-17").json()
+    assert total["portfolio_value_huf"] == 15500
+    assert total["breakdown"] == {"cash": 1_000_000, "property": 50_000_000, "pension": 0, "loans": 20_000_000, "other": 0}
+    assert total["net_wealth_huf"] == 15500 + 51_000_000 - 20_000_000
+
+    # Same query count however many dates or categories there are
+    wealth_crud.calculate_total_wealth(db, date(2024, 3, 17))
+    query_counter.clear()
+    wealth_crud.calculate_total_wealth(db, date(2024, 4, 30))
+    assert len(query_counter) <= 4
+
+    assert client.get("/wealth/values/2024-03-17", params={"as_of": True}).json()[0]["value_date"] == "2024-01-31"
+    assert client.get("/wealth/values/2024-03-17").json() == []
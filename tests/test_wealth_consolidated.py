@@ -0,0 +1,64 @@
+"""
+Total wealth consolidated over several portfolios, with subtotals
+"""
+from datetime import date
+
+from backend.app import models, wealth_crud
+
+
+def _seed(db, portfolios=3):
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.WealthCategory(id=1, category_type="cash", name="Current account", currency="HUF"))
+    for pid in range(1, portfolios + 1):
+        db.add(models.Portfolio(id=pid, name=f"Portfolio {pid}"))
+        # Portfolio n last valued on day n of March
+        for day in range(1, pid + 1):
+            db.add(models.PortfolioValueDaily(
+                portfolio_id=pid, snapshot_date=date(2024, 3, day), instrument_id=1, quantity=pid,
+                price=1000 + day, instrument_currency="HUF", fx_rate=1, value_huf=pid * (1000 + day)
+            ))
+    db.commit()
+    wealth_crud.add_or_update_wealth_value(db, 1, date(2024, 2, 29), 100_000)
+
+
+def test_consolidated_total_with_subtotals(client, db):
+    _seed(db)
+    total = client.get("/wealth/total/2024-03-31").json()
+    assert [(p["portfolio_id"], p["value_huf"], p["value_date"]) for p in total["portfolios"]] == [
+        (1, 1001, "2024-03-01"), (2, 2004, "2024-03-02"), (3, 3009, "2024-03-03"),
+    ]
+    assert total["portfolio_value_huf"] == 1001 + 2004 + 3009
+    assert total["net_wealth_huf"] == 1001 + 2004 + 3009 + 100_000
+
+    selected = client.get("/wealth/total/2024-03-31", params=[("portfolio_id", 1), ("portfolio_id", 3)]).json()
+    assert [p["portfolio_id"] for p in selected["portfolios"]] == [1, 3]
+    assert selected["portfolio_value_huf"] == 1001 + 3009
+
+    # Each portfolio resolves its own last valued day; none before the first
+    march_2 = wealth_crud.calculate_total_wealth(db, date(2024, 3, 2))
+    assert [p["value_date"] for p in march_2["portfolios"]] == ["2024-03-01", "2024-03-02", "2024-03-02"]
+    early = wealth_crud.calculate_wealth_totals(db, [date(2024, 2, 29), date(2024, 3, 31)])[date(2024, 2, 29)]
+    assert early["portfolios"][2] == {"portfolio_id": 3, "name": "Portfolio 3", "value_huf": 0.0, "value_date": None}
+    assert early["portfolio_value_huf"] == 0
+
+    saved = client.post("/wealth/snapshot/2024-03-31").json()
+    assert saved["portfolio_value_huf"] == 1001 + 2004 + 3009
+    assert len(saved["portfolios"]) == 3
+
+    # A subset must not replace the consolidated snapshot of the date
+    assert client.post("/wealth/snapshot/2024-03-31", params={"portfolio_id": 1}).status_code == 400
+    db.expire_all()
+    snapshot = db.query(models.TotalWealthSnapshot).filter_by(snapshot_date=date(2024, 3, 31)).one()
+    assert float(snapshot.portfolio_value_huf) == 1001 + 2004 + 3009
+    every = [("portfolio_id", pid) for pid in (1, 2, 3)]
+    assert client.post("/wealth/snapshot/2024-03-31", params=every).status_code == 200
+
+
+def test_query_count_independent_of_portfolio_count(db, query_counter):
+    _seed(db, portfolios=8)
+    dates = [date(2024, 3, day) for day in range(1, 32)]
+    wealth_crud.calculate_wealth_totals(db, dates)  # loads the FX curves
+    query_counter.clear()
+    totals = wealth_crud.calculate_wealth_totals(db, dates)
+    assert len(query_counter) <= 3
+    assert len(totals[date(2024, 3, 31)]["portfolios"]) == 8
@@ -0,0 +1,94 @@
+"""
+Wealth values converted at the FX rate of their own date
+"""
+from datetime import date
+
+import pytest
+
+from backend.app import models, wealth_crud
+from backend.app.generate_all_snapshots import generate_all_snapshots
+
+DATES = [date(2024, 1, 15), date(2024, 1, 31), date(2024, 2, 29), date(2024, 3, 31), date(2024, 4, 30)]
+
+
+def _seed(db):
+    db.add(models.Portfolio(id=1, name="Main"))
+    db.add(models.WealthCategory(id=1, category_type="cash", name="HUF account", currency="HUF"))
+    db.add(models.WealthCategory(id=2, category_type="cash", name="EUR account", currency="EUR"))
+    db.add(models.WealthCategory(id=3, category_type="loan", name="USD loan", currency="USD", is_liability=True))
+    for day, eur, usd in ((date(2024, 1, 2), 380, 350), (date(2024, 2, 1), 390, 355), (date(2024, 3, 29), 400, 360)):
+        db.add(models.FxRate(rate_date=day, base_currency="EUR", target_currency="HUF", rate=eur))
+        db.add(models.FxRate(rate_date=day, base_currency="USD", target_currency="HUF", rate=usd))
+    db.add(models.Instrument(id=1, isin="HU0000073507", name="Magyar Telekom", currency="HUF"))
+    db.add(models.PortfolioValueDaily(portfolio_id=1, snapshot_date=date(2024, 2, 29), instrument_id=1, quantity=10,
+                                      price=1550, instrument_currency="HUF", fx_rate=1, value_huf=15500))
+    db.commit()
+    for category_id, day, value in (
+        (1, date(2024, 1, 31), 1_000_000), (1, date(2024, 3, 31), 1_100_000),
+        (2, date(2024, 1, 31), 1000), (2, date(2024, 3, 31), 2000),
+        (3, date(2024, 2, 29), 500),
+    ):
+        wealth_crud.add_or_update_wealth_value(db, category_id, day, value, note="history.csv")
+
+
+def test_each_value_uses_the_rate_of_its_date(db):
+    _seed(db)
+    total = wealth_crud.calculate_total_wealth(db, date(2024, 3, 15))
+    details = {wv["name"]: (wv["fx_rate"], wv["value_huf"]) for wv in total["wealth_details"]}
+    assert details == {
+        "HUF account": (1.0, 1_000_000),
+        "EUR account": (380.0, 380_000),   # Jan 31 value at the Jan 2 rate
+        "USD loan": (355.0, 177_500),      # Feb 29 value at the Feb 1 rate
+    }
+    assert total["breakdown"]["cash"] == 1_380_000
+    assert total["net_wealth_huf"] == 15500 + 1_380_000 - 177_500
+
+
+def test_range_totals_match_single_dates(db, query_counter):
+    _seed(db)
+    wealth_crud.calculate_wealth_totals(db, DATES)  # loads the FX curves
+    query_counter.clear()
+    totals = wealth_crud.calculate_wealth_totals(db, DATES)
+    assert len(query_counter) <= 3
+
+    for day in DATES:
+        single = wealth_crud.calculate_total_wealth(db, day)
+        for key in ("portfolio_value_huf", "other_assets_huf", "total_liabilities_huf", "net_wealth_huf"):
+            assert totals[day][key] == pytest.approx(single[key])
+        assert totals[day]["breakdown"] == pytest.approx(single["breakdown"])
+    assert totals[date(2024, 3, 31)]["breakdown"]["cash"] == 1_100_000 + 2000 * 400
+
+
+def test_generate_all_snapshots_converts_currencies(db):
+    _seed(db)
+    generate_all_snapshots(db)
+    db.expire_all()
+    snapshot = db.query(models.TotalWealthSnapshot).filter_by(snapshot_date=date(2024, 3, 31)).one()
+    assert float(snapshot.cash_huf) == 1_100_000 + 2000 * 400
+    assert float(snapshot.total_liabilities_huf) == 500 * 355
+    assert float(snapshot.portfolio_value_huf) == 15500
+    assert db.query(models.TotalWealthSnapshot).count() == 3
+
+
+def test_currency_without_rates_is_reported_not_converted_at_one(client, db):
+    _seed(db)
+    db.add(models.WealthCategory(id=4, category_type="cash", name="CHF account", currency="CHF"))
+    db.commit()
+    wealth_crud.add_or_update_wealth_value(db, 4, date(2024, 1, 31), 5000)
+
+    total = wealth_crud.calculate_total_wealth(db, date(2024, 3, 15))
+    chf, = [wv for wv in total["wealth_details"] if wv["currency"] == "CHF"]
+    assert (chf["fx_rate"], chf["value_huf"]) == (None, None)
+    assert total["breakdown"]["cash"] == 1_380_000
+    assert total["unconverted"] == [{"category_id": 4, "name": "CHF account", "currency": "CHF"}]
+
+    totals = wealth_crud.calculate_wealth_totals(db, [date(2024, 1, 15), date(2024, 3, 15)])
+    assert totals[date(2024, 1, 15)]["unconverted"] == []
+    assert totals[date(2024, 3, 15)]["unconverted"] == total["unconverted"]
+    assert totals[date(2024, 3, 15)]["breakdown"]["cash"] == 1_380_000
+
+    assert client.post("/wealth/snapshot/2024-03-15").status_code == 400
+    assert db.query(models.TotalWealthSnapshot).count() == 0
+    attribution = client.get("/wealth/attribution", params={"start_date": "2024-01-31", "end_date": "2024-03-15"}).json()
+    assert attribution["unconverted"] == total["unconverted"]
+    assert 4 not in [line["category_id"] for line in attribution["wealth"]]
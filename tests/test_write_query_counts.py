@@ -0,0 +1,120 @@
+"""
+Query-count checks for the write endpoints.
+
+Every write should be a single INSERT/UPDATE ... RETURNING (plus an existence
+check where the endpoint validates input first). Building the JSON response
+must not trigger any further SELECT to reload expired attributes.
+"""
+from datetime import date
+
+
+def _count_writes(query_counter, client, method, url, payload):
+    query_counter.clear()
+    response = client.request(method, url, json=payload)
+    assert response.status_code == 200, response.text
+    return response.json(), list(query_counter)
+
+
+def _create_instrument(client, isin="HU0000073507"):
+    response = client.post("/instruments", json={
+        "isin": isin,
+        "name": "Magyar Telekom",
+        "currency": "HUF",
+        "instrument_type": "equity"
+    })
+    return response.json()["id"]
+
+
+def test_create_instrument_queries(client, query_counter):
+    data, statements = _count_writes(query_counter, client, "POST", "/instruments", {
+        "isin": "HU0000153937",
+        "name": "MOL",
+        "currency": "HUF",
+        "instrument_type": "equity"
+    })
+    # duplicate-ISIN check + INSERT ... RETURNING
+    assert len(statements) == 2
+    assert "RETURNING" in statements[-1]
+    assert data["created_at"]
+
+
+def test_create_transaction_queries(client, query_counter):
+    instrument_id = _create_instrument(client)
+    payload = {
+        "portfolio_id": 1,
+        "instrument_id": instrument_id,
+        "transaction_date": date(2025, 1, 15).isoformat(),
+        "transaction_type": "buy",
+        "quantity": 10,
+        "price": 1500.0
+    }
+    client.post("/transactions", json=payload)  # seeds the maintained positions
+
+    data, statements = _count_writes(query_counter, client, "POST", "/transactions", payload)
+    inserts = [s for s in statements if s.startswith("INSERT INTO transactions")]
+    assert len(inserts) == 1 and "RETURNING" in inserts[0]
+    # The remaining statements only maintain positions; nothing reloads the row
+    assert not any(s.startswith("SELECT") and "FROM transactions" in s for s in statements)
+    assert data["transaction_type"] == "BUY"
+    assert data["id"] and data["created_at"]
+
+
+def test_create_manual_price_queries(client, query_counter):
+    instrument_id = _create_instrument(client)
+    payload = {
+        "instrument_id": instrument_id,
+        "override_date": date(2025, 1, 15).isoformat(),
+        "price": 1800.0,
+        "currency": "HUF"
+    }
+    # New override: UPDATE ... RETURNING finds nothing, INSERT ... RETURNING,
+    # plus the stale-valuation check
+    data, statements = _count_writes(query_counter, client, "POST", "/prices/manual", payload)
+    assert len(statements) == 3
+    first_id = data["id"]
+
+    # Existing override: a single UPDATE ... RETURNING plus the check
+    payload["price"] = 1850.0
+    data, statements = _count_writes(query_counter, client, "POST", "/prices/manual", payload)
+    assert len(statements) == 2
+    assert data["id"] == first_id
+    assert data["price"] == 1850.0
+
+
+def test_wealth_category_queries(client, query_counter):
+    data, statements = _count_writes(query_counter, client, "POST", "/wealth/categories", {
+        "category_type": "cash",
+        "name": "MKB account EUR",
+        "currency": "EUR"
+    })
+    assert len(statements) == 1
+    category_id = data["id"]
+
+    data, statements = _count_writes(
+        query_counter, client, "PUT", f"/wealth/categories/{category_id}", {"name": "MKB EUR"}
+    )
+    assert len(statements) == 1
+    assert data["name"] == "MKB EUR"
+
+
+def test_wealth_value_queries(client, query_counter):
+    category = client.post("/wealth/categories", json={
+        "category_type": "cash",
+        "name": "CIB account HUF",
+        "currency": "HUF"
+    }).json()
+    payload = {
+        "wealth_category_id": category["id"],
+        "value_date": "2025-01-31",
+        "present_value": 1000000.0
+    }
+    data, statements = _count_writes(query_counter, client, "POST", "/wealth/values", payload)
+    assert len(statements) == 1
+    first_id = data["id"]
+
+    # Same (category, date) again is an in-place upsert
+    payload["present_value"] = 1200000.0
+    data, statements = _count_writes(query_counter, client, "POST", "/wealth/values", payload)
+    assert len(statements) == 1
+    assert data["id"] == first_id
+    assert data["present_value"] == 1200000.0
@@ -4,6 +4,7 @@ Complete system for portfolio + total wealth tracking
 """
 import streamlit as st
 import requests
+import json
 import pandas as pd
 import plotly.graph_objects as go
 import plotly.express as px
@@ -188,29 +189,64 @@ This fetches:
 Safe to run anytime - takes 2-3 minutes.
 """)
 
+def read_server_events(response):
+    """Yield (event, data) pairs from a server-sent events stream"""
+    event, data = "message", []
+    for line in response.iter_lines(decode_unicode=True):
+        if line is None:
+            continue
+        if line == "":
+            if data:
+                yield event, json.loads("\n".join(data))
+            event, data = "message", []
+        elif line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+
 if st.sidebar.button("🔄 Run Daily Update", type="primary", use_container_width=True):
     with st.sidebar:
-        with st.spinner("Running daily update..."):
-            try:
-                update_response = requests.post(f"{API_URL}/etl/run-daily-update", timeout=180)
+        try:
+            # Subscribe before starting so no progress event is missed
+            with requests.get(f"{API_URL}/events", stream=True, timeout=(5, 120)) as stream:
+                start_response = requests.post(
+                    f"{API_URL}/etl/run-daily-update", params={"background": True}, timeout=10
+                )
                 
-                if update_response.status_code == 200:
-                    result = update_response.json()
-                    st.success("✅ Daily update completed!")
-                    
-                    with st.expander("📋 View Update Log"):
-                        st.code(result.get('output', 'No output'), language='text')
-                    
-                    st.info(f"🕐 Last updated: {result.get('timestamp')}")
-                    
-                    # Auto-refresh the page
-                    st.rerun()
-                else:
-                    st.error(f"❌ Update failed: {update_response.text}")
-            except requests.Timeout:
-                st.error("⏱️ Update timed out. It may still be running. Check back in a minute.")
-            except Exception as e:
-                st.error(f"❌ Error: {str(e)}")
+                if start_response.status_code == 409:
+                    st.info("⏳ An update is already running - following its progress...")
+                elif start_response.status_code != 200:
+                    st.error(f"❌ Update failed: {start_response.text}")
+                    st.stop()
+                
+                progress = st.progress(0.0, text="Starting daily update...")
+                log_lines = []
+                
+                # Follow progress until the run completes; no fixed overall timeout
+                for event, data in read_server_events(stream):
+                    if event != "etl":
+                        continue
+                    status = data.get("status")
+                    if status == "step_started":
+                        progress.progress((data["step"] - 1) / data["steps"], text=f"Step {data['step']}/{data['steps']}: {data['title']}...")
+                    elif status == "step_completed":
+                        log_lines.append(f"✓ Step {data['step']}: {data['title']}")
+                        progress.progress(data["step"] / data["steps"], text=f"Step {data['step']}/{data['steps']} done")
+                    elif status == "failed":
+                        st.error(f"❌ Update failed at step {data['step']} ({data['title']}): {data['error']}")
+                        break
+                    elif status == "completed":
+                        st.success("✅ Daily update completed!")
+                        with st.expander("📋 View Update Log"):
+                            st.code("\n".join(log_lines), language='text')
+                        st.info(f"🕐 Data version: {data.get('version')}")
+                        
+                        # Refresh the page now that new data has landed
+                        st.rerun()
+        except requests.Timeout:
+            st.error("⏱️ Lost contact with the update. It may still be running. Check back in a minute.")
+        except Exception as e:
+            st.error(f"❌ Error: {str(e)}")
 
 st.sidebar.markdown("---")
 st.sidebar.markdown("""
@@ -254,6 +290,10 @@ with tab1:
         if response.status_code == 200:
             wealth_data = response.json()
             
+            if wealth_data.get('unconverted'):
+                missing = ", ".join(f"{c['name']} ({c['currency']})" for c in wealth_data['unconverted'])
+                st.warning(f"⚠️ No FX rates, left out of the totals: {missing}")
+            
             # Display key metrics
             col1, col2, col3, col4 = st.columns(4)
             
@@ -292,6 +332,14 @@ with tab1:
             usd_equivalent = net_wealth / wealth_data['fx_rates'].get('USD', 327.87)
             st.info(f"💵 **Net Wealth in USD**: ${usd_equivalent:,.2f}")
             
+            # Per-portfolio subtotals when more than one portfolio is consolidated
+            if len(wealth_data.get('portfolios', [])) > 1:
+                portfolios_df = pd.DataFrame([
+                    {"Portfolio": p['name'], "Value (HUF)": f"{p['value_huf']:,.0f}", "Valued On": p['value_date']}
+                    for p in wealth_data['portfolios']
+                ])
+                st.dataframe(portfolios_df, use_container_width=True, hide_index=True)
+            
             st.markdown("---")
             
             # Breakdown
@@ -393,11 +441,11 @@ with tab1:
                         
                         df_port_display = df_port_display[[
                             'name', 'instrument_type', 'quantity', 'price', 
-                            'currency', 'value_huf', 'price_source'
+                            'currency', 'value_huf', 'price_source', 'price_date'
                         ]]
                         df_port_display.columns = [
                             'Instrument', 'Type', 'Quantity', 'Price', 
-                            'Currency', 'Value (HUF)', 'Price Source'
+                            'Currency', 'Value (HUF)', 'Price Source', 'Price Date'
                         ]
                         
                         st.dataframe(df_port_display, use_container_width=True, hide_index=True)
@@ -1017,11 +1065,11 @@ with tab4:
                 
                 df_display = df_display[[
                     'name', 'instrument_type', 'quantity', 'price', 
-                    'currency', 'value_huf', 'price_source'
+                    'currency', 'value_huf', 'price_source', 'price_date'
                 ]]
                 df_display.columns = [
                     'Instrument', 'Type', 'Quantity', 'Price', 
-                    'Currency', 'Value (HUF)', 'Source'
+                    'Currency', 'Value (HUF)', 'Source', 'Price Date'
                 ]
                 
                 st.dataframe(df_display, use_container_width=True, hide_index=True)